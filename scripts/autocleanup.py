@@ -3,48 +3,62 @@
 
 import os
 import datetime
-import boto3
+import functools
+from clients import get_client
 from cleanup import cleanup_version_stack
-from cleanup import get_alb_default_target_group
+from concurrency import print_report
+from concurrency import run_tasks
+from cutover import get_alb_default_target_groups
+from metrics import run_report
+from stack_resources import get_physical_resource_id
+from tracing import trace_run
+
+
+def get_stack_record(stack):
+    """Given a stack from describe_stacks, returns the inventory record used by the autocleanup filters"""
+
+    return {
+        'StackName': stack['StackName'],
+        'StackId': stack['StackId'],
+        'StackStatus': stack['StackStatus'],
+        'Description': stack.get('Description', ''),
+        'CreationTime': stack['CreationTime'],
+        'TerminationProtection': stack.get('EnableTerminationProtection', False),
+        'Parameters': {x['ParameterKey']: x.get('ParameterValue') for x in stack.get('Parameters', [])},
+        'Outputs': {x['OutputKey']: x.get('OutputValue') for x in stack.get('Outputs', [])}
+    }
 
 
 def list_stacks(cluster_name, app_name):
-    """List stacks matching the app stack convention"""
+    """List stacks matching the app stack convention
+
+    Pages through describe_stacks once and returns an inventory record per stack, so the
+    filters below never have to describe a stack again."""
 
     stack_name_prefix = "ECS-{cluster_name}-App-{app_name}-".format(
         cluster_name=cluster_name,
         app_name=app_name
     )
     stack_description = "ECS Cluster Application Version"
+    stack_statuses = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
 
     stack_list = []
 
-    cloudformation = boto3.client('cloudformation')
-    paginator = cloudformation.get_paginator('list_stacks')
-    response_iterator = paginator.paginate(StackStatusFilter=['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'])
-    for page in response_iterator:
-        stacks = page['StackSummaries']
-        for stack in stacks:
+    cloudformation = get_client('cloudformation')
+    paginator = cloudformation.get_paginator('describe_stacks')
+    for page in paginator.paginate():
+        for stack in page['Stacks']:
             if not stack['StackName'].startswith(stack_name_prefix):
                 continue
-            if "".join(stack['TemplateDescription']) != stack_description:
+            if stack['StackStatus'] not in stack_statuses:
                 continue
-
-            # Check if application name is correct:
-            response = cloudformation.describe_stacks(
-                StackName=stack['StackName']
-            )
-            stack_details = response['Stacks'][0]
-            stack_param_name = "undefined"
-
-            for stack_param in stack_details['Parameters']:
-                if stack_param['ParameterKey'] == 'Name':
-                    stack_param_name = stack_param['ParameterValue']
-
-            if stack_param_name != app_name:
+            record = get_stack_record(stack)
+            if record['Description'] != stack_description:
+                continue
+            if record['Parameters'].get('Name', 'undefined') != app_name:  # Check if application name is correct
                 continue
 
-            stack_list.append(stack)
+            stack_list.append(record)
 
     return stack_list
 
@@ -61,22 +75,30 @@ def filter_old_stacks(stacks, age_seconds):
     return filtered_stacks
 
 
-def filter_not_cutover(stacks, cluster_name, app_name):
-    """Filter live stacks from the rest"""
+def get_stack_target_group(stack):
+    """Return the Target Group ARN of a given stack record
+
+    Read from the `TargetGroup` output, so filtering needs no call per stack. Stacks deployed
+    before the template had that output fall back to looking up the stack's resources."""
+
+    target_group = stack['Outputs'].get('TargetGroup')
+    if target_group is None:
+        target_group = get_physical_resource_id(stack['StackName'], 'ALBTargetGroup')
+    return target_group
+
+
+def filter_not_cutover(stacks, cluster_name, app_name, live_target_groups=None):
+    """Filter live stacks from the rest
+
+    `live_target_groups` are the target groups the listener forwards to, looked up when not given."""
 
     filtered_stacks = []
 
-    alb_default_target_group = get_alb_default_target_group(cluster_name, app_name)
+    alb_default_target_groups = get_alb_default_target_groups(cluster_name, app_name) if live_target_groups is None else live_target_groups
 
-    cloudformation = boto3.client('cloudformation')
     for stack in stacks:
-        # Fetching Application Version TargetGroup ARN
-        response = cloudformation.describe_stack_resources(
-            StackName=stack['StackName'],
-            LogicalResourceId='ALBTargetGroup'
-        )
-        target_group = response['StackResources'][0]['PhysicalResourceId']
-        if target_group != alb_default_target_group:
+        target_group = get_stack_target_group(stack)
+        if target_group not in alb_default_target_groups:
             filtered_stacks.append(stack)
 
     return filtered_stacks
@@ -102,22 +124,41 @@ def filter_excludes(stacks, stack_excludes):
     return filtered_stacks
 
 
-def get_stack_version(stack_name):
-    """Return the `Version` output of a given CloudFormation stack"""
+def get_stack_version(stack):
+    """Return the `Version` output of a given stack record"""
+
+    return stack['Outputs'].get('Version')
+
+
+def get_termination_protection(stack):
+    """Return the state of termination protection for a given stack record"""
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stacks(StackName=stack_name)
-    for output in response['Stacks'][0]['Outputs']:
-        if output['OutputKey'] == 'Version':
-            return output['OutputValue']
+    return stack['TerminationProtection']
 
 
-def get_termination_protection(stack_name):
-    """Return the state of termination protection for a given CloudFormation stack"""
+def cleanup_versions(cluster_name, app_name, stacks, concurrency=1, live_target_groups=None):
+    """Cleans up the versions of the given stack records, deleting up to `concurrency` stacks at the same time
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stacks(StackName=stack_name)
-    return response['Stacks'][0]['EnableTerminationProtection']
+    The stack ID and target group come from the inventory and the live target groups are
+    resolved once per run, so a deletion makes no lookups of its own. A failure in one stack
+    does not stop the others, returns one result per version, see concurrency.run_tasks.
+    Each version's output is prefixed with the version."""
+
+    if live_target_groups is None:
+        live_target_groups = get_alb_default_target_groups(cluster_name, app_name)
+    tasks = [
+        (str(get_stack_version(stack)), functools.partial(
+            cleanup_version_stack,
+            cluster_name=cluster_name,
+            app_name=app_name,
+            version=get_stack_version(stack),
+            stack_id=stack['StackId'],
+            target_group=get_stack_target_group(stack),
+            live_target_groups=live_target_groups
+        ))
+        for stack in stacks
+    ]
+    return run_tasks(tasks, max_workers=concurrency)
 
 
 def main():
@@ -125,7 +166,9 @@ def main():
 
     stacks = list_stacks(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'])
 
-    stacks = filter_not_cutover(stacks=stacks, cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'])
+    live_target_groups = get_alb_default_target_groups(os.environ['ECS_CLUSTER_NAME'], os.environ['ECS_APP_NAME'])
+
+    stacks = filter_not_cutover(stacks=stacks, cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'], live_target_groups=live_target_groups)
 
     if 'ECS_AUTOCLEANUP_EXCLUDES' in os.environ:
         stacks = filter_excludes(stacks, os.environ['ECS_AUTOCLEANUP_EXCLUDES'])
@@ -133,15 +176,16 @@ def main():
     if 'ECS_AUTOCLEANUP_OLDER_THAN' in os.environ:
         stacks = filter_old_stacks(stacks, os.environ['ECS_AUTOCLEANUP_OLDER_THAN'])
 
+    cleanup_stacks = []
     for stack in stacks:
-        version = get_stack_version(stack['StackName'])
+        version = get_stack_version(stack)
 
         stack_name = "{cluster_name}-{app_name}-{version}".format(
             cluster_name=os.environ['ECS_CLUSTER_NAME'],
             app_name=os.environ['ECS_APP_NAME'],
             version=version)
 
-        if get_termination_protection(stack['StackName']):
+        if get_termination_protection(stack):
             print("Skipping {stack_name}, Termination Protection Enabled".format(stack_name=stack_name))
             continue
 
@@ -149,9 +193,22 @@ def main():
             print("Skipping {stack_name}, Dry-run Enabled".format(stack_name=stack_name))
             continue
 
-        print("Cleaning up {stack_name}".format(stack_name=stack_name))
+        cleanup_stacks.append(stack)
+
+    results = cleanup_versions(
+        cluster_name=os.environ['ECS_CLUSTER_NAME'],
+        app_name=os.environ['ECS_APP_NAME'],
+        stacks=cleanup_stacks,
+        concurrency=int(os.environ.get('ECS_AUTOCLEANUP_CONCURRENCY', '1')),
+        live_target_groups=live_target_groups
+    )
+    print_report("Cleanup summary", results)
+
+    failed = [x['name'] for x in results if x['error'] is not None]
+    if failed:
+        raise Exception("Cleanup failed for version(s): {}".format(", ".join(str(x) for x in failed)))
 
-        cleanup_version_stack(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'], version=version)
 
 if __name__ == "__main__":
-    main()
+    with run_report('autocleanup'), trace_run('autocleanup'):
+        main()
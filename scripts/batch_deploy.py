@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""CLI tool for deploying many ECS Services from a single manifest
+
+The manifest is a YAML file with an optional `defaults` section and a list of `services`:
+
+    defaults:
+      env: Dev
+      cluster_name: my-cluster
+      aws_hosted_zone: example.com
+    services:
+      - app_name: api
+        version: 1.2.3
+        base_path: /api
+        task_definition: services/api/deployment/ecs.json
+        config: services/api/deployment/ecs-config.yml
+        variables:
+          SOME_VAR: some value
+
+`env`, `cluster_name` and `aws_hosted_zone` fall back to ENV, ECS_CLUSTER_NAME and
+AWS_HOSTED_ZONE. The task definition and config are rendered with the environment plus
+the service's ECS_APP_NAME, BUILD_VERSION, ENV, ECS_CLUSTER_NAME, AWS_HOSTED_ZONE and
+BASE_PATH and any extra `variables`. All services share the same AWS clients and stack
+resource cache."""
+
+import os
+import yaml
+from concurrency import print_report
+from concurrency import run_tasks
+from deploy import deploy_ecs_service
+from metrics import run_report
+from render import render_json_file
+from render import render_yaml_file
+from tracing import trace_run
+
+
+def load_manifest(path):
+    """Reads a batch manifest and returns one fully resolved entry per service"""
+
+    with open(path, 'r') as manifest_file:
+        manifest = yaml.safe_load(manifest_file)
+    defaults = {
+        'env': os.environ.get('ENV'),
+        'cluster_name': os.environ.get('ECS_CLUSTER_NAME'),
+        'aws_hosted_zone': os.environ.get('AWS_HOSTED_ZONE'),
+        'task_definition': 'deployment/ecs.json',
+        'config': 'deployment/ecs-config.yml',
+        'variables': {}
+    }
+    defaults.update(manifest.get('defaults') or {})
+
+    services = []
+    for service in manifest['services']:
+        entry = dict(defaults, **service)
+        missing = [x for x in ['app_name', 'version', 'base_path', 'env', 'cluster_name', 'aws_hosted_zone'] if entry.get(x) is None]
+        if missing:
+            raise Exception("Manifest entry {} is missing: {}".format(service.get('app_name', service), ", ".join(missing)))
+        entry['version'] = str(entry['version'])
+        services.append(entry)
+    return services
+
+
+def get_service_variables(service):
+    """Returns the variables a service's task definition and config are rendered with"""
+
+    variables = dict(os.environ)
+    variables.update({
+        'ECS_APP_NAME': service['app_name'],
+        'BUILD_VERSION': service['version'],
+        'ENV': service['env'],
+        'ECS_CLUSTER_NAME': service['cluster_name'],
+        'AWS_HOSTED_ZONE': service['aws_hosted_zone'],
+        'BASE_PATH': service['base_path']
+    })
+    variables.update({key: str(value) for key, value in service['variables'].items()})
+    return variables
+
+
+def _deploy_service(service, template):
+    """Renders a service's task definition and config and deploys it, with its variables as the containers' environment"""
+
+    variables = get_service_variables(service)
+    config = render_yaml_file(service['config'], variables)
+    task_definition = render_json_file(service['task_definition'], variables)
+    deploy_ecs_service(
+        app_name=service['app_name'],
+        env=service['env'],
+        cluster_name=service['cluster_name'],
+        version=service['version'],
+        aws_hosted_zone=service['aws_hosted_zone'],
+        base_path=service['base_path'],
+        config=config,
+        task_definition=task_definition,
+        template=template,
+        variables=variables
+    )
+
+
+def batch_deploy(services, template, concurrency):
+    """Deploys every service with at most `concurrency` deployments in flight, returns one result per service"""
+
+    tasks = [
+        ("{}-{}".format(service['app_name'], service['version']), lambda service=service: _deploy_service(service, template))
+        for service in services
+    ]
+    return run_tasks(tasks, max_workers=concurrency)
+
+
+def main():
+    """Entrypoint for CLI"""
+
+    template_path = os.environ.get('ECS_APP_VERSION_TEMPLATE_PATH', '/scripts/ecs-cluster-application-version.yml')
+    manifest_path = os.environ.get('ECS_BATCH_MANIFEST', 'deployment/batch.yml')
+    concurrency = int(os.environ.get('ECS_BATCH_CONCURRENCY', '5'))
+
+    services = load_manifest(manifest_path)
+    with open(template_path, 'r') as template_file:
+        template = template_file.read()
+
+    print("Deploying {} services, {} at a time...".format(len(services), concurrency))
+    results = batch_deploy(services, template, concurrency)
+    print_report("Batch deploy report", results)
+
+    failed = [x['name'] for x in results if x['error'] is not None]
+    if failed:
+        raise Exception("Deployment failed for: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    with run_report('batch-deploy'), trace_run('batch-deploy'):
+        main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Benchmarks the deploy, cutover, cleanup and autocleanup code paths against fake_aws
+
+Each scenario runs against a freshly built synthetic fleet: a cluster with ECS_BENCH_SERVICES
+unrelated services, an app with ECS_BENCH_VERSIONS version stacks and ECS_BENCH_RULES unrelated
+listener rules. Every fake API attempt takes ECS_BENCH_LATENCY seconds and ECS_BENCH_THROTTLE_RATE
+of them fail with ThrottlingException. The fake clients carry the same retry, rate limiting
+(ECS_RATE_LIMITS) and metrics hooks as boto3 clients, so throttled calls are retried with
+botocore's backoff and requests wait for the rate limiter. Reports the wall time, API calls,
+retries and rate limiter waits of each scenario, and writes them as JSON to ECS_BENCH_OUTPUT
+when set, so runs can be compared."""
+
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import contextlib
+from clients import set_client_factory
+from fake_aws import FakeAWS
+from metrics import get_summary
+from metrics import reset_metrics
+from rate_limit import reset_rate_limiters
+from stack_resources import reset_stack_resources
+import autocleanup
+from cleanup import cleanup_version_stack
+from cutover import change_default_rule_tg
+from deploy import deploy_ecs_service
+
+
+CLUSTER_NAME = 'bench'
+APP_NAME = 'app'
+SCENARIOS = ['deploy', 'cutover', 'progressive_cutover', 'cleanup', 'autocleanup']
+
+CONFIG = {
+    'lb_health_check': '/',
+    'lb_health_check_grace_period': 30,
+    'lb_health_check_timeout': 5,
+    'lb_health_check_interval': 10,
+    'security_classification': 'bench',
+    'security_data_type': 'bench',
+    'security_accessibility': 'bench',
+    'stack_tags': []
+}
+TASK_DEFINITION = {
+    'family': 'bench-app',
+    'containerDefinitions': [{'name': APP_NAME, 'image': 'bench', 'portMappings': [{'containerPort': 8080}]}]
+}
+
+
+@contextlib.contextmanager
+def _environment(values):
+    """Sets environment variables while the with statement runs"""
+
+    previous = {key: os.environ.get(key) for key in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+
+
+def run_deploy(_):
+    """Deploys a new version of the app"""
+
+    deploy_ecs_service(
+        app_name=APP_NAME, env='Bench', cluster_name=CLUSTER_NAME, version='new', aws_hosted_zone='example.com',
+        base_path='/', config=CONFIG, task_definition=json.loads(json.dumps(TASK_DEFINITION)), template='Resources: {}'
+    )
+
+
+def run_cutover(fake):
+    """Cuts over to a new version that has fewer tasks than the live one"""
+
+    fake.add_version(CLUSTER_NAME, APP_NAME, 'new')
+    fake.reset_counters()
+    change_default_rule_tg(cluster_name=CLUSTER_NAME, app_name=APP_NAME, version='new', aws_hosted_zone='example.com', base_path='/')
+
+
+def run_progressive_cutover(fake):
+    """Cuts over to a new version in three weighted steps, without waiting between them"""
+
+    with _environment({'ECS_CUTOVER_STEPS': '10,50,100', 'ECS_CUTOVER_STEP_INTERVAL': '0'}):
+        run_cutover(fake)
+
+
+def run_cleanup(_):
+    """Deletes the oldest version"""
+
+    cleanup_version_stack(cluster_name=CLUSTER_NAME, app_name=APP_NAME, version='v0')
+
+
+def run_autocleanup(_):
+    """Deletes every version but the live one"""
+
+    with _environment({'ECS_CLUSTER_NAME': CLUSTER_NAME, 'ECS_APP_NAME': APP_NAME}):
+        autocleanup.main()
+
+
+def run_scenario(name, fleet, latency=0.0, throttle_rate=0.0, verbose=False):
+    """Runs a scenario against a fresh fake fleet and returns its wall time and API call counts"""
+
+    fake = FakeAWS(latency=latency, throttle_rate=throttle_rate)
+    fake.build_fleet(CLUSTER_NAME, APP_NAME, **fleet)
+    set_client_factory(fake.client)
+    reset_stack_resources()
+    reset_rate_limiters()
+    reset_metrics()
+
+    scenario = globals()['run_{}'.format(name)]
+    output = sys.stdout if verbose else io.StringIO()
+    error = None
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, '.env'), 'w').close()
+        settings = {
+            'DOTENV': os.path.join(directory, '.env'),
+            'ECS_TEMPLATE_VALIDATION_CACHE': os.path.join(directory, 'template-validation.json'),
+            'ECS_STACK_EVENTS_POLL_INTERVAL': '0.1'
+        }
+        start_time = time.monotonic()
+        try:
+            with _environment(settings), contextlib.redirect_stdout(output):
+                scenario(fake)
+        except Exception as exception:  # pylint: disable=broad-except
+            error = exception
+        finally:
+            wall_time = time.monotonic() - start_time
+            set_client_factory(None)
+            reset_stack_resources()
+
+    summary = get_summary()
+    return {
+        'scenario': name,
+        'wall_time': wall_time,
+        'total_calls': sum(fake.calls.values()),
+        'throttles': sum(fake.throttles.values()),
+        'retries': sum(x['retries'] for x in summary['services'].values()),
+        'rate_limit_wait': round(sum(y['total_seconds'] for x, y in summary['waits'].items() if x.startswith('rate_limit.')), 3),
+        'calls': dict(sorted(fake.calls.items())),
+        'error': None if error is None else str(error)
+    }
+
+
+def print_results(results):
+    """Prints the wall time and API calls of every scenario"""
+
+    print("{:22}{:>12}{:>12}{:>12}{:>12}{:>14}".format('Scenario', 'Wall time', 'API calls', 'Throttled', 'Retries', 'Rate limited'))
+    for result in results:
+        status = '' if result['error'] is None else '  FAILED ({})'.format(result['error'])
+        print("{:22}{:>11.2f}s{:>12}{:>12}{:>12}{:>13.2f}s{}".format(
+            result['scenario'], result['wall_time'], result['total_calls'], result['throttles'], result['retries'], result['rate_limit_wait'], status))
+        for operation, count in result['calls'].items():
+            print("    {:54}{:>8}".format(operation, count))
+
+
+def main():
+    """Entrypoint for CLI"""
+
+    fleet = {
+        'versions': int(os.environ.get('ECS_BENCH_VERSIONS', '100')),
+        'services': int(os.environ.get('ECS_BENCH_SERVICES', '300')),
+        'rules': int(os.environ.get('ECS_BENCH_RULES', '200'))
+    }
+    latency = float(os.environ.get('ECS_BENCH_LATENCY', '0.02'))
+    throttle_rate = float(os.environ.get('ECS_BENCH_THROTTLE_RATE', '0'))
+    scenarios = [x.strip() for x in os.environ.get('ECS_BENCH_SCENARIOS', ','.join(SCENARIOS)).split(',')]
+    verbose = os.environ.get('ECS_BENCH_VERBOSE', 'false') == 'true'
+
+    print("Fleet: {versions} versions, {services} services, {rules} listener rules".format(**fleet))
+    print("Latency {}s per attempt, {:.0%} of attempts throttled".format(latency, throttle_rate))
+    results = [run_scenario(x, fleet, latency, throttle_rate, verbose) for x in scenarios]
+    print_results(results)
+
+    if 'ECS_BENCH_OUTPUT' in os.environ:
+        with open(os.environ['ECS_BENCH_OUTPUT'], 'w') as output_file:
+            json.dump({'fleet': fleet, 'latency': latency, 'throttle_rate': throttle_rate, 'results': results}, output_file, indent=2)
+
+    failed = [x['scenario'] for x in results if x['error'] is not None]
+    if failed:
+        raise Exception("Benchmark scenarios failed: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    main()
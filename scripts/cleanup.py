@@ -2,16 +2,25 @@
 """CLI and function for targeted cleanup"""
 
 import os
-import boto3
 import botocore
+from clients import get_client
+from concurrency import check_stopped
 from cutover import get_version_target_group
-from cutover import get_alb_default_target_group
+from cutover import get_alb_default_target_groups
+from metrics import run_report
+from metrics import timed
+from stack_events import tail_stack_events
+from stack_resources import invalidate_stack_resources
+from tracing import trace_run
 
 
-def cleanup_version_stack(cluster_name, app_name, version):
-    """Main function for cleaning up a given version stack"""
+def cleanup_version_stack(cluster_name, app_name, version, stack_id=None, target_group=None, live_target_groups=None):  # pylint: disable=too-many-arguments
+    """Main function for cleaning up a given version stack
 
-    cloudformation = boto3.client('cloudformation')
+    Callers that already know the stack's ID, its target group or the target groups the
+    listener forwards to, e.g. autocleanup from its inventory, pass them to skip the lookups."""
+
+    cloudformation = get_client('cloudformation')
 
     version_stack_name = "ECS-{cluster_name}-App-{app_name}-{version}".format(
         cluster_name=cluster_name,
@@ -19,15 +28,25 @@ def cleanup_version_stack(cluster_name, app_name, version):
         version=version
     )
 
-    alb_default_target_group = get_alb_default_target_group(cluster_name, app_name)
+    if live_target_groups is None:
+        live_target_groups = get_alb_default_target_groups(cluster_name, app_name)
 
-    target_group = get_version_target_group(version_stack_name)
+    if target_group is None:
+        target_group = get_version_target_group(version_stack_name)
 
-    if target_group == alb_default_target_group:
+    if target_group in live_target_groups:
         # Cannot cleanup, target group is in use
         raise Exception("Cannot cleanup, version {version} is live".format(version=version))
 
-    response = cloudformation.delete_stack(
+    # Deleted stacks can only be looked up by ID, so resolve it before deleting
+    if stack_id is None:
+        response = cloudformation.describe_stacks(
+            StackName=version_stack_name
+        )
+        stack_id = response['Stacks'][0]['StackId']
+
+    check_stopped()
+    cloudformation.delete_stack(
         StackName=version_stack_name
     )
 
@@ -35,27 +54,23 @@ def cleanup_version_stack(cluster_name, app_name, version):
 
     print("Deleting stack: {}".format(version_stack_name))
     try:
-        waiter.wait(StackName=version_stack_name)
+        with tail_stack_events(stack_id), timed('waiter.stack_delete_complete'):
+            waiter.wait(StackName=stack_id)
     except botocore.exceptions.WaiterError:
-        print('Could not delete version stack!')
-        print('Outputting events for stack {}:'.format(version_stack_name))
-        response = cloudformation.describe_stack_events(
-            StackName=version_stack_name
-        )
+        print('Could not delete version stack {}!'.format(version_stack_name))
+        raise
+    finally:
+        invalidate_stack_resources(version_stack_name)
 
-        for stack_event in response['StackEvents'][::-1]:
-            if 'ResourceStatusReason' not in stack_event:
-                stack_event['ResourceStatusReason'] = ""
+    print('Stack deletion complete')
 
-            print(
-                "{resource_status} {logical_resource_id} {resource_status_reason}".format(
-                    resource_status=stack_event['ResourceStatus'],
-                    logical_resource_id=stack_event['LogicalResourceId'],
-                    resource_status_reason=stack_event['ResourceStatusReason']
-                )
-            )
 
-    print('Stack deletion complete')
+def main():
+    """CLI entrypoint for cleanup.py"""
 
-if __name__ == "__main__":
     cleanup_version_stack(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'], version=os.environ['BUILD_VERSION'])
+
+
+if __name__ == "__main__":
+    with run_report('cleanup'), trace_run('cleanup'):
+        main()
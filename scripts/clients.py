@@ -0,0 +1,109 @@
+"""Process-wide registry of boto3 clients shared by all ecs-utils scripts"""
+
+import os
+import threading
+import contextlib
+import boto3
+import botocore.config
+from metrics import instrument_client
+from rate_limit import limit_client_rate
+from tracing import trace_client
+
+
+_SESSION = None
+_CLIENTS = {}
+_LOCK = threading.Lock()
+_THREAD_STATE = threading.local()
+_CLIENT_FACTORY = None
+
+
+def _get_session():
+    """Returns the boto3 session shared by every client in this process"""
+
+    global _SESSION  # pylint: disable=global-statement
+    if _SESSION is None:
+        _SESSION = boto3.session.Session()
+    return _SESSION
+
+
+def get_client_config():
+    """Returns the botocore config applied to every client
+
+    The connection pool size can be tuned with ECS_UTILS_MAX_POOL_CONNECTIONS. Throttled
+    calls are retried in botocore's adaptive mode, which also slows a client down once it
+    is throttled, up to ECS_UTILS_MAX_ATTEMPTS attempts."""
+
+    return botocore.config.Config(
+        max_pool_connections=int(os.environ.get('ECS_UTILS_MAX_POOL_CONNECTIONS', '20')),
+        tcp_keepalive=True,
+        retries={'mode': 'adaptive', 'max_attempts': int(os.environ.get('ECS_UTILS_MAX_ATTEMPTS', '10'))}
+    )
+
+
+def get_region(region=None):
+    """Returns the given region, else the region selected with use_region in this thread, else the session's region"""
+
+    if region is not None:
+        return region
+    if getattr(_THREAD_STATE, 'region', None) is not None:
+        return _THREAD_STATE.region
+    with _LOCK:
+        return _get_session().region_name
+
+
+@contextlib.contextmanager
+def use_region(region):
+    """Makes clients created without an explicit region in this thread use `region` while the with statement runs
+
+    Threads started from inside the with statement do not inherit the region, pass
+    get_region() to them explicitly."""
+
+    previous = getattr(_THREAD_STATE, 'region', None)
+    _THREAD_STATE.region = region
+    try:
+        yield
+    finally:
+        _THREAD_STATE.region = previous
+
+
+def get_client(service, region=None):
+    """Returns a boto3 client for the given service and region, creating it on first use
+
+    Clients are cached per (service, region) for the lifetime of the process so endpoint
+    resolution and TLS connection pools are reused across calls and threads. Their calls
+    are recorded by the metrics and tracing modules and rate limited per service by rate_limit."""
+
+    region = get_region(region)
+    with _LOCK:  # boto3 sessions are not thread safe, so creation is serialised
+        session = _get_session()
+        key = (service, region)
+        if key not in _CLIENTS:
+            factory = session.client if _CLIENT_FACTORY is None else _CLIENT_FACTORY
+            client = factory(service, region_name=region, config=get_client_config())
+            instrument_client(client)
+            limit_client_rate(client, service, region)
+            trace_client(client)
+            _CLIENTS[key] = client
+        return _CLIENTS[key]
+
+
+def set_client_factory(factory):
+    """Makes get_client build clients with `factory(service, region_name=..., config=...)` instead of boto3
+
+    Used to run the scripts against an in-process stand-in for AWS, pass None to go back to boto3.
+    The clients it builds get the same hooks as boto3 clients, so they must emit botocore
+    events through `client.meta.events`. Drops every cached client."""
+
+    global _CLIENT_FACTORY  # pylint: disable=global-statement
+    reset_clients()
+    with _LOCK:
+        _CLIENT_FACTORY = factory
+
+
+def reset_clients():
+    """Drops every cached client and the shared session"""
+
+    global _SESSION  # pylint: disable=global-statement
+    with _LOCK:
+        _CLIENTS.clear()
+        _SESSION = None
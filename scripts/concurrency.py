@@ -0,0 +1,241 @@
+"""Helpers for running deployment work concurrently in one process"""
+
+import sys
+import time
+import datetime
+import threading
+import contextlib
+import concurrent.futures
+from clients import get_region
+from clients import use_region
+from tracing import current_span
+from tracing import use_parent
+
+
+_STOP = threading.local()
+
+
+class TaskStoppedError(Exception):
+    """Raised by check_stopped when another task of a fail-fast run has failed"""
+
+
+@contextlib.contextmanager
+def use_stop_event(event):
+    """Makes check_stopped in this thread raise once `event` is set, while the with statement runs"""
+
+    previous = getattr(_STOP, 'event', None)
+    _STOP.event = event
+    try:
+        yield
+    finally:
+        _STOP.event = previous
+
+
+def check_stopped():
+    """Raises TaskStoppedError if the fail-fast run this thread belongs to has been stopped
+
+    Called between the phases of deploy, warmup, cutover and cleanup, so a task that is
+    already running stops before its next change to AWS rather than running to completion.
+    Does nothing outside of a fail-fast run."""
+
+    event = getattr(_STOP, 'event', None)
+    if event is not None and event.is_set():
+        raise TaskStoppedError("Stopped after another task failed")
+
+
+class PrefixedStream:
+    """Wraps a stream so that each line written by a thread carries that thread's prefix"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        """Writes complete lines with the current thread's prefix, buffering any partial line"""
+
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            return self.stream.write(text)
+        lines = (getattr(self.local, 'buffer', '') + text).split('\n')
+        self.local.buffer = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.stream.write('[{}] {}\n'.format(prefix, line))
+        return len(text)
+
+    def flush(self):
+        """Writes out the current thread's partial line, then flushes the underlying stream"""
+
+        buffer = getattr(self.local, 'buffer', '')
+        if buffer:
+            self.local.buffer = ''
+            with self.lock:
+                self.stream.write('[{}] {}'.format(self.local.prefix, buffer))
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def output_prefix(prefix):
+    """Prefixes every line the current thread prints with `prefix` while the with statement runs"""
+
+    if not isinstance(sys.stdout, PrefixedStream):
+        sys.stdout = PrefixedStream(sys.stdout)
+    stream = sys.stdout
+    previous = getattr(stream.local, 'prefix', None)
+    stream.local.prefix = prefix
+    try:
+        yield
+    finally:
+        stream.flush()
+        stream.local.prefix = previous
+
+
+def bind_thread_context(function):
+    """Returns a callable running `function` with the calling thread's region, output prefix, tracing span and stop event
+
+    Used to hand work to pool threads without losing which region and deployment it belongs to."""
+
+    region = get_region()
+    prefix = getattr(sys.stdout.local, 'prefix', None) if isinstance(sys.stdout, PrefixedStream) else None
+    parent_span = current_span()
+    stop = getattr(_STOP, 'event', None)
+
+    def run(*args, **kwargs):
+        with use_region(region), use_parent(parent_span), use_stop_event(stop):
+            if prefix is None:
+                return function(*args, **kwargs)
+            with output_prefix(prefix):
+                return function(*args, **kwargs)
+    return run
+
+
+def get_critical_path(timings, dependencies):
+    """Returns the chain of steps that determined the total duration, first step first
+
+    Starting from the step that finished last, repeatedly follows the dependency that finished last."""
+
+    if not timings:
+        return []
+    path = [max(timings, key=lambda x: timings[x]['end'])]
+    while dependencies[path[-1]]:
+        path.append(max(dependencies[path[-1]], key=lambda x: timings[x]['end']))
+    return path[::-1]
+
+
+def run_graph(steps, max_workers=4):  # pylint: disable=too-many-locals
+    """Runs a small dependency graph of steps concurrently and returns the result of every step
+
+    `steps` is a list of (name, function, dependencies) tuples. Each function is called with
+    a dict holding the results of the steps it depends on and starts as soon as they are done.
+    The critical path is printed at the end; the first failing step's exception is re-raised
+    once the steps already running have finished."""
+
+    functions = {name: bind_thread_context(function) for name, function, _ in steps}
+    dependencies = {name: list(depends_on) for name, _, depends_on in steps}
+    results = {}
+    timings = {}
+    running = {}
+    start_time = time.monotonic()
+
+    def timed(name, inputs):
+        started = time.monotonic() - start_time
+        try:
+            return functions[name](inputs)
+        finally:
+            timings[name] = {'start': started, 'end': time.monotonic() - start_time}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [name for name, _, _ in steps]
+        error = None
+        while pending or running:
+            for name in [x for x in pending if all(y in results for y in dependencies[x])] if error is None else []:
+                pending.remove(name)
+                running[executor.submit(timed, name, {x: results[x] for x in dependencies[name]})] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    results[name] = future.result()
+        if error is not None:
+            raise error
+        if pending:
+            raise Exception("Steps with unmet dependencies: {}".format(", ".join(pending)))
+
+    critical_path = get_critical_path(timings, dependencies)
+    print("Critical path: {}".format(" -> ".join(
+        "{} ({:.1f}s)".format(x, timings[x]['end'] - timings[x]['start']) for x in critical_path)))
+    return results
+
+
+def _run_task(name, function, stop=None):
+    """Runs a task with its output prefixed by its name, returns its result instead of raising
+
+    When `stop` is given, the task runs with it as its stop event and a failure sets it,
+    otherwise the task keeps the stop event of the thread that started it."""
+
+    start_time = datetime.datetime.now()
+    value = None
+    error = None
+    with output_prefix(name), use_stop_event(stop) if stop is not None else contextlib.nullcontext():
+        try:
+            check_stopped()  # a worker freed by the failing task must not start a queued one
+            value = function()
+        except TaskStoppedError as exception:
+            print("Stopped: {}".format(exception))
+            error = 'cancelled'
+        except Exception as exception:  # pylint: disable=broad-except
+            print("Failed: {}".format(exception))
+            error = exception
+            if stop is not None:
+                stop.set()
+    return {
+        'name': name,
+        'value': value,
+        'error': error,
+        'elapsed_time': datetime.datetime.now() - start_time
+    }
+
+
+def run_tasks(tasks, max_workers, fail_fast=False):
+    """Runs named callables with at most `max_workers` at a time and returns one result per task, in order
+
+    A failing task does not stop the others unless fail_fast is set. Then, once a task has
+    failed, tasks that have not started yet are cancelled, and running tasks stop at their
+    next check_stopped, both reported as cancelled. Work a running task did before that
+    check is not undone. Tasks run with the calling thread's region and tracing span, see
+    bind_thread_context."""
+
+    stop = threading.Event() if fail_fast else None
+    run_task = bind_thread_context(_run_task)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [(name, executor.submit(run_task, name, function, stop)) for name, function in tasks]
+        if fail_fast:
+            for future in concurrent.futures.as_completed([x[1] for x in futures]):
+                if future.result()['error'] is not None:
+                    for _, pending in futures:
+                        pending.cancel()
+                    break
+        results = []
+        for name, future in futures:
+            if future.cancelled():
+                results.append({'name': name, 'value': None, 'error': 'cancelled', 'elapsed_time': datetime.timedelta(0)})
+            else:
+                results.append(future.result())
+        return results
+
+
+def print_report(title, results):
+    """Prints the outcome and duration of every task"""
+
+    print("{}:".format(title))
+    for result in results:
+        status = 'OK' if result['error'] is None else 'FAILED ({})'.format(result['error'])
+        print("{:50}{:20}{}".format('{}:'.format(result['name']), str(result['elapsed_time']), status))
@@ -4,40 +4,64 @@ CLI tool and function for changing the default rule of an ALB to point to a TG
 """
 
 import os
-import time
-import datetime
-import boto3
+import concurrent.futures
+from clients import get_client
+from concurrency import bind_thread_context
+from concurrency import check_stopped
+from cutover_history import get_service_entry
+from cutover_history import record_cutover
 from deploy import get_list_of_rules
-
-
-def get_alb_default_target_group(cluster_name, app_name):
-    """Return the Target Group for the default routing rule of an ALB"""
+from drain import drain_previous_version
+from drain import get_drain_settings
+from health import PollTimeoutError
+from health import wait_for_healthy_targets
+from metrics import run_report
+from scaling import carry_scaling_state
+from scaling import get_resource_id
+from scaling import get_scalable_target
+from scaling import get_scaling_settings
+from stack_resources import get_physical_resource_id
+from tracing import span
+from tracing import trace_run
+from traffic_shift import check_version
+from traffic_shift import get_action_weights
+from traffic_shift import get_shift_settings
+from traffic_shift import set_listener_weights
+from traffic_shift import shift_traffic
+
+
+def get_alb_default_weights(cluster_name, app_name):
+    """Return the {Target Group ARN: weight} of the default routing rule of an ALB"""
 
     app_stack_name = "ECS-{cluster}-App-{app}".format(cluster=cluster_name, app=app_name)
 
-    alb_default_target_group = ""
-
     rules = get_list_of_rules(app_stack_name)
     for rule in rules:
         if rule['IsDefault'] is True:
-            alb_default_target_group = rule['Actions'][0]['TargetGroupArn']
-            break
+            return get_action_weights(rule['Actions'][0])
+
+    raise Exception("Default action target group not found in ALB Listener")
+
+
+def get_alb_default_target_group(cluster_name, app_name):
+    """Return the Target Group receiving most traffic from the default routing rule of an ALB"""
+
+    weights = get_alb_default_weights(cluster_name, app_name)
+    return max(weights, key=weights.get)
 
-    if alb_default_target_group == "":
-        raise Exception("Default action target group not found in ALB Listener")
 
-    return alb_default_target_group
+def get_alb_default_target_groups(cluster_name, app_name):
+    """Return every Target Group receiving traffic from the default routing rule of an ALB
+
+    There is more than one while a progressive cutover is in progress or was stopped half way."""
+
+    return [x for x, weight in get_alb_default_weights(cluster_name, app_name).items() if weight > 0]
 
 
 def get_version_target_group(version_stack_name):
     """Returns the ARN of a Target Group for a given version stack"""
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName=version_stack_name,
-        LogicalResourceId='ALBTargetGroup'
-    )
-    target_group = response['StackResources'][0]['PhysicalResourceId']
+    target_group = get_physical_resource_id(version_stack_name, 'ALBTargetGroup')
     print('Target Group ARN is: {}'.format(target_group))
     return target_group
 
@@ -45,12 +69,7 @@ def get_version_target_group(version_stack_name):
 def get_cluster_full_name(cluster_name):
     """Returns the automatically generated name of the cluster from the logical name we give it"""
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName="ECS-{}".format(cluster_name),
-        LogicalResourceId='ECSCluster'
-    )
-    cluster = response['StackResources'][0]['PhysicalResourceId']
+    cluster = get_physical_resource_id("ECS-{}".format(cluster_name), 'ECSCluster')
     return cluster
 
 
@@ -60,103 +79,136 @@ def get_current_count(cluster_name, service_full_name, cluster_full_name=None):
     if cluster_full_name is None:
         cluster_full_name = get_cluster_full_name(cluster_name)
 
-    ecs = boto3.client('ecs')
+    ecs = get_client('ecs')
     response = ecs.describe_services(
         cluster=cluster_full_name,
         services=[service_full_name])
     return response['services'][0]['runningCount']
 
 
-def get_live_desired_count(cluster_name, app_name, cluster_full_name=None, next_token=None):
-    """For a given app, loop through all services in the cluster and return the desired count for the live service. Recursively calls itself to loop through list_service pagination."""
+def chunks(items, size):
+    """Splits a list into consecutive lists of at most `size` items"""
+
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _find_service_by_target_group(cluster_full_name, services, target_group):
+    """Describes up to 10 services and returns the one attached to the target group, if any"""
+
+    ecs = get_client('ecs')
+    response = ecs.describe_services(cluster=cluster_full_name, services=services)
+    for service in response['services']:
+        if len(service['loadBalancers']) > 0:  # pylint: disable=len-as-condition
+            if service['loadBalancers'][0]['targetGroupArn'] == target_group:
+                return service
+    return None
+
+
+def get_service_by_target_group(cluster_full_name, target_group):
+    """Scans the services in the cluster and returns the one attached to the target group, or None if there is none
+
+    Each page of list_services is described in concurrent batches of 10 (the describe_services limit)
+    and the scan stops at the first page that contains the service. The batches run with this
+    thread's region, output prefix and tracing span, see concurrency.bind_thread_context."""
+
+    find_service = bind_thread_context(_find_service_by_target_group)
+    ecs = get_client('ecs')
+    paginator = ecs.get_paginator('list_services')
+    pages = paginator.paginate(cluster=cluster_full_name, launchType='EC2', PaginationConfig={'PageSize': 100})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        for page in pages:
+            services = [x.split('/')[-1] for x in page['serviceArns']]  # returned data is ARN, we just want the name
+            futures = [executor.submit(find_service, cluster_full_name, batch, target_group) for batch in chunks(services, 10)]
+            for future in concurrent.futures.as_completed(futures):
+                service = future.result()
+                if service is not None:
+                    return service
+    return None
+
+
+def get_live_service(cluster_name, app_name, cluster_full_name=None):
+    """For a given app, return the service behind the default rule of the ALB, or None if there is none"""
 
     if cluster_full_name is None:
         cluster_full_name = get_cluster_full_name(cluster_name)
 
-    live_service = None
-    ecs = boto3.client('ecs')
     default_target_group = get_alb_default_target_group(cluster_name, app_name)
-    kwargs = {
-        'cluster': cluster_full_name,
-        'launchType': 'EC2',
-    }
-    if next_token is not None:
-        kwargs['nextToken'] = next_token
-    response = ecs.list_services(**kwargs)
-    next_token = response.get('nextToken')
-    services = [x.split('/')[-1] for x in response['serviceArns']]  # returned data is ARN, we just want the name
-    response = ecs.describe_services(cluster=cluster_full_name, services=services)
+    return get_service_by_target_group(cluster_full_name, default_target_group)
 
-    for service in response['services']:
-        if len(service['loadBalancers']) > 0:  # pylint: disable=len-as-condition
-            if service['loadBalancers'][0]['targetGroupArn'] == default_target_group:
-                live_service = service
 
-    if live_service is not None:
-        return live_service['desiredCount']
-    elif next_token is not None:
-        return get_live_desired_count(cluster_name=cluster_name, cluster_full_name=cluster_full_name, app_name=app_name, next_token=next_token)
+def get_live_desired_count(cluster_name, app_name, cluster_full_name=None):
+    """For a given app, return the desired count for the live service, or None if there is no live service"""
 
+    live_service = get_live_service(cluster_name=cluster_name, app_name=app_name, cluster_full_name=cluster_full_name)
+    if live_service is None:
+        return None
+    return live_service['desiredCount']
 
-def set_correct_service_size(cluster_name, app_name, version_stack_name, target_group):
-    """Ensures that the service being cutover has at least the same number of tasks as the currently live service."""
+
+def set_correct_service_size(cluster_name, app_name, version_stack_name, target_group, carry_scaling=None):
+    """Ensures that the service being cutover has at least the same number of tasks as the currently live service.
+
+    With ECS_CUTOVER_CARRY_SCALING=true, or carry_scaling set, the service's autoscaling bounds
+    are first raised to cover the live service's capacity, see scaling.py. Returns the live
+    service, None if there is none."""
+
+    if carry_scaling is None:
+        carry_scaling = get_scaling_settings()['carry']
 
     cluster_full_name = get_cluster_full_name(cluster_name)
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName=version_stack_name,
-        LogicalResourceId='ECSService'
-    )
-    service_full_name = response['StackResources'][0]['PhysicalResourceId'].split('/')[-1]
+    service_full_name = get_physical_resource_id(version_stack_name, 'ECSService').split('/')[-1]
 
-    desired_count = get_live_desired_count(cluster_name=cluster_name, cluster_full_name=cluster_full_name, app_name=app_name)
+    live_service = get_live_service(cluster_name=cluster_name, cluster_full_name=cluster_full_name, app_name=app_name)
+    desired_count = None if live_service is None else live_service['desiredCount']
     current_count = get_current_count(cluster_name=cluster_name, cluster_full_name=cluster_full_name, service_full_name=service_full_name)
     print('Live service has {} tasks, this version has {}.'.format(desired_count, current_count))
     if desired_count is None:
         print('Number of desired running tasks is unknown, do not change.')
-        return
+        return live_service
     if current_count is None:
         print('Number of current running tasks is unknown, do not change.')
-        return
+        return live_service
+    if carry_scaling and live_service['serviceName'] != service_full_name:
+        carry_scaling_state(cluster_full_name, live_service, service_full_name)
     if current_count >= desired_count:
         print('Number of running tasks ({}) requires no change.'.format(current_count))
-        return
+        return live_service
     print('Updating this version to match.')
-    ecs = boto3.client('ecs')
-    response = ecs.update_service(
+    ecs = get_client('ecs')
+    ecs.update_service(
         cluster=cluster_full_name,
         service=service_full_name,
         desiredCount=desired_count
     )
     print('Update in progress...')
     wait_for_target_group_size(desired_count, target_group)
+    return live_service
 
 
 def wait_for_target_group_size(desired_count, target_group):
     """Waits until a target group has a given number of healthy targets"""
 
-    targets = 0
-    timeout = 600
-    backoff = 0
-    start_time = datetime.datetime.now()
-    elapsed_time = elapsed_time = datetime.datetime.now() - start_time
     print('Polling until there are {} healthy tasks.'.format(desired_count))
-    while targets < desired_count and elapsed_time < datetime.timedelta(seconds=timeout):
-        elbv2 = boto3.client('elbv2')
-        response = elbv2.describe_target_health(TargetGroupArn=target_group)
-        targets = len([x for x in response['TargetHealthDescriptions'] if x['TargetHealth']['State'] == 'healthy'])
-        elapsed_time = datetime.datetime.now() - start_time
-        print('There are {} healthy tasks.'.format(targets))
-        time.sleep(backoff)
-        backoff = backoff + 1
-    if elapsed_time > datetime.timedelta(seconds=timeout):
-        raise Exception('Could not start additional tasks before {}s timeout.'.format(timeout))
-    print('Additional containers started in {}'.format(elapsed_time))
-    assert targets >= desired_count
+    try:
+        result = wait_for_healthy_targets(target_group, desired_count=desired_count)
+    except PollTimeoutError as exception:
+        raise Exception('Could not start additional tasks before timeout.') from exception
+    print('Additional containers started in {}'.format(result['elapsed_time']))
 
 
 def change_default_rule_tg(cluster_name, app_name, version, aws_hosted_zone, base_path):
-    """Main function for cutting over the default rule of a target group"""
+    """Main function for cutting over the default rule of a target group
+
+    With ECS_CUTOVER_STEPS set, traffic is shifted progressively, see traffic_shift.py. With
+    ECS_CUTOVER_CARRY_SCALING=true, the autoscaling bounds are raised before the switch and
+    restored later by restore_scaling.py, see scaling.py. With ECS_CUTOVER_SCALE_DOWN_FLOOR set, the
+    previous version is drained and scaled down after the switch, see drain.py. The switch is
+    recorded on the listener for rollback.py. Each phase is recorded as a tracing span, see
+    tracing.py."""
+
+    settings = get_shift_settings()
+    scaling_settings = get_scaling_settings()
+    drain_settings = get_drain_settings()
 
     version_stack_name = "ECS-{cluster_name}-App-{app_name}-{version}".format(
         cluster_name=cluster_name,
@@ -168,31 +220,89 @@ def change_default_rule_tg(cluster_name, app_name, version, aws_hosted_zone, bas
         app_name=app_name
     )
 
-    print('Beginning cutover for {}'.format('https://' + aws_hosted_zone + base_path))
-    print('Changing default listener rule cutover...')
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName=alb_stack_name,
-        LogicalResourceId='ALBListenerSSL'
-    )
-    alb_listener = response['StackResources'][0]['PhysicalResourceId']
-    print('ALB ARN is: {}'.format(alb_listener))
-
-    target_group = get_version_target_group(version_stack_name)
-
-    set_correct_service_size(cluster_name=cluster_name, app_name=app_name, version_stack_name=version_stack_name, target_group=target_group)
-
-    elbv2 = boto3.client('elbv2')
-    response = elbv2.modify_listener(
-        ListenerArn=alb_listener,
-        DefaultActions=[
-            {
-                'Type': 'forward',
-                'TargetGroupArn': target_group
-            }
-        ]
+    with span('change_default_rule_tg', app=app_name, version=version, stack=version_stack_name):
+        print('Beginning cutover for {}'.format('https://' + aws_hosted_zone + base_path))
+        print('Changing default listener rule cutover...')
+        with span('resolve_resources', stack=version_stack_name):
+            alb_listener = get_physical_resource_id(alb_stack_name, 'ALBListenerSSL')
+            print('ALB ARN is: {}'.format(alb_listener))
+            target_group = get_version_target_group(version_stack_name)
+            previous_target_groups = []
+            if drain_settings['floor'] is not None:
+                previous_target_groups = [x for x in get_alb_default_target_groups(cluster_name, app_name) if x != target_group]
+
+        check_stopped()
+        with span('resize', stack=version_stack_name):
+            live_service = set_correct_service_size(cluster_name=cluster_name, app_name=app_name, version_stack_name=version_stack_name, target_group=target_group)
+
+        check_stopped()
+        if settings['steps']:
+            with span('shift_traffic', listener=alb_listener, target_group=target_group):
+                shift_default_rule_tg(cluster_name, app_name, version_stack_name, alb_listener, target_group, settings)
+        else:
+            with span('modify_listener', listener=alb_listener, target_group=target_group):
+                set_listener_weights(alb_listener, {target_group: 1})
+        print('{} has been updated.'.format('https://' + aws_hosted_zone + base_path))
+
+        if live_service is not None:
+            with span('record_cutover', listener=alb_listener):
+                record_cutover_history(alb_listener, live_service, version_stack_name, target_group)
+
+        if previous_target_groups:
+            drain_previous_versions(cluster_name, previous_target_groups, drain_settings)
+
+        if scaling_settings['carry']:
+            print('Run restore-scaling {:g}s from now or later to put back the configured capacity of {}.'.format(scaling_settings['cooldown'], version_stack_name))
+
+
+def record_cutover_history(alb_listener, live_service, version_stack_name, target_group):
+    """Records the service that was live before cutover and the one now live on the listener, see cutover_history.py
+
+    The new version was resized to at least the live desired count, which is the capacity recorded for both.
+    The live service's autoscaling bounds are recorded before a drain lowers them, so rollback can restore them."""
+
+    service_arn = get_physical_resource_id(version_stack_name, 'ECSService')
+    if live_service['serviceName'] == service_arn.split('/')[-1]:
+        return
+    cluster_full_name = live_service['clusterArn'].split('/')[-1]
+    previous = get_service_entry(live_service, get_scalable_target(get_resource_id(cluster_full_name, live_service['serviceName'])))
+    current = dict(previous, **{'target-group': target_group, 'service': service_arn, 'min-capacity': None, 'max-capacity': None})
+    record_cutover(alb_listener, previous, current)
+
+
+def drain_previous_versions(cluster_name, target_groups, settings):
+    """Drains the target groups that received traffic before cutover and scales their services down"""
+
+    cluster_full_name = get_cluster_full_name(cluster_name)
+    for target_group in target_groups:
+        with span('drain', target_group=target_group):
+            service = get_service_by_target_group(cluster_full_name, target_group)
+            if service is None:
+                print('No service found for {}, not scaling it down.'.format(target_group))
+                continue
+            drain_previous_version(cluster_full_name, service, target_group, settings)
+
+
+def shift_default_rule_tg(cluster_name, app_name, version_stack_name, alb_listener, target_group, settings):  # pylint: disable=too-many-arguments
+    """Shifts the default rule from the target group currently receiving most traffic to `target_group` in steps"""
+
+    weights = get_alb_default_weights(cluster_name, app_name)
+    weights.pop(target_group, None)
+    if not weights:
+        print('Version already receives all traffic.')
+        set_listener_weights(alb_listener, {target_group: 1})
+        return
+    old_target_group = max(weights, key=weights.get)
+    cluster_full_name = get_cluster_full_name(cluster_name)
+    service_full_name = get_physical_resource_id(version_stack_name, 'ECSService').split('/')[-1]
+    print('Shifting traffic from {} in steps of {}%, {}s apart.'.format(old_target_group, settings['steps'], settings['interval']))
+    shift_traffic(
+        alb_listener,
+        old_target_group,
+        target_group,
+        lambda: check_version(cluster_full_name, service_full_name, target_group),
+        settings
     )
-    print('{} has been updated.'.format('https://' + aws_hosted_zone + base_path))
 
 
 def main():
@@ -207,4 +317,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with run_report('cutover'), trace_run('cutover'):
+        main()
@@ -0,0 +1,63 @@
+"""Records the last cutover of an app as tags on its ALB listener, so it can be rolled back without a lookup
+
+The listener is the one resource every cutover changes, and its tags are read with a single
+call, so they hold the target group, cluster, service, desired count and autoscaling bounds
+of the version that was live before the cutover and of the one that is live after it. The
+bounds are the ones the version had while it was live, before a drain lowered them (see
+drain.py), and are empty when it is not autoscaled. Each cutover or rollback replaces the
+previous record."""
+
+import datetime
+from clients import get_client
+
+
+TAG_PREFIX = 'ecs-utils:cutover-'
+FIELDS = ['target-group', 'cluster', 'service', 'desired-count', 'min-capacity', 'max-capacity']
+COUNT_FIELDS = ['desired-count', 'min-capacity', 'max-capacity']
+
+
+class NoCutoverRecordedError(Exception):
+    """Raised when a listener carries no cutover record"""
+
+
+def get_service_entry(service, scalable_target=None):
+    """Returns the history entry describing an ECS service, the target group it is registered to and its scalable target"""
+
+    return {
+        'target-group': service['loadBalancers'][0]['targetGroupArn'],
+        'cluster': service['clusterArn'].split('/')[-1],
+        'service': service['serviceArn'],
+        'desired-count': service['desiredCount'],
+        'min-capacity': scalable_target['MinCapacity'] if scalable_target else None,
+        'max-capacity': scalable_target['MaxCapacity'] if scalable_target else None
+    }
+
+
+def record_cutover(listener, previous, current):
+    """Tags the listener with the entries of the versions live before and after a cutover"""
+
+    tags = {'{}time'.format(TAG_PREFIX): datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    for name, entry in [('previous-', previous), ('', current)]:
+        for field in FIELDS:
+            tags['{}{}{}'.format(TAG_PREFIX, name, field)] = '' if entry.get(field) is None else str(entry[field])
+    elbv2 = get_client('elbv2')
+    elbv2.add_tags(ResourceArns=[listener], Tags=[{'Key': key, 'Value': value} for key, value in tags.items()])
+    print('Recorded cutover from {} to {}.'.format(previous['service'].split('/')[-1], current['service'].split('/')[-1]))
+
+
+def get_last_cutover(listener):
+    """Returns the last cutover recorded on the listener as {'previous': entry, 'current': entry, 'time': ...}
+
+    Fields missing from records written by older versions, or left empty, are None."""
+
+    elbv2 = get_client('elbv2')
+    response = elbv2.describe_tags(ResourceArns=[listener])
+    tags = {x['Key']: x['Value'] for x in response['TagDescriptions'][0]['Tags']} if response['TagDescriptions'] else {}
+    if '{}time'.format(TAG_PREFIX) not in tags:
+        raise NoCutoverRecordedError("No cutover recorded on listener {}".format(listener))
+    record = {'time': tags['{}time'.format(TAG_PREFIX)]}
+    for name, key in [('previous-', 'previous'), ('', 'current')]:
+        record[key] = {field: tags.get('{}{}{}'.format(TAG_PREFIX, name, field)) or None for field in FIELDS}
+        for field in COUNT_FIELDS:
+            record[key][field] = None if record[key][field] is None else int(record[key][field])
+    return record
@@ -3,30 +3,65 @@
 
 import os
 import re
+import time
 import datetime
+import hashlib
 import json
-import yaml
-import boto3
+import threading
 import botocore
+from clients import get_client
+from concurrency import check_stopped
+from concurrency import run_graph
+from health import PollTimeoutError
+from health import wait_for_healthy_targets
+from metrics import run_report
+from metrics import timed
+from render import render_json_file
+from render import render_yaml_file
+from stack_events import tail_stack_events
+from stack_resources import get_physical_resource_id
+from stack_resources import invalidate_stack_resources
+from task_watchdog import watch_service_tasks
+from tracing import span
+from tracing import trace_run
+
+
+TASK_DEFINITION_HASH_TAG = 'ecs-utils:definition-hash'
+_VALIDATION_CACHE_LOCK = threading.Lock()
+
+
+def get_priority(rules, excluded=()):
+    """Returns the next available priority when given the response from aws elbv2 describe-rules
+
+    Priorities in `excluded` are treated as taken, e.g. ones that already lost a race with another deploy."""
+
+    taken = {int(rule['Priority']) for rule in rules if rule['Priority'] != 'default'}
+    taken.update(int(x) for x in excluded)
+    i = 1
+    while i in taken:  # increment from 1 onwards until we find a priority that is unused
+        i = i + 1
+    return i
 
 
-def get_priority(rules):
-    """Returns the next available priority when given the response from aws elbv2 describe-rules"""
+def allocate_rule_priority(app_stack_name, excluded=()):
+    """Returns the lowest priority that is free on the app's listener right now
 
-    priorities = [rule['Priority'] for rule in rules]
-    i = 1
-    rule_priority = None
-    while not rule_priority:  # increment from 1 onwards until we find a priority that is unused
-        if not str(i) in priorities:
-            return i
-        else:
-            i = i + 1
+    The priority is only reserved optimistically: another deploy may claim it before our
+    stack creates its rule, see deploy_version_stack for how that race is handled."""
+
+    return get_priority(get_list_of_rules(app_stack_name), excluded=excluded)
 
 
-def create_or_update_stack(stack_name, template, parameters, tags):
-    """Update or create stack synchronously, returns the stack ID"""
+def create_or_update_stack(stack_name, template, parameters, tags, cluster_name=None):
+    """Update or create stack synchronously, returns the describe_stacks response for the stack
 
-    cloudformation = boto3.client('cloudformation')
+    When cluster_name is given, the stack's ECS service is watched while the stack is
+    deployed and the operation is aborted if too many of its tasks fail.
+
+    With ECS_DEPLOY_CHANGE_SET=true the stack is deployed through a change set, which is
+    printed before it is executed and skipped entirely when it contains no changes."""
+
+    cloudformation = get_client('cloudformation')
 
     template_data = _parse_template(template)
 
@@ -38,34 +73,158 @@ def create_or_update_stack(stack_name, template, parameters, tags):
     }
 
     try:
-        if _stack_exists(stack_name):
+        creating = not _stack_exists(stack_name)
+        if os.environ.get('ECS_DEPLOY_CHANGE_SET', 'false') == 'true':
+            stack_id = _deploy_change_set(params, creating)
+            if stack_id is None:
+                return cloudformation.describe_stacks(StackName=stack_name)
+        elif not creating:
             print('Updating {}'.format(stack_name))
-            stack_result = cloudformation.update_stack(**params)
-            waiter = cloudformation.get_waiter('stack_update_complete')
+            stack_id = cloudformation.update_stack(**params)['StackId']
         else:
             print('Creating {}'.format(stack_name))
-            stack_result = cloudformation.create_stack(**params)
-            waiter = cloudformation.get_waiter('stack_create_complete')
-        print("...waiting for stack to be ready...")
-        waiter.wait(StackName=stack_name)
+            stack_id = cloudformation.create_stack(**params)['StackId']
+        _wait_for_stack(stack_name, stack_id, creating, cluster_name)
     except botocore.exceptions.ClientError as ex:
         error_message = ex.response['Error']['Message']
         if error_message == 'No updates are to be performed.':
             print("No changes")
-        else:
+            return cloudformation.describe_stacks(StackName=stack_name)
+        raise
+    finally:
+        invalidate_stack_resources(stack_name)  # resources may have been added, replaced or removed
+    return cloudformation.describe_stacks(StackName=stack_id)
+
+
+def _wait_for_stack(stack_name, stack_id, creating, cluster_name):
+    """Waits for a stack create or update to finish while tailing its events and watching its tasks"""
+
+    cloudformation = get_client('cloudformation')
+    waiter_name = 'stack_create_complete' if creating else 'stack_update_complete'
+    waiter = cloudformation.get_waiter(waiter_name)
+    print("...waiting for stack to be ready...")
+    with tail_stack_events(stack_id), watch_service_tasks(stack_name, cluster_name, creating) as watchdog:
+        try:
+            with timed('waiter.{}'.format(waiter_name)):
+                waiter.wait(StackName=stack_name)
+        except botocore.exceptions.WaiterError as exception:
+            if watchdog is not None and watchdog.tripped:
+                raise Exception("Deployment of {} aborted, too many tasks failed.".format(stack_name)) from exception
             raise
-    else:
-        return cloudformation.describe_stacks(StackName=stack_result['StackId'])
+
+
+def _deploy_change_set(params, creating):
+    """Creates a change set, prints it and executes it
+
+    Returns the stack ID, or None when the change set is empty and was discarded."""
+
+    cloudformation = get_client('cloudformation')
+    change_set_name = "ecs-utils-{}".format(datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+    print('Creating change set {} for {}'.format(change_set_name, params['StackName']))
+    response = cloudformation.create_change_set(
+        ChangeSetName=change_set_name,
+        ChangeSetType='CREATE' if creating else 'UPDATE',
+        **params
+    )
+    change_set_id = response['Id']
+    stack_id = response['StackId']
+
+    waiter = cloudformation.get_waiter('change_set_create_complete')
+    try:
+        with timed('waiter.change_set_create_complete'):
+            waiter.wait(ChangeSetName=change_set_id, WaiterConfig={'Delay': 5})
+    except botocore.exceptions.WaiterError as exception:
+        response = cloudformation.describe_change_set(ChangeSetName=change_set_id)
+        reason = response.get('StatusReason', '')
+        if "didn't contain changes" in reason or 'No updates are to be performed' in reason:
+            print("No changes")
+            cloudformation.delete_change_set(ChangeSetName=change_set_id)
+            return None
+        raise Exception("Change set {} failed: {}".format(change_set_name, reason)) from exception
+
+    changes = get_change_set_changes(change_set_id)
+    print_change_set_changes(changes)
+    print('Executing change set {}'.format(change_set_name))
+    cloudformation.execute_change_set(ChangeSetName=change_set_id)
+    return stack_id
+
+
+def get_change_set_changes(change_set_id):
+    """Returns the resource changes of a change set across every page of describe_change_set"""
+
+    cloudformation = get_client('cloudformation')
+    changes = []
+    kwargs = {'ChangeSetName': change_set_id}
+    while True:
+        response = cloudformation.describe_change_set(**kwargs)
+        changes.extend(x['ResourceChange'] for x in response['Changes'] if x['Type'] == 'Resource')
+        if 'NextToken' not in response:
+            return changes
+        kwargs['NextToken'] = response['NextToken']
+
+
+def print_change_set_changes(changes):
+    """Prints the resource changes of a change set, calling out the resources that will be replaced"""
+
+    print("Change set contains {} resource change(s):".format(len(changes)))
+    for change in changes:
+        print("{:10}{:30}{}".format(change['Action'], change['LogicalResourceId'], change['ResourceType']))
+    replaced = [x['LogicalResourceId'] for x in changes if x.get('Replacement') in ('True', 'Conditional')]
+    if replaced:
+        print("WARNING: the following resources will (or may) be replaced: {}".format(", ".join(replaced)))
 
 
 def _parse_template(template):
-    cloudformation = boto3.client('cloudformation')
+    template_hash = hashlib.sha256(template.encode('utf-8')).hexdigest()
+    if _is_template_validated(template_hash):
+        print("Template {} already validated, skipping validation.".format(template_hash[:12]))
+        return template
+    cloudformation = get_client('cloudformation')
     cloudformation.validate_template(TemplateBody=template)
+    _record_template_validated(template_hash)
     return template
 
 
+def _get_validation_cache_path():
+    return os.environ.get('ECS_TEMPLATE_VALIDATION_CACHE', '.ecs-utils/template-validation.json')
+
+
+def _load_validation_cache():
+    try:
+        with open(_get_validation_cache_path(), 'r') as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _is_template_validated(template_hash):
+    """Returns True if a template with this content hash was validated and the entry has not expired"""
+
+    validated_at = _load_validation_cache().get(template_hash)
+    if validated_at is None:
+        return False
+    ttl = os.environ.get('ECS_TEMPLATE_VALIDATION_TTL')
+    return ttl is None or time.time() - validated_at < int(ttl)
+
+
+def _record_template_validated(template_hash):
+    """Stores the validation time of a template in the on-disk cache, failing silently if it is not writable"""
+
+    cache_path = _get_validation_cache_path()
+    with _VALIDATION_CACHE_LOCK:
+        cache = _load_validation_cache()
+        cache[template_hash] = time.time()
+        try:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            with open(cache_path + '.tmp', 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(cache_path + '.tmp', cache_path)
+        except (IOError, OSError) as exception:
+            print("Could not write template validation cache: {}".format(exception))
+
+
 def _stack_exists(stack_name):
-    cloudformation = boto3.client('cloudformation')
+    cloudformation = get_client('cloudformation')
     try:
         response = cloudformation.describe_stacks(
             StackName=stack_name
@@ -82,10 +241,13 @@ def _stack_exists(stack_name):
     return False
 
 
-def generate_environment_object():
+def generate_environment_object(variables=None):
     """Given a .env file, returns an environment object as per https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-ecs-taskdefinition-containerdefinitions.html#cloudformationn-ecs-taskdefinition-containerdefinition-environment
 
-    Values are pulled from the running environment."""
+    Values are pulled from `variables`, the running environment by default."""
+
+    if variables is None:
+        variables = os.environ
 
     whitelisted_vars = [
         "AWS_SECRET_ACCESS_KEY",
@@ -97,15 +259,15 @@ def generate_environment_object():
     ]
     environment = []
 
-    env_file = open(os.environ.get('DOTENV', '.env'), 'r').read()
+    env_file = open(variables.get('DOTENV', '.env'), 'r').read()
 
     for env in env_file.split('\n'):
         env = env.split('=')[0]
-        if env not in whitelisted_vars and env != '' and not re.match(r'^\s?#', env) and os.environ.get(env, None) is not None:
+        if env not in whitelisted_vars and env != '' and not re.match(r'^\s?#', env) and variables.get(env, None) is not None:
             environment.append(
                 {
                     "name": env,
-                    "value": os.environ[env]
+                    "value": variables[env]
                 }
             )
     return environment
@@ -114,22 +276,20 @@ def generate_environment_object():
 def get_list_of_rules(app_stack_name):
     """Given a CloudFormation stack name, returns a list of routing rules present on the stack's ALB"""
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName=app_stack_name,
-        LogicalResourceId='ALBListenerSSL'
-    )
-    alb_listener = response['StackResources'][0]['PhysicalResourceId']
+    alb_listener = get_physical_resource_id(app_stack_name, 'ALBListenerSSL')
 
-    client = boto3.client('elbv2')
-    response = client.describe_rules(ListenerArn=alb_listener)
-    return response['Rules']
+    client = get_client('elbv2')
+    paginator = client.get_paginator('describe_rules')
+    rules = []
+    for page in paginator.paginate(ListenerArn=alb_listener):
+        rules.extend(page['Rules'])
+    return rules
 
 
-def _update_container_defs_with_env(task_definition):
-    """merge each container definition with environment variables"""
+def _update_container_defs_with_env(task_definition, variables=None):
+    """merge each container definition with environment variables, taken from `variables` (the environment by default)"""
 
-    environment = generate_environment_object()
+    environment = generate_environment_object(variables)
     if not environment:
         return task_definition
     for container_definition in task_definition['containerDefinitions']:
@@ -149,58 +309,99 @@ def _update_container_defs_with_env(task_definition):
     return task_definition
 
 
+def get_task_definition_hash(task_definition):
+    """Returns a hash of the task definition that does not depend on key order or tags"""
+
+    definition = {key: value for key, value in task_definition.items() if key != 'tags'}
+    canonical = json.dumps(definition, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _get_latest_task_definition_arn(family, definition_hash):
+    """Returns the ARN of the latest active revision of a family if it carries the given hash, None otherwise"""
+
+    ecs = get_client('ecs')
+    try:
+        response = ecs.describe_task_definition(taskDefinition=family, include=['TAGS'])
+    except botocore.exceptions.ClientError:
+        return None  # family does not exist yet
+    tags = {x['key']: x['value'] for x in response.get('tags', [])}
+    if tags.get(TASK_DEFINITION_HASH_TAG) != definition_hash:
+        return None
+    return response['taskDefinition']['taskDefinitionArn']
+
+
 def upload_task_definition(task_definition):
     """Interpolates some values and then uploads the task definition to ECS
 
+    If the latest active revision of the family was registered from an identical
+    definition, that revision is reused instead of registering a new one.
+
     Returns the task definition version ARN"""
 
     print("Task definition to be uploaded:")
     print(json.dumps(task_definition, indent=2, default=str))
 
+    definition_hash = get_task_definition_hash(task_definition)
+    latest_arn = _get_latest_task_definition_arn(task_definition['family'], definition_hash)
+    if latest_arn is not None:
+        print("Task Definition is identical to the latest revision, reusing it.")
+        print("Task Definition ARN: {}".format(latest_arn))
+        return latest_arn
+
     print("Uploading Task Definition...")
-    ecs = boto3.client('ecs')
-    response = ecs.register_task_definition(**task_definition)
+    ecs = get_client('ecs')
+    tags = [x for x in task_definition.get('tags', []) if x['key'] != TASK_DEFINITION_HASH_TAG]
+    tags.append({'key': TASK_DEFINITION_HASH_TAG, 'value': definition_hash})
+    response = ecs.register_task_definition(**dict(task_definition, tags=tags))
     task_definition_arn = response['taskDefinition']['taskDefinitionArn']
     print("Task Definition ARN: {}".format(task_definition_arn))
     return task_definition_arn
 
 
-def get_parameters(config, version_stack_name, app_stack_name, task_definition, app_name, cluster_name, env, version, aws_hosted_zone, base_path, task_definition_arn):  # pylint: disable=too-many-arguments,too-many-locals
-    """Generates and returns necessary parameters for CloudFormation stack"""
-
-    print("Generating Parmeters for CloudFormation template")
-    container_port = [x['portMappings'][0]['containerPort'] for x in task_definition['containerDefinitions'] if x['name'] == app_name][0]
+def listener_rule_exists(version_stack_name):
+    """Returns True if the version stack already has its ALB listener rule"""
 
-    cloudformation = boto3.client('cloudformation')
-    print("Determining ALB Rule priority...")
-    priority = None
-    listener_rule = None
     try:
-        response = cloudformation.describe_stack_resources(
-            StackName=version_stack_name,
-            LogicalResourceId='ListenerRule'
-        )
-        listener_rule = response['StackResources'][0]['PhysicalResourceId']
+        get_physical_resource_id(version_stack_name, 'ListenerRule')
         print("Listener Rule already exists, not setting priority.")
+        return True
     except (KeyError, IndexError, botocore.exceptions.ClientError):
         print("Listener Rule does not already exist, getting priority...")
-    if listener_rule is None:
-        rules = get_list_of_rules(app_stack_name)
-        priority = get_priority(rules)
+        return False
+
+
+def get_rule_priority(app_stack_name, rule_exists):
+    """Returns the priority for a new listener rule, or None when the rule already exists"""
+
+    priority = None
+    if not rule_exists:
+        priority = allocate_rule_priority(app_stack_name)
     print("Rule priority is {}.".format(priority))
+    return priority
 
-    print("Determining if ALB is internal or internet-facing...")
-    elbv2 = boto3.client('elbv2')
-    response = cloudformation.describe_stack_resources(
-        StackName=app_stack_name,
-        LogicalResourceId='ALB'
-    )
-    alb = response['StackResources'][0]['PhysicalResourceId']
+
+def get_alb_scheme(app_stack_name):
+    """Returns whether the app's ALB is internal or internet-facing"""
+
+    elbv2 = get_client('elbv2')
+    alb = get_physical_resource_id(app_stack_name, 'ALB')
     response = elbv2.describe_load_balancers(
         LoadBalancerArns=[alb],
     )
     alb_scheme = response['LoadBalancers'][0]['Scheme']
     print("ALB is {}.".format(alb_scheme))
+    return alb_scheme
+
+
+def get_parameters(config, version_stack_name, task_definition, app_name, cluster_name, env, version, aws_hosted_zone, base_path, task_definition_arn, priority, alb_scheme):  # pylint: disable=too-many-arguments,too-many-locals
+    """Generates and returns necessary parameters for CloudFormation stack
+
+    `priority` is the listener rule priority for a new stack (None keeps the current one) and
+    `alb_scheme` the scheme of the app's ALB, see get_rule_priority and get_alb_scheme."""
+
+    print("Generating Parmeters for CloudFormation template")
+    container_port = [x['portMappings'][0]['containerPort'] for x in task_definition['containerDefinitions'] if x['name'] == app_name][0]
 
     try:
         autoscaling = str(config['autoscaling'])
@@ -247,6 +448,10 @@ def get_parameters(config, version_stack_name, app_stack_name, task_definition,
             "ParameterKey": 'HealthCheckInterval',
             "ParameterValue": str(config['lb_health_check_interval'])
         },
+        {
+            "ParameterKey": 'DeregistrationDelay',
+            "ParameterValue": str(config['lb_deregistration_delay']) if 'lb_deregistration_delay' in config else None
+        },
         {
             "ParameterKey": 'ContainerPort',
             "ParameterValue": str(container_port)
@@ -324,31 +529,15 @@ def check_deployment(version_stack_name, app_name):
     """Poll deployment until it is succesful, raise exception if not"""
 
     print("Polling Target Group ({}) until a successful state is reached...".format(version_stack_name))
-    elbv2 = boto3.client('elbv2')
-    waiter = elbv2.get_waiter('target_in_service')
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stack_resources(
-        StackName=version_stack_name,
-        LogicalResourceId='ALBTargetGroup'
-    )
-    target_group = response['StackResources'][0]['PhysicalResourceId']
-    start_time = datetime.datetime.now()
+    target_group = get_physical_resource_id(version_stack_name, 'ALBTargetGroup')
     try:
-        waiter.wait(TargetGroupArn=target_group)
-    except botocore.exceptions.WaiterError:
+        result = wait_for_healthy_targets(target_group)
+    except PollTimeoutError:
         print('Health check did not pass!')
-        response = cloudformation.describe_stack_resources(
-            StackName=version_stack_name,
-            LogicalResourceId='ECSService'
-        )
-        service = response['StackResources'][0]['PhysicalResourceId']
+        service = get_physical_resource_id(version_stack_name, 'ECSService')
         print('Outputting events for service {}:'.format(service))
-        response = cloudformation.describe_stack_resources(
-            StackName="ECS-{}".format(app_name),
-            LogicalResourceId='ECSCluster'
-        )
-        cluster = response['StackResources'][0]['PhysicalResourceId']
-        ecs = boto3.client('ecs')
+        cluster = get_physical_resource_id("ECS-{}".format(app_name), 'ECSCluster')
+        ecs = get_client('ecs')
         response = ecs.describe_services(
             cluster=cluster,
             services=[service]
@@ -364,15 +553,69 @@ def check_deployment(version_stack_name, app_name):
 #                StackName="MV-{realm}-{app_name}-{version}-{env}".format(env=os.environ['ENV'], app_name=os.environ['ECS_APP_NAME'], version=os.environ['BUILD_VERSION'], realm=os.environ['REALM'])
 #            )
 #            print('CloudFormation stack deleted.')
-        elapsed_time = datetime.datetime.now() - start_time
-        print('Health check passed in {}'.format(elapsed_time))
-        print("Done.")
+        raise
+    print('Health check passed in {}'.format(result['elapsed_time']))
+    print("Done.")
 
 
-def deploy_ecs_service(app_name, env, cluster_name, version, aws_hosted_zone, base_path, config, task_definition, template):  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
-    """Core function for deploying an ECS Service"""
+def _is_priority_conflict(stack_name):
+    """Returns True if the stack's listener rule failed because its priority was taken"""
 
-    print("Beginning deployment of {}...".format(app_name))
+    cloudformation = get_client('cloudformation')
+    response = cloudformation.describe_stack_events(StackName=stack_name)
+    for stack_event in response['StackEvents']:
+        if stack_event['LogicalResourceId'] != 'ListenerRule' or not stack_event['ResourceStatus'].endswith('_FAILED'):
+            continue
+        reason = stack_event.get('ResourceStatusReason', '')
+        if 'PriorityInUse' in reason or 'is currently in use' in reason:
+            return True
+    return False
+
+
+def deploy_version_stack(version_stack_name, app_stack_name, template, parameters, tags, cluster_name):  # pylint: disable=too-many-arguments
+    """Deploys the version stack, retrying with the next free rule priority if another deploy took ours
+
+    Returns the describe_stacks response for the stack."""
+
+    retries = int(os.environ.get('ECS_RULE_PRIORITY_RETRIES', '3'))
+    attempted = set()
+    while True:
+        try:
+            return create_or_update_stack(version_stack_name, template, parameters, tags, cluster_name=cluster_name)
+        except botocore.exceptions.WaiterError:
+            priority = [x.get('ParameterValue') for x in parameters if x['ParameterKey'] == 'RulePriority'][0]
+            if priority is None or len(attempted) >= retries or not _is_priority_conflict(version_stack_name):
+                raise
+            attempted.add(priority)
+            print("Rule priority {} was claimed by another deploy, deleting the failed stack and retrying...".format(priority))
+            cloudformation = get_client('cloudformation')
+            cloudformation.delete_stack(StackName=version_stack_name)
+            with timed('waiter.stack_delete_complete'):
+                cloudformation.get_waiter('stack_delete_complete').wait(StackName=version_stack_name)
+            priority = allocate_rule_priority(app_stack_name, excluded=attempted)
+            print("Rule priority is {}.".format(priority))
+            parameters = [x for x in parameters if x['ParameterKey'] != 'RulePriority']
+            parameters.append({
+                "ParameterKey": 'RulePriority',
+                "ParameterValue": str(priority)
+            })
+
+
+def _prepare_task_definition(task_definition, variables=None):
+    """Merges the environment into the task definition and registers it, returns its ARN"""
+
+    with span('merge_environment'):
+        task_definition = _update_container_defs_with_env(task_definition, variables)
+    with span('register_task_definition', family=task_definition['family']):
+        return upload_task_definition(task_definition)
+
+
+def deploy_ecs_service(app_name, env, cluster_name, version, aws_hosted_zone, base_path, config, task_definition, template, variables=None):  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+    """Core function for deploying an ECS Service
+
+    The containers' environment is taken from `variables`, the running environment by default,
+    so batch and fan-out deploys can give each service its own values. Each phase is recorded
+    as a tracing span, see tracing.py."""
 
     version_stack_name = "ECS-{cluster_name}-App-{app_name}-{version}".format(
         cluster_name=cluster_name,
@@ -381,45 +624,67 @@ def deploy_ecs_service(app_name, env, cluster_name, version, aws_hosted_zone, ba
     )
     app_stack_name = "ECS-{cluster}-App-{app}".format(cluster=cluster_name, app=app_name)
 
-    task_definition = _update_container_defs_with_env(task_definition)
-    task_definition_arn = upload_task_definition(task_definition)
+    with span('deploy_ecs_service', app=app_name, version=version, stack=version_stack_name):
+        print("Beginning deployment of {}...".format(app_name))
+
+        # None of these lookups depend on each other's AWS calls, so run them side by side
+        with span('resolve_parameters', stack=version_stack_name):
+            results = run_graph([
+                ('task_definition', lambda _: _prepare_task_definition(task_definition, variables), []),
+                ('listener_rule', lambda _: listener_rule_exists(version_stack_name), []),
+                ('rule_priority', lambda inputs: get_rule_priority(app_stack_name, inputs['listener_rule']), ['listener_rule']),
+                ('alb_scheme', lambda _: get_alb_scheme(app_stack_name), [])
+            ])
+
+            parameters = get_parameters(
+                config=config,
+                version_stack_name=version_stack_name,
+                task_definition=task_definition,
+                app_name=app_name,
+                cluster_name=cluster_name,
+                env=env,
+                version=version,
+                aws_hosted_zone=aws_hosted_zone,
+                base_path=base_path,
+                task_definition_arn=results['task_definition'],
+                priority=results['rule_priority'],
+                alb_scheme=results['alb_scheme']
+            )
 
-    parameters = get_parameters(
-        config=config,
-        version_stack_name=version_stack_name,
-        app_stack_name=app_stack_name,
-        task_definition=task_definition,
-        app_name=app_name,
-        cluster_name=cluster_name,
-        env=env,
-        version=version,
-        aws_hosted_zone=aws_hosted_zone,
-        base_path=base_path,
-        task_definition_arn=task_definition_arn
-    )
+        check_stopped()
+        print("Deploying CloudFormation stack: {}".format(version_stack_name))
+        start_time = datetime.datetime.now()
+        with span('stack_deploy', stack=version_stack_name, version=version):
+            response = deploy_version_stack(version_stack_name, app_stack_name, template, parameters, config['stack_tags'], cluster_name)
+        elapsed_time = datetime.datetime.now() - start_time
+        print("CloudFormation stack deploy completed in {}.".format(elapsed_time))
 
-    print("Deploying CloudFormation stack: {}".format(version_stack_name))
-    start_time = datetime.datetime.now()
-    response = create_or_update_stack(version_stack_name, template, parameters, config['stack_tags'])
-    elapsed_time = datetime.datetime.now() - start_time
-    print("CloudFormation stack deploy completed in {}.".format(elapsed_time))
+        outputs = response['Stacks'][0]['Outputs']
+        print("CloudFormation stack outputs:")
+        for output in outputs:
+            print("{:30}{}".format(output['OutputKey'] + ':', output.get('OutputValue', None)))
 
-    cloudformation = boto3.client('cloudformation')
-    response = cloudformation.describe_stacks(
-        StackName=version_stack_name
-    )
-    outputs = response['Stacks'][0]['Outputs']
-    print("CloudFormation stack outputs:")
-    for output in outputs:
-        print("{:30}{}".format(output['OutputKey'] + ':', output.get('OutputValue', None)))
+        with span('health_check', stack=version_stack_name):
+            check_deployment(version_stack_name, app_name)
+
+
+def load_deployment_files(variables=None):
+    """Returns the config, task definition and CloudFormation template for the current deployment
 
-    check_deployment(version_stack_name, app_name)
+    ${VAR} placeholders in the config and task definition are substituted from `variables`,
+    the environment by default."""
+
+    template_path = os.environ.get('ECS_APP_VERSION_TEMPLATE_PATH', '/scripts/ecs-cluster-application-version.yml')
+
+    config = render_yaml_file(os.environ.get('ECS_CONFIG', 'deployment/ecs-config.yml'), variables)
+    task_definition = render_json_file(os.environ.get('ECS_TASK_DEFINITION', 'deployment/ecs.json'), variables)
+    template = open(template_path, 'r').read()
+    return config, task_definition, template
 
 
 def main():
     """Entrypoint for CLI"""
 
-    template_path = os.environ.get('ECS_APP_VERSION_TEMPLATE_PATH', '/scripts/ecs-cluster-application-version.yml')
     app_name = os.environ['ECS_APP_NAME']
     env = os.environ['ENV']
     cluster_name = os.environ['ECS_CLUSTER_NAME']
@@ -427,12 +692,11 @@ def main():
     aws_hosted_zone = os.environ['AWS_HOSTED_ZONE']
     base_path = os.environ['BASE_PATH']
 
-    config = yaml.safe_load(open('deployment/ecs-config-env.yml', 'r').read())
-    task_definition = json.loads(open('deployment/ecs-env.json', 'r').read())
-    template = open(template_path, 'r').read()
+    config, task_definition, template = load_deployment_files()
 
     deploy_ecs_service(app_name=app_name, env=env, cluster_name=cluster_name, version=version, aws_hosted_zone=aws_hosted_zone, base_path=base_path, config=config, task_definition=task_definition, template=template)
 
 
 if __name__ == "__main__":
-    main()
+    with run_report('deploy'), trace_run('deploy'):
+        main()
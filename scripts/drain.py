@@ -0,0 +1,63 @@
+"""Drains and scales down the previous live version once cutover has moved its traffic away
+
+Enabled by setting ECS_CUTOVER_SCALE_DOWN_FLOOR to the number of tasks the previous version
+keeps, e.g. 0, or 1 so a rollback does not start from a cold service. After cutover the
+service is scaled down right away, and its autoscaling minimum lowered to the floor so it is
+not scaled back up. ECS deregisters the targets of the tasks it stops, the load balancer
+lets their in-flight requests finish for up to the target group's deregistration delay,
+and the tasks are only stopped then. Cutover waits until none of the targets is draining."""
+
+import os
+from clients import get_client
+from health import wait_for_drained_targets
+from scaling import get_resource_id
+from scaling import get_scalable_target
+from scaling import set_capacity_bounds
+
+
+def get_drain_settings():
+    """Returns the number of tasks the previous version is scaled down to, None to leave it running"""
+
+    floor = os.environ.get('ECS_CUTOVER_SCALE_DOWN_FLOOR', '')
+    if floor and int(floor) < 0:
+        raise ValueError("ECS_CUTOVER_SCALE_DOWN_FLOOR must be 0 or more")
+    return {
+        'floor': int(floor) if floor else None,
+        'timeout': float(os.environ.get('ECS_CUTOVER_DRAIN_TIMEOUT', '600'))
+    }
+
+
+def get_deregistration_delay(target_group):
+    """Returns the deregistration delay of a target group in seconds"""
+
+    elbv2 = get_client('elbv2')
+    response = elbv2.describe_target_group_attributes(TargetGroupArn=target_group)
+    attributes = {x['Key']: x['Value'] for x in response['Attributes']}
+    return int(attributes.get('deregistration_delay.timeout_seconds', '300'))
+
+
+def scale_down_service(cluster_full_name, service, floor):
+    """Lowers a service's desired count, and its autoscaling minimum if it has one, to `floor`"""
+
+    resource_id = get_resource_id(cluster_full_name, service['serviceName'])
+    target = get_scalable_target(resource_id)
+    if target is not None and target['MinCapacity'] > floor:
+        set_capacity_bounds(resource_id, floor, max(target['MaxCapacity'], floor))
+    if service['desiredCount'] <= floor:
+        print('{} already runs {} tasks or fewer.'.format(service['serviceName'], floor))
+        return
+    print('Scaling {} down from {} to {} tasks.'.format(service['serviceName'], service['desiredCount'], floor))
+    ecs = get_client('ecs')
+    ecs.update_service(cluster=cluster_full_name, service=service['serviceName'], desiredCount=floor)
+
+
+def drain_previous_version(cluster_full_name, service, target_group, settings):
+    """Scales the previous version's service down to the floor, then waits for its stopped targets to drain
+
+    The wait is bounded by the target group's deregistration delay plus the drain timeout."""
+
+    scale_down_service(cluster_full_name, service, settings['floor'])
+    timeout = get_deregistration_delay(target_group) + settings['timeout']
+    print('Waiting up to {}s for the targets of {} to drain...'.format(timeout, target_group))
+    result = wait_for_drained_targets(target_group, max_targets=settings['floor'], timeout=timeout)
+    print('Target group drained after {} ({} polls).'.format(result['elapsed_time'], result['polls']))
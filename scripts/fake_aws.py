@@ -0,0 +1,610 @@
+"""In-process stand-in for the CloudFormation, ELBv2, ECS and Application Auto Scaling calls made by these scripts
+
+Used by benchmark.py (and the tests) to run the deploy, cutover and cleanup code paths
+without an AWS account. Every call is counted per service and operation and can be given
+a simulated latency and throttling rate. Install it with clients.set_client_factory:
+
+    fake = FakeAWS(latency=0.02)
+    fake.build_fleet('bench', 'app', versions=100, services=300, rules=200)
+    set_client_factory(fake.client)
+
+Clients get the same metrics, rate limiting and tracing hooks as boto3 clients, and a
+throttled attempt is a ThrottlingException retried by the client the way botocore does.
+Stack operations complete as soon as they are requested, so waiters return on their first poll."""
+
+import time
+import types
+import random
+import datetime
+import threading
+import collections
+import copy
+import botocore
+import botocore.hooks
+
+
+ACCOUNT_ID = '123456789012'
+VERSION_DESCRIPTION = 'ECS Cluster Application Version'
+
+PAGINATED_RESULT_KEYS = {  # result key and default page size
+    ('cloudformation', 'describe_stacks'): ('Stacks', 100),
+    ('cloudformation', 'describe_stack_events'): ('StackEvents', 100),
+    ('cloudformation', 'list_stack_resources'): ('StackResourceSummaries', 100),
+    ('elbv2', 'describe_rules'): ('Rules', 400),
+    ('ecs', 'list_services'): ('serviceArns', 10),
+}
+WAITER_STATUSES = {
+    'stack_create_complete': 'CREATE_COMPLETE',
+    'stack_update_complete': 'UPDATE_COMPLETE',
+    'stack_delete_complete': 'DELETE_COMPLETE',
+}
+
+
+def client_error(operation, code, message):
+    """Returns a botocore ClientError shaped like the ones AWS returns"""
+
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakePaginator:  # pylint: disable=too-few-public-methods
+    """Pages through a fake operation the way a botocore paginator does, one counted call per page"""
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+        self.result_key, self.page_size = PAGINATED_RESULT_KEYS[(client.service, operation)]
+
+    def paginate(self, PaginationConfig=None, **kwargs):  # pylint: disable=invalid-name
+        """Yields pages of at most PageSize items"""
+
+        page_size = (PaginationConfig or {}).get('PageSize', self.page_size)
+        start = 0
+        while True:
+            response = self.client.call(self.operation, **kwargs)
+            items = response[self.result_key]
+            page = dict(response, **{self.result_key: items[start:start + page_size]})
+            yield page
+            start += page_size
+            if start >= len(items):
+                return
+
+
+class FakeWaiter:  # pylint: disable=too-few-public-methods
+    """Polls describe_stacks once, stacks never stay in progress in the fake"""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def wait(self, StackName, WaiterConfig=None):  # pylint: disable=invalid-name,unused-argument
+        """Returns if the stack reached the waiter's status, raises WaiterError otherwise"""
+
+        expected = WAITER_STATUSES[self.name]
+        try:
+            status = self.client.call('describe_stacks', StackName=StackName)['Stacks'][0]['StackStatus']
+        except botocore.exceptions.ClientError:
+            if expected == 'DELETE_COMPLETE':
+                return
+            raise
+        if status != expected:
+            raise botocore.exceptions.WaiterError(name=self.name, reason='Waiter encountered a terminal failure state', last_response={'Stacks': [{'StackStatus': status}]})
+
+
+class FakeClient:
+    """Client for one service, dispatching each call to the matching FakeAWS method
+
+    Calls go through the botocore events a real client emits (before-call, before-send,
+    needs-retry and after-call), so the metrics, rate limiting and tracing hooks of the
+    client registry apply. Throttled attempts are retried with botocore's backoff, up to the
+    config's max_attempts retries, then raised as a ThrottlingException ClientError."""
+
+    def __init__(self, aws, service, config=None):
+        self.aws = aws
+        self.service = service
+        self.max_attempts = (getattr(config, 'retries', None) or {}).get('max_attempts', 4)
+        self.meta = types.SimpleNamespace(events=botocore.hooks.HierarchicalEmitter(), region_name=aws.region)
+
+    def call(self, operation, **kwargs):
+        """Counts the call, applies the simulated latency and throttling and runs it"""
+
+        handler = getattr(self.aws, '{}_{}'.format(self.service.replace('-', '_'), operation), None)
+        if handler is None:
+            raise NotImplementedError("{}.{} is not supported by the fake".format(self.service, operation))
+        self.aws.record_call(self.service, operation)
+        model = types.SimpleNamespace(name=''.join(x.capitalize() for x in operation.split('_')), service_model=types.SimpleNamespace(service_name=self.service))
+        event = '{}.{}'.format(self.service, model.name)
+        context = {}
+        self.meta.events.emit('before-call.{}'.format(event), model=model, params=kwargs, request_signer=None, context=context)
+        attempts = 0
+        while True:
+            attempts += 1
+            self.meta.events.emit('before-send.{}'.format(event), request=None)
+            if not self.aws.attempt(self.service, operation):
+                response = self._run(handler, kwargs)
+                break
+            response = {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+            self.meta.events.emit('needs-retry.{}'.format(event), response=(None, response), endpoint=None, operation=model, attempts=attempts, caught_exception=None, request_dict=kwargs)
+            if attempts > self.max_attempts:
+                break
+            time.sleep(self.aws.backoff(attempts))
+        response['ResponseMetadata']['RetryAttempts'] = attempts - 1
+        self.meta.events.emit('after-call.{}'.format(event), http_response=None, parsed=response, model=model, context=context)
+        if 'Error' in response:
+            raise botocore.exceptions.ClientError(response, model.name)
+        return response
+
+    @staticmethod
+    def _run(handler, kwargs):
+        try:
+            response = copy.deepcopy(handler(**kwargs))
+        except botocore.exceptions.ClientError as error:
+            response = dict(error.response)
+            response['ResponseMetadata'] = {'HTTPStatusCode': 400}
+            return response
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        return response
+
+    def get_paginator(self, operation):
+        """Returns a FakePaginator"""
+
+        return FakePaginator(self, operation)
+
+    def get_waiter(self, name):
+        """Returns a FakeWaiter"""
+
+        return FakeWaiter(self, name)
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+        return lambda **kwargs: self.call(operation, **kwargs)
+
+
+class FakeAWS:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """State of a fake AWS account, plus the handlers for the operations the scripts use
+
+    `latency` is the number of seconds every attempt takes. A share `throttle_rate` of the
+    attempts is throttled, the client then retries them the way botocore does."""
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, region='ap-southeast-2', seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.region = region
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self.stacks = {}
+        self.stack_ids = {}
+        self.listeners = {}
+        self.load_balancers = {}
+        self.services = {}
+        self.task_definitions = {}
+        self.scalable_targets = {}
+        self.target_group_attributes = {}
+        self.draining = collections.Counter()
+        self.tags = {}
+        self.sequence = 0
+
+    def client(self, service, region_name=None, config=None):  # pylint: disable=unused-argument
+        """Client factory for clients.set_client_factory"""
+
+        return FakeClient(self, service, config)
+
+    def record_call(self, service, operation):
+        """Counts a call, retries excluded"""
+
+        with self.lock:
+            self.calls['{}.{}'.format(service, operation)] += 1
+
+    def attempt(self, service, operation):
+        """Sleeps for the simulated latency of one attempt, returns True if the attempt is throttled"""
+
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles['{}.{}'.format(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return throttled
+
+    def backoff(self, attempts):
+        """Returns the delay before retrying a throttled attempt: botocore's exponential backoff with full jitter"""
+
+        with self.lock:
+            return self.random.random() * min(20, 2 ** (attempts - 1))
+
+    def reset_counters(self):
+        """Forgets the calls counted so far"""
+
+        with self.lock:
+            self.calls.clear()
+            self.throttles.clear()
+
+    def _next_id(self):
+        with self.lock:
+            self.sequence += 1
+            return '{:012x}'.format(self.sequence)
+
+    def _arn(self, service, resource):
+        return 'arn:aws:{}:{}:{}:{}'.format(service, self.region, ACCOUNT_ID, resource)
+
+    # Fleet
+
+    def build_fleet(self, cluster_name, app_name, versions=10, services=10, rules=10, desired_count=2, autoscaling=None):  # pylint: disable=too-many-arguments
+        """Creates a cluster, an app with `versions` version stacks (the last one live), `services`
+        unrelated services in the cluster and `rules` unrelated rules on the app's listener
+
+        `autoscaling` is the (min, max) capacity of the versions' scalable targets, None for none."""
+
+        cluster_full_name = '{}-ECSCluster-{}'.format(cluster_name, self._next_id())
+        self._add_stack('ECS-{}'.format(cluster_name), 'ECS Cluster', {}, {'ECSCluster': cluster_full_name})
+
+        alb = self._arn('elasticloadbalancing', 'loadbalancer/app/{}/{}'.format(app_name, self._next_id()))
+        listener = self._arn('elasticloadbalancing', 'listener/app/{}/{}'.format(app_name, self._next_id()))
+        self.load_balancers[alb] = {'LoadBalancerArn': alb, 'Scheme': 'internet-facing'}
+        self.listeners[listener] = [{'RuleArn': listener + '/default', 'Priority': 'default', 'IsDefault': True, 'Actions': []}]
+        self._add_stack('ECS-{}-App-{}'.format(cluster_name, app_name), 'ECS Cluster Application', {}, {'ALB': alb, 'ALBListenerSSL': listener})
+
+        for i in range(rules):
+            self.listeners[listener].append(self._rule(listener, str(i + 1), self._target_group('other-{}'.format(i))))
+        for i in range(services):
+            self._add_service(cluster_full_name, 'other-{}-ECSService-{}'.format(i, self._next_id()), self._target_group('other-{}'.format(i)), desired_count)
+
+        created = _now() - datetime.timedelta(days=versions + 1)
+        for i in range(versions):
+            stack = self.add_version(cluster_name, app_name, 'v{}'.format(i), desired_count, autoscaling)
+            stack['CreationTime'] = created + datetime.timedelta(days=i)
+        if versions:
+            self._set_default_target_group(listener, stack['Resources']['ALBTargetGroup'][0])
+        return cluster_full_name
+
+    def add_version(self, cluster_name, app_name, version, desired_count=1, autoscaling=None):  # pylint: disable=too-many-arguments
+        """Creates a version stack of an app without counting any calls, returns the stack"""
+
+        listener = self._app_listener(cluster_name, app_name)
+        parameters = {'Name': app_name, 'ClusterName': cluster_name, 'Version': version, 'RulePriority': str(self._free_priority(listener)), 'TaskDefinitionArn': ''}
+        if autoscaling is not None:
+            parameters.update({'Autoscaling': 'Enable', 'AutoscalingMinSize': str(autoscaling[0]), 'AutoscalingMaxSize': str(autoscaling[1])})
+        with self.lock:
+            return self._create_version_stack('ECS-{}-App-{}-{}'.format(cluster_name, app_name, version), parameters, desired_count)
+
+    def _target_group(self, name):
+        return self._arn('elasticloadbalancing', 'targetgroup/{}/{}'.format(name[:20], self._next_id()))
+
+    @staticmethod
+    def _rule(listener, priority, target_group):
+        return {
+            'RuleArn': '{}/{}'.format(listener, priority),
+            'Priority': priority,
+            'IsDefault': False,
+            'Actions': [{'Type': 'forward', 'TargetGroupArn': target_group}]
+        }
+
+    def _free_priority(self, listener):
+        taken = {int(x['Priority']) for x in self.listeners[listener] if x['Priority'] != 'default'}
+        return next(i for i in range(1, len(taken) + 2) if i not in taken)
+
+    def _set_default_target_group(self, listener, target_group):
+        self.listeners[listener][0]['Actions'] = [{'Type': 'forward', 'TargetGroupArn': target_group}]
+
+    def _add_service(self, cluster_full_name, name, target_group, desired_count, task_definition=''):  # pylint: disable=too-many-arguments
+        arn = self._arn('ecs', 'service/{}/{}'.format(cluster_full_name, name))
+        self.services[(cluster_full_name, name)] = {
+            'serviceArn': arn,
+            'serviceName': name,
+            'clusterArn': self._arn('ecs', 'cluster/{}'.format(cluster_full_name)),
+            'launchType': 'EC2',
+            'desiredCount': desired_count,
+            'runningCount': desired_count,
+            'taskDefinition': task_definition,
+            'loadBalancers': [{'targetGroupArn': target_group}],
+            'deployments': [{'status': 'PRIMARY'}],
+            'events': []
+        }
+        return arn
+
+    def _add_stack(self, name, description, parameters, resources, outputs=None):  # pylint: disable=too-many-arguments
+        stack_id = self._arn('cloudformation', 'stack/{}/{}'.format(name, self._next_id()))
+        stack = {
+            'StackName': name,
+            'StackId': stack_id,
+            'StackStatus': 'CREATE_COMPLETE',
+            'Description': description,
+            'CreationTime': _now(),
+            'EnableTerminationProtection': False,
+            'Parameters': dict(parameters),
+            'Outputs': dict(outputs or {}),
+            'Resources': {key: (value, 'AWS::Fake::Resource') for key, value in resources.items()},
+            'Events': []
+        }
+        self.stacks[name] = stack
+        self.stack_ids[stack_id] = stack
+        self._add_events(stack, 'CREATE_COMPLETE')
+        return stack
+
+    def _add_events(self, stack, status, reason=''):
+        for logical_resource_id in list(stack['Resources']) + [stack['StackName']]:
+            stack['Events'].insert(0, {
+                'EventId': self._next_id(),
+                'StackName': stack['StackName'],
+                'LogicalResourceId': logical_resource_id,
+                'ResourceStatus': status,
+                'ResourceStatusReason': reason,
+                'Timestamp': _now()
+            })
+
+    def _find_stack(self, name, operation):
+        stack = self.stack_ids.get(name) or self.stacks.get(name)
+        if stack is None or (stack['StackStatus'] == 'DELETE_COMPLETE' and name not in self.stack_ids):
+            raise client_error(operation, 'ValidationError', 'Stack with id {} does not exist'.format(name))
+        return stack
+
+    def _app_listener(self, cluster_name, app_name):
+        return self.stacks['ECS-{}-App-{}'.format(cluster_name, app_name)]['Resources']['ALBListenerSSL'][0]
+
+    def _create_version_stack(self, name, parameters, desired_count=1):
+        cluster_full_name = self.stacks['ECS-{}'.format(parameters['ClusterName'])]['Resources']['ECSCluster'][0]
+        listener = self._app_listener(parameters['ClusterName'], parameters['Name'])
+        target_group = self._target_group(name.split('-')[-1])
+        resources = {'ALBTargetGroup': target_group}
+        self.target_group_attributes[target_group] = {'deregistration_delay.timeout_seconds': parameters.get('DeregistrationDelay', '30')}
+        outputs = {'Version': parameters.get('Version'), 'Url': 'https://example.com{}'.format(parameters.get('Path', '/')), 'TargetGroup': target_group}
+        stack = self._add_stack(name, VERSION_DESCRIPTION, parameters, resources, outputs)
+
+        priority = parameters.get('RulePriority')
+        if any(x['Priority'] == priority for x in self.listeners[listener]):
+            stack['StackStatus'] = 'ROLLBACK_COMPLETE'
+            stack['Events'].insert(0, {
+                'EventId': self._next_id(), 'StackName': name, 'LogicalResourceId': 'ListenerRule', 'ResourceStatus': 'CREATE_FAILED',
+                'ResourceStatusReason': "Priority '{}' is currently in use".format(priority), 'Timestamp': _now()})
+            return stack
+
+        rule = self._rule(listener, priority, target_group)
+        self.listeners[listener].append(rule)
+        service = self._add_service(cluster_full_name, '{}-ECSService-{}'.format(name, self._next_id()), target_group, desired_count, parameters.get('TaskDefinitionArn'))
+        stack['Resources'].update({
+            'ListenerRule': (rule['RuleArn'], 'AWS::ElasticLoadBalancingV2::ListenerRule'),
+            'ECSService': (service, 'AWS::ECS::Service'),
+        })
+        if parameters.get('Autoscaling') == 'Enable':
+            resource_id = 'service/{}/{}'.format(cluster_full_name, service.split('/')[-1])
+            self.scalable_targets[resource_id] = {
+                'ServiceNamespace': 'ecs',
+                'ResourceId': resource_id,
+                'ScalableDimension': 'ecs:service:DesiredCount',
+                'MinCapacity': int(parameters['AutoscalingMinSize']),
+                'MaxCapacity': int(parameters['AutoscalingMaxSize'])
+            }
+            stack['Resources']['ServiceScalingTarget'] = (resource_id, 'AWS::ApplicationAutoScaling::ScalableTarget')
+        stack['Listener'] = listener
+        return stack
+
+    # CloudFormation
+
+    def cloudformation_describe_stacks(self, StackName=None, NextToken=None):  # pylint: disable=invalid-name,unused-argument
+        """Describes one stack, or every stack that is not deleted"""
+
+        with self.lock:
+            if StackName is not None:
+                stacks = [self._find_stack(StackName, 'DescribeStacks')]
+            else:
+                stacks = [x for x in self.stacks.values() if x['StackStatus'] != 'DELETE_COMPLETE']
+            return {'Stacks': [{
+                'StackName': x['StackName'],
+                'StackId': x['StackId'],
+                'StackStatus': x['StackStatus'],
+                'Description': x['Description'],
+                'CreationTime': x['CreationTime'],
+                'EnableTerminationProtection': x['EnableTerminationProtection'],
+                'Parameters': [{'ParameterKey': key, 'ParameterValue': value} for key, value in x['Parameters'].items()],
+                'Outputs': [{'OutputKey': key, 'OutputValue': value} for key, value in x['Outputs'].items()]
+            } for x in stacks]}
+
+    def cloudformation_list_stack_resources(self, StackName, NextToken=None):  # pylint: disable=invalid-name,unused-argument
+        """Lists the resources of a stack"""
+
+        with self.lock:
+            stack = self._find_stack(StackName, 'ListStackResources')
+            return {'StackResourceSummaries': [
+                {'LogicalResourceId': key, 'PhysicalResourceId': value, 'ResourceType': resource_type, 'ResourceStatus': 'CREATE_COMPLETE'}
+                for key, (value, resource_type) in stack['Resources'].items()
+            ]}
+
+    def cloudformation_describe_stack_events(self, StackName, NextToken=None):  # pylint: disable=invalid-name,unused-argument
+        """Returns the events of a stack, newest first"""
+
+        with self.lock:
+            return {'StackEvents': list(self._find_stack(StackName, 'DescribeStackEvents')['Events'])}
+
+    def cloudformation_validate_template(self, TemplateBody):  # pylint: disable=invalid-name,unused-argument
+        """Accepts any template"""
+
+        return {'Parameters': []}
+
+    def cloudformation_create_stack(self, StackName, TemplateBody, Parameters, Tags=None):  # pylint: disable=invalid-name,unused-argument
+        """Creates a version stack from its parameters, the template itself is ignored"""
+
+        parameters = {x['ParameterKey']: x.get('ParameterValue') for x in Parameters}
+        with self.lock:
+            if StackName in self.stacks and self.stacks[StackName]['StackStatus'] != 'DELETE_COMPLETE':
+                raise client_error('CreateStack', 'AlreadyExistsException', 'Stack [{}] already exists'.format(StackName))
+            return {'StackId': self._create_version_stack(StackName, parameters)['StackId']}
+
+    def cloudformation_update_stack(self, StackName, TemplateBody, Parameters, Tags=None):  # pylint: disable=invalid-name,unused-argument
+        """Updates the parameters of a stack, failing like CloudFormation when nothing changes"""
+
+        with self.lock:
+            stack = self._find_stack(StackName, 'UpdateStack')
+            parameters = {x['ParameterKey']: stack['Parameters'].get(x['ParameterKey']) if x.get('UsePreviousValue') else x.get('ParameterValue') for x in Parameters}
+            if parameters == stack['Parameters']:
+                raise client_error('UpdateStack', 'ValidationError', 'No updates are to be performed.')
+            stack['Parameters'] = parameters
+            stack['StackStatus'] = 'UPDATE_COMPLETE'
+            self._add_events(stack, 'UPDATE_COMPLETE')
+            if 'ECSService' in stack['Resources']:
+                service_arn = stack['Resources']['ECSService'][0]
+                service = next(x for x in self.services.values() if x['serviceArn'] == service_arn)
+                service['taskDefinition'] = parameters.get('TaskDefinitionArn')
+            return {'StackId': stack['StackId']}
+
+    def cloudformation_delete_stack(self, StackName):  # pylint: disable=invalid-name
+        """Deletes a stack and the listener rule and service it created"""
+
+        with self.lock:
+            try:
+                stack = self._find_stack(StackName, 'DeleteStack')
+            except botocore.exceptions.ClientError:
+                return {}  # deleting a missing stack succeeds
+            if 'Listener' in stack:
+                rule_arn = stack['Resources']['ListenerRule'][0]
+                self.listeners[stack['Listener']] = [x for x in self.listeners[stack['Listener']] if x['RuleArn'] != rule_arn]
+            if 'ECSService' in stack['Resources']:
+                service_arn = stack['Resources']['ECSService'][0]
+                self.services = {key: value for key, value in self.services.items() if value['serviceArn'] != service_arn}
+            if 'ServiceScalingTarget' in stack['Resources']:
+                self.scalable_targets.pop(stack['Resources']['ServiceScalingTarget'][0], None)
+            stack['StackStatus'] = 'DELETE_COMPLETE'
+            self._add_events(stack, 'DELETE_COMPLETE')
+            return {}
+
+    # ELBv2
+
+    def elbv2_describe_rules(self, ListenerArn, Marker=None, PageSize=None):  # pylint: disable=invalid-name,unused-argument
+        """Returns the rules of a listener, default rule included"""
+
+        with self.lock:
+            return {'Rules': list(self.listeners[ListenerArn])}
+
+    def elbv2_describe_load_balancers(self, LoadBalancerArns):  # pylint: disable=invalid-name
+        """Describes load balancers by ARN"""
+
+        with self.lock:
+            return {'LoadBalancers': [self.load_balancers[x] for x in LoadBalancerArns]}
+
+    def elbv2_describe_target_health(self, TargetGroupArn):  # pylint: disable=invalid-name
+        """Reports one healthy target per running task of the services attached to the target group
+
+        The targets of tasks stopped by a scale-down are reported as draining once, then they are gone."""
+
+        with self.lock:
+            count = sum(x['runningCount'] for x in self.services.values() if x['loadBalancers'][0]['targetGroupArn'] == TargetGroupArn)
+            states = ['healthy'] * count + ['draining'] * self.draining.pop(TargetGroupArn, 0)
+        return {'TargetHealthDescriptions': [
+            {'Target': {'Id': 'i-{:017x}'.format(i), 'Port': 8080}, 'TargetHealth': {'State': state}} for i, state in enumerate(states)
+        ]}
+
+    def elbv2_describe_target_group_attributes(self, TargetGroupArn):  # pylint: disable=invalid-name
+        """Returns the attributes of a target group, AWS defaults for the ones not created by a version stack"""
+
+        with self.lock:
+            attributes = dict({'deregistration_delay.timeout_seconds': '300'}, **self.target_group_attributes.get(TargetGroupArn, {}))
+        return {'Attributes': [{'Key': key, 'Value': value} for key, value in attributes.items()]}
+
+    def elbv2_add_tags(self, ResourceArns, Tags):  # pylint: disable=invalid-name
+        """Adds or overwrites tags on load balancer resources"""
+
+        with self.lock:
+            for arn in ResourceArns:
+                self.tags.setdefault(arn, {}).update({x['Key']: x['Value'] for x in Tags})
+        return {}
+
+    def elbv2_describe_tags(self, ResourceArns):  # pylint: disable=invalid-name
+        """Returns the tags of load balancer resources"""
+
+        with self.lock:
+            return {'TagDescriptions': [
+                {'ResourceArn': x, 'Tags': [{'Key': key, 'Value': value} for key, value in self.tags.get(x, {}).items()]} for x in ResourceArns
+            ]}
+
+    def elbv2_modify_listener(self, ListenerArn, DefaultActions):  # pylint: disable=invalid-name
+        """Replaces the default actions of a listener"""
+
+        with self.lock:
+            self.listeners[ListenerArn][0]['Actions'] = DefaultActions
+        return {'Listeners': [{'ListenerArn': ListenerArn, 'DefaultActions': DefaultActions}]}
+
+    # ECS
+
+    def ecs_list_services(self, cluster, launchType=None, nextToken=None, maxResults=None):  # pylint: disable=invalid-name,unused-argument
+        """Lists the service ARNs of a cluster"""
+
+        with self.lock:
+            return {'serviceArns': [x['serviceArn'] for (cluster_full_name, _), x in self.services.items() if cluster_full_name == cluster]}
+
+    def ecs_describe_services(self, cluster, services):
+        """Describes up to 10 services by name or ARN"""
+
+        if len(services) > 10:
+            raise client_error('DescribeServices', 'InvalidParameterException', 'services can have at most 10 items.')
+        with self.lock:
+            found = [self.services.get((cluster, x.split('/')[-1])) for x in services]
+        return {
+            'services': [x for x in found if x is not None],
+            'failures': [{'arn': x, 'reason': 'MISSING'} for x, y in zip(services, found) if y is None]
+        }
+
+    def ecs_update_service(self, cluster, service, desiredCount):  # pylint: disable=invalid-name
+        """Sets the desired count of a service, its tasks start immediately and the targets of stopped tasks drain"""
+
+        with self.lock:
+            record = self.services[(cluster, service.split('/')[-1])]
+            if desiredCount < record['runningCount']:
+                self.draining[record['loadBalancers'][0]['targetGroupArn']] += record['runningCount'] - desiredCount
+            record['desiredCount'] = desiredCount
+            record['runningCount'] = desiredCount
+            return {'service': record}
+
+    def ecs_describe_task_definition(self, taskDefinition, include=None):  # pylint: disable=invalid-name,unused-argument
+        """Describes the latest revision of a family"""
+
+        with self.lock:
+            revisions = self.task_definitions.get(taskDefinition)
+            if not revisions:
+                raise client_error('DescribeTaskDefinition', 'ClientException', 'Unable to describe task definition.')
+            return revisions[-1]
+
+    def ecs_register_task_definition(self, family, tags=None, **kwargs):
+        """Registers a new revision of a family"""
+
+        with self.lock:
+            revisions = self.task_definitions.setdefault(family, [])
+            arn = self._arn('ecs', 'task-definition/{}:{}'.format(family, len(revisions) + 1))
+            revision = {'taskDefinition': dict(kwargs, family=family, taskDefinitionArn=arn, revision=len(revisions) + 1), 'tags': tags or []}
+            revisions.append(revision)
+            return revision
+
+    def ecs_list_tasks(self, cluster, serviceName, desiredStatus=None):  # pylint: disable=invalid-name,unused-argument
+        """No task ever stops in the fake"""
+
+        return {'taskArns': []}
+
+    def ecs_describe_tasks(self, cluster, tasks):  # pylint: disable=unused-argument
+        """Describes no tasks, see ecs_list_tasks"""
+
+        return {'tasks': []}
+
+    # Application Auto Scaling
+
+    def application_autoscaling_describe_scalable_targets(self, ServiceNamespace, ResourceIds=None, ScalableDimension=None):  # pylint: disable=invalid-name,unused-argument
+        """Describes the scalable targets of the given resources"""
+
+        with self.lock:
+            return {'ScalableTargets': [self.scalable_targets[x] for x in ResourceIds or list(self.scalable_targets) if x in self.scalable_targets]}
+
+    def application_autoscaling_register_scalable_target(self, ServiceNamespace, ResourceId, ScalableDimension, MinCapacity, MaxCapacity):  # pylint: disable=invalid-name,too-many-arguments
+        """Updates the capacity bounds of a scalable target, bringing the service's desired count within them"""
+
+        with self.lock:
+            if ResourceId not in self.scalable_targets:
+                raise client_error('RegisterScalableTarget', 'ValidationException', 'No scalable target registered for {}'.format(ResourceId))
+            self.scalable_targets[ResourceId].update({'ServiceNamespace': ServiceNamespace, 'ScalableDimension': ScalableDimension, 'MinCapacity': MinCapacity, 'MaxCapacity': MaxCapacity})
+            _, cluster_full_name, service_name = ResourceId.split('/')
+            record = self.services.get((cluster_full_name, service_name))
+            if record is not None:
+                record['desiredCount'] = record['runningCount'] = min(max(record['desiredCount'], MinCapacity), MaxCapacity)
+            return {}
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""CLI tool for running deploy, warmup, cutover, rollback or cleanup against several clusters and regions at once
+
+Targets are read from ECS_TARGETS as a comma separated list of `region:cluster_name`, e.g.
+
+    ECS_TARGETS=ap-southeast-2:my-cluster,us-east-1:my-cluster
+
+Every target runs in its own thread with region-scoped AWS clients. By default all
+targets run to completion (best-effort). With ECS_FANOUT_FAIL_FAST=true, once a target
+fails the others stop before their next change to AWS: before the stack is deployed or
+deleted, before cutover or warm-up resizes the new version and before cutover switches
+the listener. A change a target already made is not rolled back."""
+
+import os
+import sys
+from clients import use_region
+from cleanup import cleanup_version_stack
+from concurrency import print_report
+from concurrency import run_tasks
+from cutover import change_default_rule_tg
+from deploy import deploy_ecs_service
+from deploy import load_deployment_files
+from metrics import run_report
+from rollback import rollback
+from tracing import trace_run
+from warmup import warm_up_version
+
+
+def parse_targets(targets):
+    """Parses a comma separated list of region:cluster_name pairs into a list of tuples"""
+
+    parsed = []
+    for target in [x.strip() for x in targets.split(',') if x.strip() != '']:
+        region, separator, cluster_name = target.partition(':')
+        if separator == '' or region == '' or cluster_name == '':
+            raise Exception("Invalid target '{}', expected region:cluster_name".format(target))
+        parsed.append((region, cluster_name))
+    return parsed
+
+
+def _in_region(region, function, **kwargs):
+    """Returns a callable running `function` with clients scoped to `region`"""
+
+    def run():
+        with use_region(region):
+            return function(**kwargs)
+    return run
+
+
+def get_tasks(command, targets):
+    """Returns a named callable per target for the given command"""
+
+    app_name = os.environ['ECS_APP_NAME']
+    version = os.environ['BUILD_VERSION']
+    tasks = []
+    for region, cluster_name in targets:
+        name = "{}:{}".format(region, cluster_name)
+        if command == 'deploy':
+            # render the files per target so ${ECS_CLUSTER_NAME} and ${AWS_DEFAULT_REGION} match the target
+            # and give the containers the same values
+            variables = dict(os.environ, ECS_CLUSTER_NAME=cluster_name, AWS_DEFAULT_REGION=region)
+            config, task_definition, template = load_deployment_files(variables)
+            task = _in_region(
+                region, deploy_ecs_service, app_name=app_name, env=os.environ['ENV'], cluster_name=cluster_name, version=version,
+                aws_hosted_zone=os.environ['AWS_HOSTED_ZONE'], base_path=os.environ['BASE_PATH'], config=config,
+                task_definition=task_definition, template=template, variables=variables
+            )
+        elif command == 'cutover':
+            task = _in_region(
+                region, change_default_rule_tg, cluster_name=cluster_name, app_name=app_name, version=version,
+                aws_hosted_zone=os.environ['AWS_HOSTED_ZONE'], base_path=os.environ['BASE_PATH']
+            )
+        elif command == 'warmup':
+            task = _in_region(region, warm_up_version, cluster_name=cluster_name, app_name=app_name, version=version)
+        elif command == 'rollback':
+            task = _in_region(region, rollback, cluster_name=cluster_name, app_name=app_name)
+        elif command == 'cleanup':
+            task = _in_region(region, cleanup_version_stack, cluster_name=cluster_name, app_name=app_name, version=version)
+        else:
+            raise Exception("Unknown command '{}', expected deploy, warmup, cutover, rollback or cleanup".format(command))
+        tasks.append((name, task))
+    return tasks
+
+
+def main():
+    """Entrypoint for CLI"""
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    targets = parse_targets(os.environ['ECS_TARGETS'])
+    fail_fast = os.environ.get('ECS_FANOUT_FAIL_FAST', 'false') == 'true'
+
+    tasks = get_tasks(command, targets)
+    print("Running {} against {} targets...".format(command, len(tasks)))
+    results = run_tasks(tasks, max_workers=len(tasks), fail_fast=fail_fast)
+    print_report("Fan-out {} report".format(command), results)
+
+    failed = [x['name'] for x in results if x['error'] is not None]
+    if failed:
+        raise Exception("{} failed for: {}".format(command, ", ".join(failed)))
+
+
+if __name__ == "__main__":
+    with run_report('fanout'), trace_run('fanout'):
+        main()
@@ -0,0 +1,123 @@
+"""Shared target group health poller with capped exponential backoff"""
+
+import os
+import time
+import random
+import datetime
+from clients import get_client
+from metrics import record_wait
+
+
+class PollTimeoutError(Exception):
+    """Raised when a health condition is not met before the timeout"""
+
+
+def get_poll_settings():
+    """Returns the polling intervals, configurable through the environment"""
+
+    return {
+        'initial_interval': float(os.environ.get('ECS_HEALTH_POLL_INITIAL_INTERVAL', '2')),
+        'max_interval': float(os.environ.get('ECS_HEALTH_POLL_MAX_INTERVAL', '15')),
+        'timeout': float(os.environ.get('ECS_HEALTH_POLL_TIMEOUT', '600'))
+    }
+
+
+def backoff_intervals(initial_interval, max_interval, multiplier=2):
+    """Yields sleep intervals that grow exponentially up to max_interval, with jitter
+
+    Each interval is drawn between half and all of the capped exponential value so that
+    parallel pollers do not hit the API in lockstep."""
+
+    interval = initial_interval
+    while True:
+        capped = min(interval, max_interval)
+        yield random.uniform(capped / 2, capped)
+        interval = interval * multiplier
+
+
+def poll_until(check, timeout=None, initial_interval=None, max_interval=None):
+    """Calls `check` until it returns a truthy value, sleeping with capped exponential backoff in between
+
+    Returns a dict with the value returned by `check`, the elapsed time, the number of polls and
+    the detection latency: the time between the last failed poll and the successful one, which is
+    the most the polling can have added on top of the condition actually becoming true."""
+
+    settings = get_poll_settings()
+    timeout = settings['timeout'] if timeout is None else timeout
+    intervals = backoff_intervals(
+        settings['initial_interval'] if initial_interval is None else initial_interval,
+        settings['max_interval'] if max_interval is None else max_interval
+    )
+
+    start_time = time.monotonic()
+    last_failed_poll = None
+    polls = 0
+    while True:
+        polls = polls + 1
+        poll_time = time.monotonic()
+        value = check()
+        if value:
+            return {
+                'value': value,
+                'elapsed_time': datetime.timedelta(seconds=poll_time - start_time),
+                'polls': polls,
+                'detection_latency': datetime.timedelta(seconds=0 if last_failed_poll is None else poll_time - last_failed_poll)
+            }
+        last_failed_poll = poll_time
+        remaining = timeout - (time.monotonic() - start_time)
+        if remaining <= 0:
+            raise PollTimeoutError('Condition not met before {}s timeout.'.format(timeout))
+        interval = min(next(intervals), remaining)
+        time.sleep(interval)
+        record_wait('sleep.health_poll', interval)
+
+
+def get_healthy_target_count(target_group):
+    """Returns the number of healthy targets and the number of registered targets in a target group"""
+
+    elbv2 = get_client('elbv2')
+    response = elbv2.describe_target_health(TargetGroupArn=target_group)
+    states = [x['TargetHealth']['State'] for x in response['TargetHealthDescriptions']]
+    return len([x for x in states if x == 'healthy']), len(states)
+
+
+def wait_for_healthy_targets(target_group, desired_count=None, timeout=None):
+    """Polls a target group until it has `desired_count` healthy targets
+
+    When desired_count is None, waits until there is at least one target and every registered
+    target is healthy. Raises PollTimeoutError on timeout, returns the poll_until result otherwise."""
+
+    def check():
+        healthy, registered = get_healthy_target_count(target_group)
+        print('There are {} healthy targets out of {} registered.'.format(healthy, registered))
+        if desired_count is None:
+            return healthy > 0 and healthy == registered
+        return healthy >= desired_count
+
+    result = poll_until(check, timeout=timeout)
+    print('Target group healthy after {} ({} polls, observed at most {} after becoming healthy).'.format(
+        result['elapsed_time'], result['polls'], result['detection_latency']))
+    return result
+
+
+def get_draining_target_count(target_group):
+    """Returns the number of targets of a target group still draining in-flight requests, and the number of the other targets"""
+
+    elbv2 = get_client('elbv2')
+    response = elbv2.describe_target_health(TargetGroupArn=target_group)
+    states = [x['TargetHealth']['State'] for x in response['TargetHealthDescriptions']]
+    draining = len([x for x in states if x == 'draining'])
+    return draining, len(states) - draining
+
+
+def wait_for_drained_targets(target_group, max_targets=0, timeout=None):
+    """Polls a target group until none of its targets is draining and at most `max_targets` others are registered
+
+    Raises PollTimeoutError on timeout, returns the poll_until result otherwise."""
+
+    def check():
+        draining, registered = get_draining_target_count(target_group)
+        print('{} targets are draining, {} registered.'.format(draining, registered))
+        return draining == 0 and registered <= max_targets
+
+    return poll_until(check, timeout=timeout)
@@ -0,0 +1,176 @@
+"""Process-wide metrics of AWS API calls, waiters and sleeps, reported as JSON at the end of a run
+
+Every boto3 client created by clients.get_client is instrumented with botocore event hooks
+recording the count, latency, retries and throttling errors of each operation. Waiters and
+sleeps are recorded explicitly with timed() and record_wait()."""
+
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+
+
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown'
+}
+
+_LOCK = threading.Lock()
+_OPERATIONS = {}
+_WAITS = {}
+_CONTEXT_KEY = 'ecs_utils_metrics'
+
+
+def _get_operation(service, operation):
+    return _OPERATIONS.setdefault((service, operation), {'count': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'latencies': []})
+
+
+def _before_call(model, context, **_):
+    context[_CONTEXT_KEY] = (model.service_model.service_name, model.name, time.monotonic())
+
+
+def _after_call(parsed, context, **_):
+    if _CONTEXT_KEY not in context:
+        return
+    service, operation, start_time = context[_CONTEXT_KEY]
+    latency = time.monotonic() - start_time
+    with _LOCK:
+        record = _get_operation(service, operation)
+        record['count'] += 1
+        record['latencies'].append(latency)
+        record['retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if 'Error' in parsed:
+            record['errors'] += 1
+
+
+def _after_call_error(context, **_):
+    if _CONTEXT_KEY not in context:
+        return
+    service, operation, start_time = context[_CONTEXT_KEY]
+    latency = time.monotonic() - start_time
+    with _LOCK:
+        record = _get_operation(service, operation)
+        record['count'] += 1
+        record['errors'] += 1
+        record['latencies'].append(latency)
+
+
+def _needs_retry(response, operation, **_):
+    """Counts throttled attempts, always leaves the retry decision to botocore"""
+
+    if response is None:
+        return
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in THROTTLING_ERROR_CODES:
+        with _LOCK:
+            _get_operation(operation.service_model.service_name, operation.name)['throttles'] += 1
+
+
+def instrument_client(client):
+    """Registers the metrics hooks on a boto3 client"""
+
+    client.meta.events.register_first('before-call.*.*', _before_call)  # before any handler that short-circuits the call
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call_error)
+    client.meta.events.register('needs-retry', _needs_retry)
+
+
+def record_wait(name, seconds):
+    """Adds time spent waiting, e.g. in a waiter or a polling sleep, under `name`"""
+
+    with _LOCK:
+        record = _WAITS.setdefault(name, {'count': 0, 'total_seconds': 0.0})
+        record['count'] += 1
+        record['total_seconds'] += seconds
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Records the duration of the with statement as a wait under `name`"""
+
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        record_wait(name, time.monotonic() - start_time)
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a list of numbers"""
+
+    ordered = sorted(values)
+    return ordered[max(0, int(round(fraction * len(ordered))) - 1)]
+
+
+def get_summary():
+    """Returns the metrics recorded so far, per operation, per service and per wait"""
+
+    with _LOCK:
+        operations = {key: dict(value, latencies=list(value['latencies'])) for key, value in _OPERATIONS.items()}
+        waits = {key: dict(value) for key, value in _WAITS.items()}
+
+    summary = {'operations': {}, 'services': {}, 'waits': {}}
+    for (service, operation), record in sorted(operations.items()):
+        latencies = record.pop('latencies')
+        total_seconds = sum(latencies)
+        summary['operations']['{}.{}'.format(service, operation)] = dict(record, total_seconds=round(total_seconds, 3), latency_ms={
+            'p50': round(percentile(latencies, 0.5) * 1000, 1),
+            'p90': round(percentile(latencies, 0.9) * 1000, 1),
+            'p99': round(percentile(latencies, 0.99) * 1000, 1),
+            'max': round(max(latencies) * 1000, 1)
+        } if latencies else {})
+        totals = summary['services'].setdefault(service, {'count': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'total_seconds': 0.0})
+        for key in ['count', 'errors', 'retries', 'throttles']:
+            totals[key] += record[key]
+        totals['total_seconds'] = round(totals['total_seconds'] + total_seconds, 3)
+    for name, record in sorted(waits.items()):
+        summary['waits'][name] = dict(record, total_seconds=round(record['total_seconds'], 3))
+    return summary
+
+
+def reset_metrics():
+    """Forgets every recorded call and wait"""
+
+    with _LOCK:
+        _OPERATIONS.clear()
+        _WAITS.clear()
+
+
+@contextlib.contextmanager
+def run_report(command):
+    """Emits the metrics summary of a run as JSON when the with statement ends, even if it failed
+
+    The summary is written to ECS_METRICS_PATH when set and printed otherwise."""
+
+    start_time = time.monotonic()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        summary = {
+            'command': command,
+            'succeeded': succeeded,
+            'finished_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'elapsed_seconds': round(time.monotonic() - start_time, 3)
+        }
+        summary.update(get_summary())
+        path = os.environ.get('ECS_METRICS_PATH')
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as metrics_file:
+                json.dump(summary, metrics_file, indent=2)
+            print("AWS API metrics written to {}".format(path))
+        else:
+            print("AWS API metrics:")
+            print(json.dumps(summary, indent=2))
+            sys.stdout.flush()
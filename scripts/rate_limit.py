@@ -0,0 +1,98 @@
+"""Client-side rate limiting of AWS API requests, shared by every thread in the process
+
+Each AWS service and region gets one token bucket, consulted before every HTTP request
+(retries included) sent by the clients of the client registry. Limits are requests per
+second, set with ECS_RATE_LIMITS, e.g. `cloudformation=5,elbv2=10,ecs=20`; 0 disables
+the limit of a service. Time spent waiting for a token is reported as a wait by metrics."""
+
+import os
+import time
+import threading
+from metrics import record_wait
+
+
+DEFAULT_RATE_LIMITS = {
+    'cloudformation': 5.0,
+    'elbv2': 10.0,
+    'ecs': 20.0,
+    'application-autoscaling': 10.0
+}
+
+_LIMITERS = {}
+_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`
+
+    Callers that find the bucket empty reserve the next token and sleep until it is due,
+    so concurrent callers are served in order without busy waiting."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds the caller must wait before using it"""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """Waits for a token, returns the number of seconds waited"""
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def get_rate_limits():
+    """Returns the requests per second allowed per service, from DEFAULT_RATE_LIMITS and ECS_RATE_LIMITS"""
+
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in os.environ.get('ECS_RATE_LIMITS', '').split(','):
+        if item.strip():
+            service, rate = item.split('=')
+            limits[service.strip()] = float(rate)
+    return limits
+
+
+def get_rate_limiter(service, region):
+    """Returns the token bucket shared by every client of a service in a region, None if it is not limited"""
+
+    with _LOCK:
+        key = (service, region)
+        if key not in _LIMITERS:
+            rate = get_rate_limits().get(service, 0)
+            _LIMITERS[key] = TokenBucket(rate) if rate > 0 else None
+        return _LIMITERS[key]
+
+
+def reset_rate_limiters():
+    """Drops every token bucket, so changed limits apply to the clients created next"""
+
+    with _LOCK:
+        _LIMITERS.clear()
+
+
+def limit_client_rate(client, service, region):
+    """Makes every request sent by a boto3 client wait for a token of the service's bucket"""
+
+    limiter = get_rate_limiter(service, region)
+    if limiter is None:
+        return
+
+    def before_send(**_):
+        waited = limiter.acquire()
+        if waited > 0:
+            record_wait('rate_limit.{}'.format(service), waited)
+
+    client.meta.events.register('before-send', before_send)
@@ -0,0 +1,96 @@
+"""In-process replacement for envsubst: substitutes ${VAR} in JSON templates and loaded YAML structures"""
+
+import os
+import re
+import json
+import yaml
+
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # pylint: disable=invalid-name  # the C loader is much faster when libyaml is available
+PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+MALFORMED_PLACEHOLDER = re.compile(r'\$\{(?![A-Za-z_][A-Za-z0-9_]*\})[^}\s]*\S?')
+
+
+class RenderError(Exception):
+    """Raised in strict mode when a template has unresolved or malformed variables"""
+
+
+class Renderer:
+    """Substitutes variables into strings, remembering which ones could not be resolved"""
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.unresolved = set()
+        self.malformed = set()
+
+    def _replace(self, match):
+        name = match.group(1) or match.group(2)
+        if name not in self.variables:
+            self.unresolved.add(name)
+            return ''  # same as envsubst
+        return self.variables[name]
+
+    def render_string(self, value, yaml_scalar=False):
+        """Substitutes the variables in a string
+
+        When yaml_scalar is set and the whole string is a single placeholder, the value is
+        re-read as a YAML scalar so that e.g. `size: ${SIZE}` still becomes a number."""
+
+        self.malformed.update(MALFORMED_PLACEHOLDER.findall(value))
+        rendered = PLACEHOLDER.sub(self._replace, value)
+        if yaml_scalar and PLACEHOLDER.fullmatch(value):
+            loaded = yaml.load(rendered, Loader=YAML_LOADER)
+            if not isinstance(loaded, (dict, list)):
+                return loaded
+        return rendered
+
+    def render(self, data, yaml_scalars=False):
+        """Returns a copy of a loaded JSON or YAML structure with every string rendered"""
+
+        if isinstance(data, dict):
+            return {self.render(key): self.render(value, yaml_scalars) for key, value in data.items()}
+        if isinstance(data, list):
+            return [self.render(value, yaml_scalars) for value in data]
+        if isinstance(data, str):
+            return self.render_string(data, yaml_scalars)
+        return data
+
+    def report(self, name):
+        """Prints the unresolved and malformed variables, raising in strict mode (ECS_RENDER_STRICT=true)"""
+
+        problems = []
+        if self.unresolved:
+            problems.append("unresolved variables: {}".format(", ".join(sorted(self.unresolved))))
+        if self.malformed:
+            problems.append("malformed placeholders: {}".format(", ".join(sorted(self.malformed))))
+        if not problems:
+            return
+        message = "{} has {}".format(name, "; ".join(problems))
+        if os.environ.get('ECS_RENDER_STRICT', 'false') == 'true':
+            raise RenderError(message)
+        print("WARNING: {}".format(message))
+
+
+def render_json_file(path, variables=None):
+    """Substitutes variables (the environment by default) into a JSON file, then loads it
+
+    The substitution runs on the raw text, like envsubst did, so unquoted placeholders such
+    as `"memory": ${MEMORY}` become numbers."""
+
+    with open(path, 'r') as json_file:
+        text = json_file.read()
+    renderer = Renderer(os.environ if variables is None else variables)
+    rendered = renderer.render_string(text)
+    renderer.report(path)
+    return json.loads(rendered)
+
+
+def render_yaml_file(path, variables=None):
+    """Loads a YAML file and substitutes variables (the environment by default) into it"""
+
+    with open(path, 'r') as yaml_file:
+        data = yaml.load(yaml_file, Loader=YAML_LOADER)
+    renderer = Renderer(os.environ if variables is None else variables)
+    rendered = renderer.render(data, yaml_scalars=True)
+    renderer.report(path)
+    return rendered
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""CLI tool and function for putting a version's autoscaling bounds back on the ones configured in its stack
+
+Warm-up, and cutover with ECS_CUTOVER_CARRY_SCALING=true, raise the new version's bounds to
+the live capacity (see scaling.py) and leave them raised. Run this as a later pipeline step, once
+ECS_CUTOVER_SCALING_COOLDOWN seconds have passed since cutover. Run earlier, it waits only
+for the rest of the cooldown, counted from the cutover recorded on the listener (see
+cutover_history.py)."""
+
+import os
+import time
+import datetime
+from cutover import get_cluster_full_name
+from cutover_history import NoCutoverRecordedError
+from cutover_history import get_last_cutover
+from metrics import record_wait
+from metrics import run_report
+from scaling import get_scaling_settings
+from scaling import restore_configured_bounds
+from stack_resources import get_physical_resource_id
+from tracing import span
+from tracing import trace_run
+
+
+def get_remaining_cooldown(alb_listener, service_arn, cooldown):
+    """Returns the seconds left of the cooldown since the cutover to `service_arn`, 0 if it is over or was not recorded"""
+
+    try:
+        record = get_last_cutover(alb_listener)
+    except NoCutoverRecordedError:
+        return 0
+    if record['current']['service'] != service_arn:
+        return 0
+    elapsed = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(record['time'])
+    return max(0, cooldown - elapsed.total_seconds())
+
+
+def restore_scaling(cluster_name, app_name, version):
+    """Main function for restoring the configured autoscaling bounds of a version after its cutover"""
+
+    settings = get_scaling_settings()
+    version_stack_name = "ECS-{cluster_name}-App-{app_name}-{version}".format(
+        cluster_name=cluster_name,
+        app_name=app_name,
+        version=version
+    )
+    alb_stack_name = 'ECS-{cluster_name}-App-{app_name}'.format(
+        cluster_name=cluster_name,
+        app_name=app_name
+    )
+
+    with span('restore_scaling', app=app_name, version=version, stack=version_stack_name):
+        service_arn = get_physical_resource_id(version_stack_name, 'ECSService')
+        remaining = get_remaining_cooldown(get_physical_resource_id(alb_stack_name, 'ALBListenerSSL'), service_arn, settings['cooldown'])
+        if remaining:
+            print('Waiting {:.0f}s for the rest of the scaling cooldown...'.format(remaining))
+            time.sleep(remaining)
+            record_wait('sleep.scaling_cooldown', remaining)
+        restore_configured_bounds(get_cluster_full_name(cluster_name), service_arn, version_stack_name)
+
+
+def main():
+    """CLI entrypoint for restore_scaling.py"""
+
+    restore_scaling(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'], version=os.environ['BUILD_VERSION'])
+
+
+if __name__ == "__main__":
+    with run_report('restore_scaling'), trace_run('restore_scaling'):
+        main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""CLI tool and function for rolling the default rule of an ALB back to the version live before the last cutover
+
+The last cutover is read from the listener's tags (see cutover_history.py), so the rollback
+does not have to resolve version stacks or scan the cluster for the previous service. If the
+previous service was scaled down after cutover (see drain.py) its autoscaling bounds are put
+back to the recorded ones and it is scaled back up first, otherwise the listener is flipped
+back with a single modify_listener call."""
+
+import os
+from clients import get_client
+from cutover import get_alb_default_target_group
+from cutover import get_cluster_full_name
+from cutover import wait_for_target_group_size
+from cutover_history import get_last_cutover
+from cutover_history import record_cutover
+from health import get_healthy_target_count
+from metrics import run_report
+from scaling import get_resource_id
+from scaling import get_scalable_target
+from scaling import set_capacity_bounds
+from stack_resources import get_physical_resource_id
+from tracing import span
+from tracing import trace_run
+from traffic_shift import set_listener_weights
+
+
+def restore_capacity_bounds(cluster_full_name, entry):
+    """Puts the scalable target of the service of a history entry back on the bounds it had when it was live"""
+
+    if entry['min-capacity'] is None:
+        return
+    resource_id = get_resource_id(cluster_full_name, entry['service'])
+    target = get_scalable_target(resource_id)
+    if target is None or (target['MinCapacity'], target['MaxCapacity']) == (entry['min-capacity'], entry['max-capacity']):
+        return
+    print('Restoring the capacity of {} to {}-{} (was {}-{}).'.format(
+        entry['service'].split('/')[-1], entry['min-capacity'], entry['max-capacity'], target['MinCapacity'], target['MaxCapacity']))
+    set_capacity_bounds(resource_id, entry['min-capacity'], entry['max-capacity'])
+
+
+def ensure_capacity(cluster_full_name, entry):
+    """Makes sure the service of a history entry has its autoscaling bounds and as many healthy targets as it had when it was live"""
+
+    restore_capacity_bounds(cluster_full_name, entry)
+    healthy, registered = get_healthy_target_count(entry['target-group'])
+    print('Previous version has {} healthy targets out of {} registered, {} needed.'.format(healthy, registered, entry['desired-count']))
+    if healthy >= entry['desired-count']:
+        return
+    service_name = entry['service'].split('/')[-1]
+    ecs = get_client('ecs')
+    service = ecs.describe_services(cluster=cluster_full_name, services=[service_name])['services'][0]
+    if service['desiredCount'] < entry['desired-count']:
+        print('Scaling {} back up to {} tasks.'.format(service_name, entry['desired-count']))
+        ecs.update_service(cluster=cluster_full_name, service=service_name, desiredCount=entry['desired-count'])
+    wait_for_target_group_size(entry['desired-count'], entry['target-group'])
+
+
+def rollback(cluster_name, app_name):
+    """Main function for rolling back the last cutover of an app"""
+
+    alb_stack_name = 'ECS-{cluster_name}-App-{app_name}'.format(
+        cluster_name=cluster_name,
+        app_name=app_name
+    )
+
+    with span('rollback', app=app_name):
+        alb_listener = get_physical_resource_id(alb_stack_name, 'ALBListenerSSL')
+        record = get_last_cutover(alb_listener)
+        previous, current = record['previous'], record['current']
+        print('Last cutover at {} went from {} to {}.'.format(record['time'], previous['service'].split('/')[-1], current['service'].split('/')[-1]))
+
+        live_target_group = get_alb_default_target_group(cluster_name, app_name)
+        if live_target_group != current['target-group']:
+            raise Exception("Cannot roll back, the listener forwards to {} instead of {} since the last cutover".format(live_target_group, current['target-group']))
+
+        with span('ensure_capacity', target_group=previous['target-group']):
+            ensure_capacity(previous['cluster'] or get_cluster_full_name(cluster_name), previous)
+        with span('modify_listener', listener=alb_listener, target_group=previous['target-group']):
+            set_listener_weights(alb_listener, {previous['target-group']: 1})
+        print('Rolled back to {}.'.format(previous['service'].split('/')[-1]))
+        record_cutover(alb_listener, current, previous)
+
+
+def main():
+    """CLI entrypoint for rollback.py"""
+
+    rollback(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'])
+
+
+if __name__ == "__main__":
+    with run_report('rollback'), trace_run('rollback'):
+        main()
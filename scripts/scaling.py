@@ -0,0 +1,104 @@
+"""Carries Application Auto Scaling state from the live version to a new version around cutover
+
+A new version's scalable target starts at the static bounds of its stack, so right after
+cutover it would be scaled in towards autoscaling_min_size while the old version was
+sized for the current load. With ECS_CUTOVER_CARRY_SCALING=true, the new version's bounds
+are raised to the live version's current capacity before traffic moves. The bounds
+configured in the stack are put back by restore_scaling.py, a separate step run once
+ECS_CUTOVER_SCALING_COOLDOWN seconds have passed since cutover, so cutover does not wait."""
+
+import os
+from clients import get_client
+
+
+SERVICE_NAMESPACE = 'ecs'
+SCALABLE_DIMENSION = 'ecs:service:DesiredCount'
+
+
+def get_scaling_settings():
+    """Returns whether scaling state is carried across versions and the cooldown before restoring it"""
+
+    return {
+        'carry': os.environ.get('ECS_CUTOVER_CARRY_SCALING', 'false') == 'true',
+        'cooldown': float(os.environ.get('ECS_CUTOVER_SCALING_COOLDOWN', '300'))
+    }
+
+
+def get_resource_id(cluster_full_name, service_name):
+    """Returns the Application Auto Scaling resource ID of an ECS service"""
+
+    return 'service/{}/{}'.format(cluster_full_name, service_name.split('/')[-1])
+
+
+def get_scalable_target(resource_id):
+    """Returns the scalable target of an ECS service's desired count, None if it is not autoscaled"""
+
+    autoscaling = get_client('application-autoscaling')
+    response = autoscaling.describe_scalable_targets(
+        ServiceNamespace=SERVICE_NAMESPACE,
+        ResourceIds=[resource_id],
+        ScalableDimension=SCALABLE_DIMENSION
+    )
+    return response['ScalableTargets'][0] if response['ScalableTargets'] else None
+
+
+def set_capacity_bounds(resource_id, min_capacity, max_capacity):
+    """Updates the minimum and maximum capacity of an existing scalable target"""
+
+    autoscaling = get_client('application-autoscaling')
+    autoscaling.register_scalable_target(
+        ServiceNamespace=SERVICE_NAMESPACE,
+        ResourceId=resource_id,
+        ScalableDimension=SCALABLE_DIMENSION,
+        MinCapacity=min_capacity,
+        MaxCapacity=max_capacity
+    )
+
+
+def get_configured_bounds(version_stack_name):
+    """Returns the (min, max) capacity a version stack was deployed with, None if it has no autoscaling"""
+
+    cloudformation = get_client('cloudformation')
+    stack = cloudformation.describe_stacks(StackName=version_stack_name)['Stacks'][0]
+    parameters = {x['ParameterKey']: x.get('ParameterValue') for x in stack.get('Parameters', [])}
+    if parameters.get('Autoscaling') != 'Enable':
+        return None
+    return int(parameters['AutoscalingMinSize']), int(parameters['AutoscalingMaxSize'])
+
+
+def carry_scaling_state(cluster_full_name, live_service, service_name):
+    """Raises a new version's scalable target bounds to cover the live service's current capacity
+
+    The minimum becomes at least the live desired count, so the new version is not scaled in
+    before it takes traffic, and the maximum at least the live version's maximum. Returns the
+    (min, max) applied, None when the new version is not autoscaled."""
+
+    resource_id = get_resource_id(cluster_full_name, service_name)
+    target = get_scalable_target(resource_id)
+    if target is None:
+        print('{} has no scalable target, not carrying scaling state.'.format(service_name))
+        return None
+    live_target = get_scalable_target(get_resource_id(cluster_full_name, live_service['serviceName']))
+    desired_count = live_service['desiredCount']
+    min_capacity = max(target['MinCapacity'], desired_count)
+    max_capacity = max(target['MaxCapacity'], desired_count, live_target['MaxCapacity'] if live_target else 0)
+    if (min_capacity, max_capacity) != (target['MinCapacity'], target['MaxCapacity']):
+        print('Carrying scaling state of {}: capacity {}-{} (was {}-{}).'.format(
+            live_service['serviceName'], min_capacity, max_capacity, target['MinCapacity'], target['MaxCapacity']))
+        set_capacity_bounds(resource_id, min_capacity, max_capacity)
+    return min_capacity, max_capacity
+
+
+def restore_configured_bounds(cluster_full_name, service_name, version_stack_name):
+    """Puts the version's scalable target back on its stack's bounds"""
+
+    bounds = get_configured_bounds(version_stack_name)
+    if bounds is None:
+        return
+    resource_id = get_resource_id(cluster_full_name, service_name)
+    target = get_scalable_target(resource_id)
+    if target is None or (target['MinCapacity'], target['MaxCapacity']) == bounds:
+        print('Capacity of {} is already the configured one.'.format(service_name.split('/')[-1]))
+        return
+    set_capacity_bounds(resource_id, *bounds)
+    print('Capacity of {} restored to {}-{}.'.format(service_name.split('/')[-1], *bounds))
@@ -0,0 +1,122 @@
+"""Incremental tailing of CloudFormation stack events while a stack operation runs"""
+
+import os
+import datetime
+import threading
+import contextlib
+import botocore
+from clients import get_client
+from concurrency import bind_thread_context
+
+
+def format_stack_event(stack_event, duration=None):
+    """Returns a printable line for a stack event, with the resource's duration when known"""
+
+    line = "{timestamp} {resource_status} {logical_resource_id} {resource_status_reason}".format(
+        timestamp=stack_event['Timestamp'].strftime('%H:%M:%S'),
+        resource_status=stack_event['ResourceStatus'],
+        logical_resource_id=stack_event['LogicalResourceId'],
+        resource_status_reason=stack_event.get('ResourceStatusReason', '')
+    ).rstrip()
+    if duration is not None:
+        line = "{} ({})".format(line, duration)
+    return line
+
+
+class StackEventTailer(threading.Thread):  # pylint: disable=too-many-instance-attributes
+    """Background thread printing new events of a stack as they happen
+
+    Keeps a cursor on the last event it printed, so each poll only pages through
+    describe_stack_events until it reaches events it has already seen."""
+
+    def __init__(self, stack_name, since=None, interval=None):
+        super().__init__(daemon=True)
+        self.stack_name = stack_name
+        self.since = since
+        self.interval = float(os.environ.get('ECS_STACK_EVENTS_POLL_INTERVAL', '5')) if interval is None else interval
+        self._in_context = bind_thread_context(lambda function: function())  # region, output prefix and span of the thread that started the tailer
+        self.last_event_id = None
+        self.started = {}
+        self.durations = {}
+        self._stop_event = threading.Event()
+
+    def fetch_new_events(self):
+        """Returns the events newer than the cursor, oldest first"""
+
+        cloudformation = get_client('cloudformation')
+        paginator = cloudformation.get_paginator('describe_stack_events')
+        new_events = []
+        for page in paginator.paginate(StackName=self.stack_name):
+            for stack_event in page['StackEvents']:  # newest first
+                if stack_event['EventId'] == self.last_event_id:
+                    return new_events[::-1]
+                if self.since is not None and stack_event['Timestamp'] < self.since:
+                    return new_events[::-1]
+                new_events.append(stack_event)
+        return new_events[::-1]
+
+    def poll(self):
+        """Prints every event that happened since the previous poll"""
+
+        try:
+            new_events = self.fetch_new_events()
+        except botocore.exceptions.ClientError as exception:
+            print("Could not fetch events for stack {}: {}".format(self.stack_name, exception.response['Error']['Message']))
+            return
+        for stack_event in new_events:
+            print(format_stack_event(stack_event, self._track_duration(stack_event)))
+            self.last_event_id = stack_event['EventId']
+
+    def _track_duration(self, stack_event):
+        """Records when a resource started changing and returns how long it took once it is done"""
+
+        logical_resource_id = stack_event['LogicalResourceId']
+        resource_status = stack_event['ResourceStatus']
+        if resource_status.endswith('_IN_PROGRESS'):
+            self.started.setdefault(logical_resource_id, stack_event['Timestamp'])
+            return None
+        started = self.started.pop(logical_resource_id, None)
+        if started is None:
+            return None
+        duration = stack_event['Timestamp'] - started
+        self.durations[logical_resource_id] = duration
+        return duration
+
+    def run(self):
+        self._in_context(self._poll_until_stopped)
+
+    def _poll_until_stopped(self):
+        while not self._stop_event.wait(self.interval):
+            self.poll()
+
+    def stop(self):
+        """Stops the thread after printing any remaining events"""
+
+        self._stop_event.set()
+        self.join()
+        self._in_context(self.poll)
+
+    def print_durations(self):
+        """Prints how long each resource took, slowest first"""
+
+        if not self.durations:
+            return
+        print("Time spent per resource:")
+        for logical_resource_id, duration in sorted(self.durations.items(), key=lambda x: x[1], reverse=True):
+            print("{:30}{}".format(logical_resource_id + ':', duration))
+
+
+@contextlib.contextmanager
+def tail_stack_events(stack_name):
+    """Prints the events of a stack while the body of the with statement runs
+
+    Only events from the moment the tailer starts are printed."""
+
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)  # allow for clock skew
+    tailer = StackEventTailer(stack_name, since=since)
+    tailer.start()
+    try:
+        yield tailer
+    finally:
+        tailer.stop()
+        tailer.print_durations()
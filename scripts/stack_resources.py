@@ -0,0 +1,67 @@
+"""In-process cache of CloudFormation stack resources"""
+
+import threading
+from clients import get_client
+from clients import get_region
+
+
+_RESOURCES = {}
+_KEY_LOCKS = {}
+_LOCK = threading.Lock()
+
+
+def _load_stack_resources(stack_name, region):
+    """Fetches every resource of a stack and returns a map of logical ID to physical ID"""
+
+    cloudformation = get_client('cloudformation', region)
+    paginator = cloudformation.get_paginator('list_stack_resources')
+    resources = {}
+    for page in paginator.paginate(StackName=stack_name):
+        for resource in page['StackResourceSummaries']:
+            resources[resource['LogicalResourceId']] = resource.get('PhysicalResourceId')
+    return resources
+
+
+def get_stack_resources(stack_name, region=None, refresh=False):
+    """Returns a map of logical ID to physical ID for every resource in a stack
+
+    The stack is only queried the first time it is requested (or when refresh is set),
+    every other lookup is served from memory."""
+
+    key = (get_region(region), stack_name)
+    with _LOCK:
+        resources = None if refresh else _RESOURCES.get(key)
+        key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+    if resources is not None:
+        return resources
+    with key_lock:  # concurrent lookups of the same stack wait for a single load
+        with _LOCK:
+            resources = None if refresh else _RESOURCES.get(key)
+        if resources is None:
+            resources = _load_stack_resources(stack_name, key[0])
+            with _LOCK:
+                _RESOURCES[key] = resources
+    return resources
+
+
+def get_physical_resource_id(stack_name, logical_resource_id, region=None, refresh=False):
+    """Returns the physical ID of a resource in a stack, raises KeyError if the stack has no such resource"""
+
+    physical_resource_id = get_stack_resources(stack_name, region=region, refresh=refresh).get(logical_resource_id)
+    if physical_resource_id is None:
+        raise KeyError("{} not found in stack {}".format(logical_resource_id, stack_name))
+    return physical_resource_id
+
+
+def reset_stack_resources():
+    """Forgets the cached resources of every stack"""
+
+    with _LOCK:
+        _RESOURCES.clear()
+
+
+def invalidate_stack_resources(stack_name, region=None):
+    """Forgets the cached resources of a stack, e.g. after it has been updated or deleted"""
+
+    with _LOCK:
+        _RESOURCES.pop((get_region(region), stack_name), None)
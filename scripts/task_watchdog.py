@@ -0,0 +1,133 @@
+"""Watchdog that aborts a stack operation when the ECS service's tasks keep failing"""
+
+import os
+import datetime
+import threading
+import contextlib
+import botocore
+from clients import get_client
+from concurrency import bind_thread_context
+from stack_resources import get_physical_resource_id
+
+
+FAILED_STOP_CODES = ['TaskFailedToStart', 'EssentialContainerExited']
+
+
+def is_failed_task(task):
+    """Returns True if a stopped task crashed or failed its load balancer health checks"""
+
+    if task.get('stopCode') in FAILED_STOP_CODES:
+        return True
+    return 'health checks' in task.get('stoppedReason', '')
+
+
+def format_stop_reasons(task):
+    """Returns printable lines describing why a task and its containers stopped"""
+
+    lines = ["Task {} stopped: {}".format(task['taskArn'].split('/')[-1], task.get('stoppedReason', 'unknown reason'))]
+    for container in task.get('containers', []):
+        lines.append("  {name}: exit code {exit_code} {reason}".format(
+            name=container['name'],
+            exit_code=container.get('exitCode', 'n/a'),
+            reason=container.get('reason', '')
+        ).rstrip())
+    return lines
+
+
+class TaskWatchdog(threading.Thread):  # pylint: disable=too-many-instance-attributes
+    """Background thread counting failed tasks of a version stack's ECS service
+
+    Once `max_failed_tasks` tasks have failed since the watchdog started, the stack
+    operation is aborted: a stack being created is deleted and an update is cancelled."""
+
+    def __init__(self, stack_name, cluster_name, creating, max_failed_tasks, interval=None):  # pylint: disable=too-many-arguments
+        super().__init__(daemon=True)
+        self.stack_name = stack_name
+        self.cluster_name = cluster_name
+        self.creating = creating
+        self.max_failed_tasks = max_failed_tasks
+        self.interval = float(os.environ.get('ECS_WATCHDOG_POLL_INTERVAL', '15')) if interval is None else interval
+        self._in_context = bind_thread_context(lambda function: function())  # region, output prefix and span of the thread that started the watchdog
+        self.since = datetime.datetime.now(datetime.timezone.utc)
+        self.failed_tasks = {}
+        self.tripped = False
+        self._stop_event = threading.Event()
+
+    def _get_service(self):
+        """Returns the service ARN once CloudFormation has created it, None before that"""
+
+        try:
+            return get_physical_resource_id(self.stack_name, 'ECSService', refresh=True) or None
+        except (KeyError, botocore.exceptions.ClientError):
+            return None
+
+    def get_failed_tasks(self, cluster, service):
+        """Returns the tasks of the service that failed since the watchdog started"""
+
+        ecs = get_client('ecs')
+        response = ecs.list_tasks(cluster=cluster, serviceName=service.split('/')[-1], desiredStatus='STOPPED')
+        task_arns = [x for x in response['taskArns'] if x not in self.failed_tasks]
+        for i in range(0, len(task_arns), 100):
+            response = ecs.describe_tasks(cluster=cluster, tasks=task_arns[i:i + 100])
+            for task in response['tasks']:
+                if task.get('stoppedAt', self.since) >= self.since and is_failed_task(task):
+                    self.failed_tasks[task['taskArn']] = task
+        return list(self.failed_tasks.values())
+
+    def check(self):
+        """Counts failed tasks and aborts the stack operation when there are too many"""
+
+        service = self._get_service()
+        if service is None:
+            return
+        cluster = get_physical_resource_id("ECS-{}".format(self.cluster_name), 'ECSCluster')
+        failed_tasks = self.get_failed_tasks(cluster, service)
+        if len(failed_tasks) < self.max_failed_tasks:
+            return
+
+        self.tripped = True
+        print("{} tasks of {} failed, aborting deployment:".format(len(failed_tasks), service))
+        for task in failed_tasks:
+            for line in format_stop_reasons(task):
+                print(line)
+        cloudformation = get_client('cloudformation')
+        if self.creating:
+            print("Deleting stack {}...".format(self.stack_name))
+            cloudformation.delete_stack(StackName=self.stack_name)
+        else:
+            print("Cancelling update of stack {}...".format(self.stack_name))
+            cloudformation.cancel_update_stack(StackName=self.stack_name)
+
+    def run(self):
+        self._in_context(self._check_until_stopped)
+
+    def _check_until_stopped(self):
+        while not self.tripped and not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except botocore.exceptions.ClientError as exception:
+                print("Task watchdog could not check {}: {}".format(self.stack_name, exception.response['Error']['Message']))
+
+    def stop(self):
+        """Stops the thread"""
+
+        self._stop_event.set()
+        self.join()
+
+
+@contextlib.contextmanager
+def watch_service_tasks(stack_name, cluster_name, creating):
+    """Runs a TaskWatchdog while the body of the with statement runs
+
+    Disabled unless ECS_WATCHDOG_MAX_FAILED_TASKS is set, yields None in that case."""
+
+    max_failed_tasks = int(os.environ.get('ECS_WATCHDOG_MAX_FAILED_TASKS', '0'))
+    if max_failed_tasks <= 0 or cluster_name is None:
+        yield None
+        return
+    watchdog = TaskWatchdog(stack_name, cluster_name, creating, max_failed_tasks)
+    watchdog.start()
+    try:
+        yield watchdog
+    finally:
+        watchdog.stop()
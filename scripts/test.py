@@ -2,10 +2,41 @@
 
 """Tests for ecs-utils"""
 
+import datetime
+import io
 import json
+import os
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
+import botocore
+import botocore.stub
+import autocleanup
+import benchmark
+import clients
+import concurrency
+import cutover
+import cutover_history
 import deploy
+import drain
+import fake_aws
+import stack_events
+import health
+import metrics
+import rate_limit
+import render
+import restore_scaling
+import rollback
+import scaling
+import stack_resources
+import task_watchdog
+import tracing
+import warmup
+import traffic_shift
+import test_parallel
+from test_parallel import use_fake_aws
+from test_parallel import without_rate_limits
 
 
 class GetPriorityTest(unittest.TestCase):
@@ -29,6 +60,12 @@ class GetPriorityTest(unittest.TestCase):
         priority = deploy.get_priority(rules)
         self.assertEqual(priority, 1)
 
+    def test_4(self):
+        """Test with excluded priorities"""
+        rules = [{"Priority": "1"}, {"Priority": "3"}, {"Priority": "default"}]
+        priority = deploy.get_priority(rules, excluded=['2', '4'])
+        self.assertEqual(priority, 5)
+
 
 class GenerateEnvironmentObjectTest(unittest.TestCase):
     """Unit tests for deploy.generate_environment_object()"""
@@ -153,6 +190,778 @@ class UpdateContainerDefinitionsWithEnvVarsTest(unittest.TestCase):
         self.assertEqual(result, expected_task_definition)
 
 
+class GetClientTest(unittest.TestCase):
+    """Unit tests for clients.get_client()"""
+
+    def setUp(self):
+        clients.reset_clients()
+
+    def tearDown(self):
+        clients.reset_clients()
+
+    @patch('boto3.session.Session')
+    def test_1(self, session):
+        """Test that clients are reused per service and region"""
+        session.return_value.region_name = 'ap-southeast-2'
+        session.return_value.client.side_effect = lambda service, **kwargs: unittest.mock.Mock(name=service)
+        first = clients.get_client('ecs')
+        self.assertIs(clients.get_client('ecs'), first)
+        self.assertIs(clients.get_client('ecs', 'ap-southeast-2'), first)
+        self.assertIsNot(clients.get_client('ecs', 'us-east-1'), first)
+        self.assertIsNot(clients.get_client('elbv2'), first)
+        self.assertEqual(session.return_value.client.call_count, 3)
+
+
+class GetPhysicalResourceIdTest(unittest.TestCase):
+    """Unit tests for stack_resources.get_physical_resource_id()"""
+
+    def setUp(self):
+        stack_resources._RESOURCES.clear()  # pylint: disable=protected-access
+
+    @patch('stack_resources.get_region', lambda region=None: 'ap-southeast-2')
+    @patch('stack_resources.get_client')
+    def test_1(self, get_client):
+        """Test that a stack is only fetched once until it is invalidated"""
+        paginator = get_client.return_value.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {"StackResourceSummaries": [{"LogicalResourceId": "ALB", "PhysicalResourceId": "alb-arn"}]},
+            {"StackResourceSummaries": [{"LogicalResourceId": "ALBListenerSSL", "PhysicalResourceId": "listener-arn"}]}
+        ]
+        self.assertEqual(stack_resources.get_physical_resource_id('ECS-c-App-a', 'ALB'), 'alb-arn')
+        self.assertEqual(stack_resources.get_physical_resource_id('ECS-c-App-a', 'ALBListenerSSL'), 'listener-arn')
+        self.assertRaises(KeyError, stack_resources.get_physical_resource_id, 'ECS-c-App-a', 'ECSService')
+        self.assertEqual(paginator.paginate.call_count, 1)
+        stack_resources.invalidate_stack_resources('ECS-c-App-a')
+        stack_resources.get_physical_resource_id('ECS-c-App-a', 'ALB')
+        self.assertEqual(paginator.paginate.call_count, 2)
+
+
+class ListStacksTest(unittest.TestCase):
+    """Unit tests for autocleanup.list_stacks()"""
+
+    @staticmethod
+    def _stack(name, app_name, status='CREATE_COMPLETE', description='ECS Cluster Application Version'):
+        return {
+            "StackName": name,
+            "StackId": "arn:aws:cloudformation:ap-southeast-2:12345678987:stack/{}/1".format(name),
+            "StackStatus": status,
+            "Description": description,
+            "CreationTime": datetime.datetime(2018, 1, 1),
+            "EnableTerminationProtection": False,
+            "Parameters": [{"ParameterKey": "Name", "ParameterValue": app_name}],
+            "Outputs": [{"OutputKey": "Version", "OutputValue": name.split('-')[-1]}]
+        }
+
+    @patch('autocleanup.get_client')
+    def test_1(self, get_client):
+        """Test that stacks are filtered from a single describe_stacks pass"""
+        paginator = get_client.return_value.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {"Stacks": [self._stack("ECS-c-App-a-1", "a"), self._stack("ECS-c-App-a-b-1", "a-b")]},
+            {"Stacks": [self._stack("ECS-c-App-a-2", "a", status='DELETE_FAILED'), self._stack("ECS-c-App-a-3", "a", description='Other'), self._stack("ECS-c-App-a-4", "a")]}
+        ]
+        stacks = autocleanup.list_stacks('c', 'a')
+        self.assertEqual([x['StackName'] for x in stacks], ["ECS-c-App-a-1", "ECS-c-App-a-4"])
+        self.assertEqual(autocleanup.get_stack_version(stacks[1]), "4")
+        self.assertFalse(autocleanup.get_termination_protection(stacks[1]))
+        get_client.return_value.describe_stacks.assert_not_called()
+
+
+class FilterNotCutoverTest(unittest.TestCase):
+    """Unit tests for autocleanup.filter_not_cutover()"""
+
+    @patch('autocleanup.get_physical_resource_id')
+    @patch('autocleanup.get_alb_default_target_groups')
+    def test_1(self, get_alb_default_target_groups, get_physical_resource_id):
+        """Test that live stacks are found from the TargetGroup output, without a call per stack"""
+        get_alb_default_target_groups.return_value = ['tg-2']
+        stacks = [{'StackName': 'ECS-c-App-a-{}'.format(x), 'Outputs': {'TargetGroup': 'tg-{}'.format(x)}} for x in range(1, 4)]
+        self.assertEqual([x['StackName'] for x in autocleanup.filter_not_cutover(stacks, 'c', 'a')], ['ECS-c-App-a-1', 'ECS-c-App-a-3'])
+        get_physical_resource_id.assert_not_called()
+
+    @patch('autocleanup.get_physical_resource_id')
+    def test_2(self, get_physical_resource_id):
+        """Test that stacks deployed before the TargetGroup output fall back to their resources"""
+        get_physical_resource_id.return_value = 'tg-1'
+        self.assertEqual(autocleanup.get_stack_target_group({'StackName': 'ECS-c-App-a-1', 'Outputs': {}}), 'tg-1')
+        get_physical_resource_id.assert_called_once_with('ECS-c-App-a-1', 'ALBTargetGroup')
+
+
+class GetLiveServiceTest(unittest.TestCase):
+    """Unit tests for cutover.get_live_service()"""
+
+    @patch('cutover.get_alb_default_target_group', lambda cluster_name, app_name: 'live-tg')
+    @patch('cutover.get_client')
+    def test_1(self, get_client):
+        """Test that services are described in batches of 10 and the scan stops at the live service"""
+        ecs = get_client.return_value
+        ecs.get_paginator.return_value.paginate.return_value = iter([
+            {"serviceArns": ["arn:aws:ecs:::service/svc-{}".format(i) for i in range(25)]},
+            {"serviceArns": ["arn:aws:ecs:::service/never-described"]}
+        ])
+
+        def describe_services(cluster, services):  # pylint: disable=unused-argument
+            self.assertLessEqual(len(services), 10)
+            return {"services": [{"serviceName": x, "desiredCount": 4, "loadBalancers": [{"targetGroupArn": 'live-tg' if x == 'svc-17' else 'other-tg'}]} for x in services]}
+        ecs.describe_services.side_effect = describe_services
+
+        service = cutover.get_live_service('c', 'a', cluster_full_name='cluster')
+        self.assertEqual(service['serviceName'], 'svc-17')
+        self.assertEqual(ecs.describe_services.call_count, 3)
+
+    @patch('cutover.get_alb_default_target_group', lambda cluster_name, app_name: 'live-tg')
+    @patch('cutover.get_client')
+    def test_2(self, get_client):
+        """Test that no live service returns None"""
+        ecs = get_client.return_value
+        ecs.get_paginator.return_value.paginate.return_value = [{"serviceArns": []}]
+        self.assertIsNone(cutover.get_live_desired_count('c', 'a', cluster_full_name='cluster'))
+
+    @patch('cutover.get_alb_default_target_group', lambda cluster_name, app_name: 'live-tg')
+    @patch('cutover.get_client')
+    def test_3(self, get_client):
+        """Test that the batches are described with the caller's region and tracing span"""
+        ecs = get_client.return_value
+        ecs.get_paginator.return_value.paginate.return_value = [{"serviceArns": ["arn:aws:ecs:::service/svc"]}]
+        seen = []
+
+        def describe_services(cluster, services):  # pylint: disable=unused-argument
+            seen.append((clients.get_region(), tracing.current_span()))
+            return {"services": []}
+        ecs.describe_services.side_effect = describe_services
+
+        with patch.dict(os.environ, {'ECS_TRACE_PATH': 'trace.json'}), clients.use_region('eu-west-1'), tracing.span('scan'):
+            parent = tracing.current_span()
+            cutover.get_live_service('c', 'a', cluster_full_name='cluster')
+        tracing.reset_trace()
+        self.assertEqual(seen, [('eu-west-1', parent)])
+
+
+class PollUntilTest(unittest.TestCase):
+    """Unit tests for health.poll_until()"""
+
+    def test_1(self):
+        """Test that backoff grows exponentially, is capped and jittered"""
+        intervals = health.backoff_intervals(1, 4)
+        for expected in [1, 2, 4, 4, 4]:
+            interval = next(intervals)
+            self.assertGreaterEqual(interval, expected / 2)
+            self.assertLessEqual(interval, expected)
+
+    @patch('time.sleep')
+    def test_2(self, sleep):
+        """Test that polling returns as soon as the condition is met"""
+        results = iter([False, False, 'done'])
+        result = health.poll_until(lambda: next(results), timeout=60, initial_interval=1, max_interval=4)
+        self.assertEqual(result['value'], 'done')
+        self.assertEqual(result['polls'], 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    @patch('time.sleep')
+    def test_3(self, sleep):  # pylint: disable=unused-argument
+        """Test that polling raises once the timeout is reached"""
+        self.assertRaises(health.PollTimeoutError, health.poll_until, lambda: False, timeout=0)
+
+
+class StackEventTailerTest(unittest.TestCase):
+    """Unit tests for stack_events.StackEventTailer"""
+
+    @staticmethod
+    def _event(event_id, logical_resource_id, resource_status, second):
+        return {
+            "EventId": event_id,
+            "LogicalResourceId": logical_resource_id,
+            "ResourceStatus": resource_status,
+            "Timestamp": datetime.datetime(2018, 1, 1, 0, 0, second, tzinfo=datetime.timezone.utc)
+        }
+
+    @patch('builtins.print')
+    @patch('stack_events.get_client')
+    def test_1(self, get_client, _print):
+        """Test that only new events are returned and resource durations are tracked"""
+        paginator = get_client.return_value.get_paginator.return_value
+        tailer = stack_events.StackEventTailer('stack', since=datetime.datetime(2018, 1, 1, 0, 0, 1, tzinfo=datetime.timezone.utc))
+        paginator.paginate.return_value = [
+            {"StackEvents": [self._event('2', 'ECSService', 'CREATE_IN_PROGRESS', 10), self._event('1', 'ALBTargetGroup', 'CREATE_COMPLETE', 5)]},
+            {"StackEvents": [self._event('0', 'ALBTargetGroup', 'CREATE_COMPLETE', 0)]}
+        ]
+        tailer.poll()
+        self.assertEqual(tailer.last_event_id, '2')
+        paginator.paginate.return_value = [
+            {"StackEvents": [self._event('3', 'ECSService', 'CREATE_COMPLETE', 40), self._event('2', 'ECSService', 'CREATE_IN_PROGRESS', 10)]}
+        ]
+        self.assertEqual([x['EventId'] for x in tailer.fetch_new_events()], ['3'])
+        tailer.poll()
+        self.assertEqual(tailer.durations, {'ECSService': datetime.timedelta(seconds=30)})
+
+    @patch('stack_events.get_client')
+    def test_2(self, get_client):
+        """Test that events printed by the tailer thread carry the output prefix of the thread that started it"""
+        get_client.return_value.get_paginator.return_value.paginate.return_value = [{"StackEvents": [self._event('1', 'ECSService', 'CREATE_COMPLETE', 5)]}]
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with concurrency.output_prefix('v1'):
+                tailer = stack_events.StackEventTailer('stack', interval=0.01)
+                tailer.start()
+                while tailer.last_event_id is None:
+                    time.sleep(0.01)
+                tailer.stop()
+            self.assertEqual(stdout.getvalue().splitlines(), ['[v1] 00:00:05 CREATE_COMPLETE ECSService'])
+
+
+class TaskWatchdogTest(unittest.TestCase):
+    """Unit tests for task_watchdog.TaskWatchdog"""
+
+    @staticmethod
+    def _task(task_id, stop_code, stopped_reason):
+        return {
+            "taskArn": "arn:aws:ecs:::task/{}".format(task_id),
+            "stopCode": stop_code,
+            "stoppedReason": stopped_reason,
+            "stoppedAt": datetime.datetime.now(datetime.timezone.utc),
+            "containers": [{"name": "app", "exitCode": 1, "reason": "OutOfMemoryError"}]
+        }
+
+    @patch('builtins.print')
+    @patch('task_watchdog.get_physical_resource_id', lambda stack_name, logical_resource_id, refresh=False: 'arn:aws:ecs:::service/cluster/svc')
+    @patch('task_watchdog.get_client')
+    def test_1(self, get_client, _print):
+        """Test that the stack is deleted once enough tasks have failed"""
+        watchdog = task_watchdog.TaskWatchdog('stack', 'cluster', creating=True, max_failed_tasks=2, interval=0)
+        watchdog.since = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+        client = get_client.return_value
+        client.list_tasks.return_value = {"taskArns": ["arn:aws:ecs:::task/1", "arn:aws:ecs:::task/2"]}
+        client.describe_tasks.return_value = {"tasks": [
+            self._task(1, 'EssentialContainerExited', 'Essential container in task exited'),
+            self._task(2, 'ServiceSchedulerInitiated', 'Scaling activity initiated by deployment')
+        ]}
+        watchdog.check()
+        self.assertFalse(watchdog.tripped)
+        client.list_tasks.return_value = {"taskArns": ["arn:aws:ecs:::task/1", "arn:aws:ecs:::task/3"]}
+        client.describe_tasks.return_value = {"tasks": [
+            self._task(3, 'ServiceSchedulerInitiated', 'Task failed ELB health checks in (target-group tg)')
+        ]}
+        watchdog.check()
+        self.assertTrue(watchdog.tripped)
+        client.delete_stack.assert_called_once_with(StackName='stack')
+        client.cancel_update_stack.assert_not_called()
+
+    @patch('task_watchdog.get_physical_resource_id', lambda stack_name, logical_resource_id, refresh=False: 'arn:aws:ecs:::service/cluster/svc')
+    @patch('task_watchdog.get_client')
+    def test_2(self, get_client):
+        """Test that the watchdog thread prints with the output prefix of the thread that started it"""
+        client = get_client.return_value
+        client.list_tasks.return_value = {"taskArns": ["arn:aws:ecs:::task/1"]}
+        client.describe_tasks.return_value = {"tasks": [self._task(1, 'EssentialContainerExited', 'Essential container in task exited')]}
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with concurrency.output_prefix('v1'):
+                watchdog = task_watchdog.TaskWatchdog('stack', 'cluster', creating=False, max_failed_tasks=1, interval=0)
+                watchdog.since = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+                watchdog.start()
+                watchdog.join()
+            lines = stdout.getvalue().splitlines()
+        self.assertTrue(watchdog.tripped)
+        self.assertIn('[v1] Cancelling update of stack stack...', lines)
+        self.assertTrue(all(x.startswith('[v1] ') for x in lines))
+
+
+class ParseTemplateTest(unittest.TestCase):
+    """Unit tests for deploy._parse_template(template)"""
+
+    @patch('deploy.get_client')
+    def test_1(self, get_client):
+        """Test that an unchanged template is only validated once"""
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict('os.environ', {'ECS_TEMPLATE_VALIDATION_CACHE': os.path.join(directory, 'cache', 'validation.json')}):
+                deploy._parse_template('template: 1')  # pylint: disable=protected-access
+                deploy._parse_template('template: 1')  # pylint: disable=protected-access
+                self.assertEqual(get_client.return_value.validate_template.call_count, 1)
+                deploy._parse_template('template: 2')  # pylint: disable=protected-access
+                self.assertEqual(get_client.return_value.validate_template.call_count, 2)
+                with patch.dict('os.environ', {'ECS_TEMPLATE_VALIDATION_TTL': '0'}):
+                    deploy._parse_template('template: 1')  # pylint: disable=protected-access
+                self.assertEqual(get_client.return_value.validate_template.call_count, 3)
+
+
+class UploadTaskDefinitionTest(unittest.TestCase):
+    """Unit tests for deploy.upload_task_definition(task_definition)"""
+
+    task_definition = {"family": "afamily", "containerDefinitions": [{"name": "aname", "image": "an/image"}], "memory": "128"}
+
+    def test_1(self):
+        """Test that the hash ignores key order and tags"""
+        reordered = {"memory": "128", "containerDefinitions": [{"image": "an/image", "name": "aname"}], "family": "afamily", "tags": [{"key": "a", "value": "b"}]}
+        self.assertEqual(deploy.get_task_definition_hash(self.task_definition), deploy.get_task_definition_hash(reordered))
+        changed = dict(self.task_definition, memory="256")
+        self.assertNotEqual(deploy.get_task_definition_hash(self.task_definition), deploy.get_task_definition_hash(changed))
+
+    @patch('builtins.print')
+    @patch('deploy.get_client')
+    def test_2(self, get_client, _print):
+        """Test that an identical latest revision is reused"""
+        ecs = get_client.return_value
+        ecs.describe_task_definition.return_value = {
+            "taskDefinition": {"taskDefinitionArn": "arn:aws:ecs:::task-definition/afamily:7"},
+            "tags": [{"key": deploy.TASK_DEFINITION_HASH_TAG, "value": deploy.get_task_definition_hash(self.task_definition)}]
+        }
+        self.assertEqual(deploy.upload_task_definition(self.task_definition), "arn:aws:ecs:::task-definition/afamily:7")
+        ecs.register_task_definition.assert_not_called()
+
+    @patch('builtins.print')
+    @patch('deploy.get_client')
+    def test_3(self, get_client, _print):
+        """Test that a changed definition is registered with its hash tag"""
+        ecs = get_client.return_value
+        ecs.describe_task_definition.return_value = {
+            "taskDefinition": {"taskDefinitionArn": "arn:aws:ecs:::task-definition/afamily:7"},
+            "tags": [{"key": deploy.TASK_DEFINITION_HASH_TAG, "value": "stale"}]
+        }
+        ecs.register_task_definition.return_value = {"taskDefinition": {"taskDefinitionArn": "arn:aws:ecs:::task-definition/afamily:8"}}
+        self.assertEqual(deploy.upload_task_definition(self.task_definition), "arn:aws:ecs:::task-definition/afamily:8")
+        tags = ecs.register_task_definition.call_args[1]['tags']
+        self.assertEqual(tags, [{"key": deploy.TASK_DEFINITION_HASH_TAG, "value": deploy.get_task_definition_hash(self.task_definition)}])
+
+
+class CreateOrUpdateStackTest(unittest.TestCase):
+    """Unit tests for deploy.create_or_update_stack() in change set mode"""
+
+    @patch('builtins.print')
+    @patch.dict('os.environ', {'ECS_DEPLOY_CHANGE_SET': 'true'})
+    @patch('deploy._stack_exists', lambda stack_name: True)
+    @patch('deploy._parse_template', lambda template: template)
+    @patch('deploy.get_client')
+    def test_1(self, get_client, _print):
+        """Test that an empty change set is discarded without updating the stack"""
+        cloudformation = get_client.return_value
+        cloudformation.create_change_set.return_value = {"Id": "change-set-arn", "StackId": "stack-arn"}
+        cloudformation.get_waiter.return_value.wait.side_effect = botocore.exceptions.WaiterError('ChangeSetCreateComplete', 'failed', {})
+        cloudformation.describe_change_set.return_value = {"Status": "FAILED", "StatusReason": "The submitted information didn't contain changes."}
+        cloudformation.describe_stacks.return_value = {"Stacks": [{"StackName": "stack"}]}
+        response = deploy.create_or_update_stack('stack', 'template', [], [])
+        self.assertEqual(response, {"Stacks": [{"StackName": "stack"}]})
+        cloudformation.delete_change_set.assert_called_once_with(ChangeSetName="change-set-arn")
+        cloudformation.execute_change_set.assert_not_called()
+        cloudformation.update_stack.assert_not_called()
+
+    @patch('builtins.print')
+    @patch('deploy.get_client')
+    def test_2(self, get_client, _print):
+        """Test that change set changes are read across pages"""
+        cloudformation = get_client.return_value
+        cloudformation.describe_change_set.side_effect = [
+            {"Changes": [{"Type": "Resource", "ResourceChange": {"Action": "Modify", "LogicalResourceId": "ECSService", "ResourceType": "AWS::ECS::Service", "Replacement": "True"}}], "NextToken": "next"},
+            {"Changes": [{"Type": "Resource", "ResourceChange": {"Action": "Modify", "LogicalResourceId": "ALBTargetGroup", "ResourceType": "AWS::ElasticLoadBalancingV2::TargetGroup", "Replacement": "False"}}]}
+        ]
+        changes = deploy.get_change_set_changes('change-set-arn')
+        self.assertEqual([x['LogicalResourceId'] for x in changes], ['ECSService', 'ALBTargetGroup'])
+
+
+class DeployVersionStackTest(unittest.TestCase):
+    """Unit tests for deploy.deploy_version_stack()"""
+
+    @patch('builtins.print')
+    @patch('deploy.allocate_rule_priority', lambda app_stack_name, excluded: 4)
+    @patch('deploy._is_priority_conflict', lambda stack_name: True)
+    @patch('deploy.get_client')
+    @patch('deploy.create_or_update_stack')
+    def test_1(self, create_or_update_stack, get_client, _print):
+        """Test that a priority conflict is retried with the next free priority"""
+        create_or_update_stack.side_effect = [botocore.exceptions.WaiterError('StackCreateComplete', 'failed', {}), {"Stacks": []}]
+        parameters = [{"ParameterKey": "Name", "ParameterValue": "a"}, {"ParameterKey": "RulePriority", "ParameterValue": "3"}]
+        response = deploy.deploy_version_stack('stack', 'app-stack', 'template', parameters, [], 'cluster')
+        self.assertEqual(response, {"Stacks": []})
+        get_client.return_value.delete_stack.assert_called_once_with(StackName='stack')
+        retried_parameters = create_or_update_stack.call_args[0][2]
+        self.assertIn({"ParameterKey": "RulePriority", "ParameterValue": "4"}, retried_parameters)
+
+    @patch('deploy.get_client')
+    @patch('deploy.create_or_update_stack')
+    def test_2(self, create_or_update_stack, get_client):
+        """Test that failures on an existing rule are not retried"""
+        create_or_update_stack.side_effect = botocore.exceptions.WaiterError('StackUpdateComplete', 'failed', {})
+        parameters = [{"ParameterKey": "RulePriority", "UsePreviousValue": True}]
+        self.assertRaises(botocore.exceptions.WaiterError, deploy.deploy_version_stack, 'stack', 'app-stack', 'template', parameters, [], 'cluster')
+        get_client.return_value.delete_stack.assert_not_called()
+
+
+class RenderTest(unittest.TestCase):
+    """Unit tests for render.Renderer"""
+
+    def test_1(self):
+        """Test substitution into nested structures, like envsubst"""
+        renderer = render.Renderer({'APP': 'api', 'VERSION': '1.2'})
+        rendered = renderer.render({"name": "${APP}", "image": "repo/$APP:${VERSION}", "ports": [{"containerPort": 8080}], "${APP}": "key"})
+        self.assertEqual(rendered, {"name": "api", "image": "repo/api:1.2", "ports": [{"containerPort": 8080}], "api": "key"})
+
+    def test_2(self):
+        """Test that unresolved and malformed variables are reported"""
+        renderer = render.Renderer({'ENV': 'Dev'})
+        rendered = renderer.render({"a": "${MISSING}-${ENV}", "b": "${SECURITY_CLASSIFICATION)"})
+        self.assertEqual(rendered, {"a": "-Dev", "b": "${SECURITY_CLASSIFICATION)"})
+        self.assertEqual(renderer.unresolved, {'MISSING'})
+        self.assertEqual(renderer.malformed, {'${SECURITY_CLASSIFICATION)'})
+        with patch.dict('os.environ', {'ECS_RENDER_STRICT': 'true'}):
+            self.assertRaises(render.RenderError, renderer.report, 'ecs-config.yml')
+
+    def test_3(self):
+        """Test that whole-value YAML placeholders keep their YAML type"""
+        renderer = render.Renderer({'SIZE': '3', 'ENABLED': 'Enable', 'EMPTY': ''})
+        rendered = renderer.render({"size": "${SIZE}", "autoscaling": "${ENABLED}", "path": "/${SIZE}", "empty": "${EMPTY}"}, yaml_scalars=True)
+        self.assertEqual(rendered, {"size": 3, "autoscaling": "Enable", "path": "/3", "empty": None})
+
+    def test_4(self):
+        """Test that JSON templates are rendered before they are parsed, so unquoted placeholders become numbers"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ecs.json')
+            with open(path, 'w') as json_file:
+                json_file.write('[{"name": "${APP}", "memory": ${MEMORY}, "portMappings": [{"containerPort": ${PORT}}]}]')
+            rendered = render.render_json_file(path, {'APP': 'api', 'MEMORY': '512', 'PORT': '8080'})
+        self.assertEqual(rendered, [{"name": "api", "memory": 512, "portMappings": [{"containerPort": 8080}]}])
+
+
+class BenchmarkTest(unittest.TestCase):
+    """Runs the benchmark scenarios against a small fake fleet"""
+
+    fleet = {'versions': 5, 'services': 45, 'rules': 5}
+
+    def setUp(self):
+        without_rate_limits(self)
+
+    def test_1(self):
+        """Test that every scenario completes against the fake"""
+        for scenario in benchmark.SCENARIOS:
+            result = benchmark.run_scenario(scenario, self.fleet)
+            self.assertIsNone(result['error'], scenario)
+            self.assertGreater(result['total_calls'], 0)
+
+    def test_2(self):
+        """Test that cutover describes services in batches of 10, deploy validates the template once and autocleanup makes no lookups per stack"""
+        result = benchmark.run_scenario('cutover', self.fleet)
+        self.assertLessEqual(result['calls']['ecs.describe_services'], 7)  # 51 services in batches of 10, plus the new service's count
+        result = benchmark.run_scenario('deploy', self.fleet)
+        self.assertEqual(result['calls']['cloudformation.validate_template'], 1)
+        self.assertEqual(result['calls']['cloudformation.create_stack'], 1)
+        result = benchmark.run_scenario('autocleanup', self.fleet)
+        self.assertEqual(result['calls']['elbv2.describe_rules'], 1)  # live target groups resolved once per run
+        self.assertEqual(result['calls']['cloudformation.list_stack_resources'], 1)  # the listener, stacks come from the inventory
+        self.assertEqual(result['calls']['cloudformation.describe_stacks'], 5)  # the inventory, then one waiter poll per deleted stack
+
+
+class FakeAWSTest(unittest.TestCase):
+    """Unit tests for the fake clients"""
+
+    def setUp(self):
+        metrics.reset_metrics()
+        self.addCleanup(metrics.reset_metrics)
+
+    @patch('fake_aws.time.sleep')
+    def test_1(self, sleep):
+        """Test that throttled attempts are retried and raised as ThrottlingException once the retries run out"""
+        fake = fake_aws.FakeAWS(throttle_rate=1.0)
+        fake.build_fleet('c', 'a', versions=1, services=0, rules=0)
+        use_fake_aws(self, fake)
+        with patch.dict(os.environ, {'ECS_UTILS_MAX_ATTEMPTS': '2'}):
+            ecs = clients.get_client('ecs', 'ap-southeast-2')
+            with self.assertRaises(botocore.exceptions.ClientError) as context:
+                ecs.list_services(cluster='c')
+        self.assertEqual(context.exception.response['Error']['Code'], 'ThrottlingException')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(fake.throttles['ecs.list_services'], 3)
+        record = metrics.get_summary()['operations']['ecs.ListServices']
+        self.assertEqual((record['count'], record['errors'], record['retries'], record['throttles']), (1, 1, 2, 3))
+
+    def test_2(self):
+        """Test that fake clients wait for the rate limiter like boto3 clients"""
+        fake = fake_aws.FakeAWS()
+        fake.build_fleet('c', 'a', versions=1, services=0, rules=0)
+        use_fake_aws(self, fake)
+        with patch.dict(os.environ, {'ECS_RATE_LIMITS': 'ecs=50'}):
+            rate_limit.reset_rate_limiters()
+            ecs = clients.get_client('ecs', 'ap-southeast-2')
+            for _ in range(int(rate_limit.get_rate_limiter('ecs', 'ap-southeast-2').capacity) + 2):
+                ecs.list_services(cluster='c')
+        self.assertIn('rate_limit.ecs', metrics.get_summary()['waits'])
+
+
+class MetricsTest(unittest.TestCase):
+    """Unit tests for metrics"""
+
+    def setUp(self):
+        metrics.reset_metrics()
+        clients.reset_clients()
+
+    def tearDown(self):
+        metrics.reset_metrics()
+        clients.reset_clients()
+
+    def test_1(self):
+        """Test that calls and errors of registry clients are recorded per operation"""
+        cloudformation = clients.get_client('cloudformation', 'ap-southeast-2')
+        with botocore.stub.Stubber(cloudformation) as stubber:
+            stubber.add_response('describe_stacks', {'Stacks': []})
+            stubber.add_client_error('describe_stacks', 'ValidationError', 'Stack does not exist')
+            cloudformation.describe_stacks(StackName='a')
+            self.assertRaises(botocore.exceptions.ClientError, cloudformation.describe_stacks, StackName='b')
+        summary = metrics.get_summary()
+        self.assertEqual(summary['operations']['cloudformation.DescribeStacks']['count'], 2)
+        self.assertEqual(summary['operations']['cloudformation.DescribeStacks']['errors'], 1)
+        self.assertEqual(summary['services']['cloudformation']['count'], 2)
+
+    @patch('builtins.print')
+    def test_2(self, _print):
+        """Test that throttled attempts and waits are included in the JSON report"""
+        operation = clients.get_client('ecs', 'ap-southeast-2').meta.service_model.operation_model('DescribeServices')
+        metrics._needs_retry(response=(None, {'Error': {'Code': 'ThrottlingException'}}), operation=operation)  # pylint: disable=protected-access
+        metrics.record_wait('sleep.health_poll', 1.5)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            with patch.dict('os.environ', {'ECS_METRICS_PATH': path}):
+                with metrics.run_report('cutover'):
+                    pass
+            with open(path, 'r') as metrics_file:
+                summary = json.load(metrics_file)
+        self.assertEqual(summary['command'], 'cutover')
+        self.assertTrue(summary['succeeded'])
+        self.assertEqual(summary['operations']['ecs.DescribeServices']['throttles'], 1)
+        self.assertEqual(summary['waits']['sleep.health_poll'], {'count': 1, 'total_seconds': 1.5})
+
+
+class RateLimitTest(unittest.TestCase):
+    """Unit tests for rate_limit"""
+
+    def test_1(self):
+        """Test that callers beyond the burst capacity are spaced out at the configured rate"""
+        bucket = rate_limit.TokenBucket(rate=10, capacity=2)
+        waits = [bucket.reserve() for _ in range(4)]
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertAlmostEqual(waits[2], 0.1, places=2)
+        self.assertAlmostEqual(waits[3], 0.2, places=2)
+
+    def test_2(self):
+        """Test that ECS_RATE_LIMITS overrides the defaults and 0 disables a limit"""
+        rate_limit.reset_rate_limiters()
+        with patch.dict('os.environ', {'ECS_RATE_LIMITS': 'cloudformation=2, ecs=0'}):
+            self.assertEqual(rate_limit.get_rate_limiter('cloudformation', 'ap-southeast-2').rate, 2.0)
+            self.assertIsNone(rate_limit.get_rate_limiter('ecs', 'ap-southeast-2'))
+            self.assertIs(rate_limit.get_rate_limiter('cloudformation', 'ap-southeast-2'), rate_limit.get_rate_limiter('cloudformation', 'ap-southeast-2'))
+        rate_limit.reset_rate_limiters()
+
+    def test_3(self):
+        """Test that registry clients retry in adaptive mode"""
+        self.assertEqual(clients.get_client_config().retries['mode'], 'adaptive')  # pylint: disable=no-member
+
+
+class TrafficShiftTest(unittest.TestCase):
+    """Unit tests for traffic_shift"""
+
+    def test_1(self):
+        """Test that weights round-trip through listener actions and a single target group is a plain forward"""
+        action = traffic_shift.get_forward_action({'old-tg': 75, 'new-tg': 25})
+        self.assertEqual(traffic_shift.get_action_weights(action), {'old-tg': 75, 'new-tg': 25})
+        self.assertEqual(traffic_shift.get_forward_action({'old-tg': 0, 'new-tg': 100}), {'Type': 'forward', 'TargetGroupArn': 'new-tg'})
+
+    @patch('builtins.print')
+    @patch('traffic_shift.set_listener_weights')
+    def test_2(self, set_listener_weights, _print):
+        """Test that a failed check restores the previous step's weights"""
+        checks = iter([None, 'service not stable'])
+        settings = {'steps': [10, 50, 100], 'interval': 0, 'check_interval': 0}
+        with self.assertRaises(traffic_shift.TrafficShiftError):
+            traffic_shift.shift_traffic('listener', 'old-tg', 'new-tg', lambda: next(checks), settings)
+        self.assertEqual([x[0][1] for x in set_listener_weights.call_args_list], [
+            {'old-tg': 90, 'new-tg': 10},
+            {'old-tg': 50, 'new-tg': 50},
+            {'old-tg': 90, 'new-tg': 10}
+        ])
+
+    def test_3(self):
+        """Test that the step schedule always ends at 100% and must be strictly increasing"""
+        for steps in ['10, 50', '10,50,100']:
+            with patch.dict('os.environ', {'ECS_CUTOVER_STEPS': steps}):
+                self.assertEqual(traffic_shift.get_shift_settings()['steps'], [10, 50, 100])
+        for steps in ['50,10', '10,10,50', '0,50', '50,100,100']:
+            with patch.dict('os.environ', {'ECS_CUTOVER_STEPS': steps}), self.assertRaises(ValueError, msg=steps):
+                traffic_shift.get_shift_settings()
+
+    @patch('cutover.get_list_of_rules', lambda app_stack_name: [{'IsDefault': True, 'Actions': [traffic_shift.get_forward_action({'old-tg': 60, 'new-tg': 40})]}])
+    def test_4(self):
+        """Test that both target groups of a weighted default rule count as live"""
+        self.assertEqual(cutover.get_alb_default_target_group('c', 'a'), 'old-tg')
+        self.assertEqual(sorted(cutover.get_alb_default_target_groups('c', 'a')), ['new-tg', 'old-tg'])
+
+
+class FakeFleetTestCase(unittest.TestCase):
+    """Runs each test against a fake fleet: app `a` in cluster `c` with versions v0 and v1 (live) and an undeployed `new` version"""
+
+    fleet = {'versions': 2, 'services': 3, 'rules': 0, 'desired_count': 4}
+    new_version = {'desired_count': 1}
+
+    def setUp(self):
+        self.fake = fake_aws.FakeAWS()
+        self.fake.build_fleet('c', 'a', **self.fleet)
+        self.fake.add_version('c', 'a', 'new', **self.new_version)
+        self.listener = self.fake.stacks['ECS-c-App-a']['Resources']['ALBListenerSSL'][0]
+        use_fake_aws(self, self.fake)
+
+    def default_target_group(self):
+        """Returns the target group the fake listener forwards to"""
+        return self.fake.listeners[self.listener][0]['Actions'][0]['TargetGroupArn']
+
+
+class WarmupTest(FakeFleetTestCase):
+    """Unit tests for warmup"""
+
+    @patch('builtins.print')
+    def test_1(self, _print):
+        """Test that warming up scales the new version to the live count so cutover does not have to"""
+        warmup.warm_up_version('c', 'a', 'new')
+        self.assertEqual(self.fake.calls['ecs.update_service'], 1)
+        self.fake.reset_counters()
+        cutover.set_correct_service_size('c', 'a', 'ECS-c-App-a-new', cutover.get_version_target_group('ECS-c-App-a-new'))
+        self.assertEqual(self.fake.calls['ecs.update_service'], 0)
+
+
+class ScalingTest(FakeFleetTestCase):
+    """Unit tests for scaling"""
+
+    fleet = {'versions': 2, 'services': 0, 'rules': 0, 'desired_count': 6, 'autoscaling': (2, 8)}
+    new_version = {'desired_count': 1, 'autoscaling': (1, 4)}
+
+    @patch('restore_scaling.time.sleep')
+    @patch('builtins.print')
+    def test_1(self, _print, sleep):
+        """Test that cutover carries the live capacity to the new version without waiting, and restore-scaling puts the configured bounds back"""
+        target = next(x for x in self.fake.scalable_targets.values() if 'ECS-c-App-a-new' in x['ResourceId'])
+        with patch.dict(os.environ, {'ECS_CUTOVER_CARRY_SCALING': 'true', 'ECS_CUTOVER_SCALING_COOLDOWN': '0'}):
+            cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+            self.assertEqual(self.fake.calls['application-autoscaling.register_scalable_target'], 1)
+            self.assertEqual((target['MinCapacity'], target['MaxCapacity']), (6, 8))
+            restore_scaling.restore_scaling('c', 'a', 'new')
+        sleep.assert_not_called()
+        self.assertEqual(self.fake.calls['application-autoscaling.register_scalable_target'], 2)
+        self.assertEqual((target['MinCapacity'], target['MaxCapacity']), (1, 4))
+
+    @patch('scaling.set_capacity_bounds')
+    @patch('scaling.get_scalable_target')
+    def test_2(self, get_scalable_target, set_capacity_bounds):
+        """Test that carried bounds cover the live desired count and maximum, and are left alone when they already do"""
+        get_scalable_target.side_effect = [{'MinCapacity': 1, 'MaxCapacity': 4}, {'MinCapacity': 2, 'MaxCapacity': 8}]
+        self.assertEqual(scaling.carry_scaling_state('cluster', {'serviceName': 'live', 'desiredCount': 6}, 'new'), (6, 8))
+        set_capacity_bounds.assert_called_once_with('service/cluster/new', 6, 8)
+        set_capacity_bounds.reset_mock()
+        get_scalable_target.side_effect = [{'MinCapacity': 6, 'MaxCapacity': 10}, {'MinCapacity': 2, 'MaxCapacity': 8}]
+        self.assertEqual(scaling.carry_scaling_state('cluster', {'serviceName': 'live', 'desiredCount': 6}, 'new'), (6, 10))
+        set_capacity_bounds.assert_not_called()
+        get_scalable_target.side_effect = [None]
+        with patch('builtins.print'):
+            self.assertIsNone(scaling.carry_scaling_state('cluster', {'serviceName': 'live', 'desiredCount': 6}, 'new'))
+
+    @patch('restore_scaling.time.sleep')
+    @patch('builtins.print')
+    def test_3(self, _print, sleep):
+        """Test that restore-scaling run right after cutover only waits for the rest of the cooldown"""
+        with patch.dict(os.environ, {'ECS_CUTOVER_CARRY_SCALING': 'true', 'ECS_CUTOVER_SCALING_COOLDOWN': '300'}):
+            cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+            restore_scaling.restore_scaling('c', 'a', 'new')
+        sleep.assert_called_once()
+        self.assertTrue(290 < sleep.call_args[0][0] <= 300)
+
+    @patch('builtins.print')
+    def test_4(self, _print):
+        """Test that warm-up pins the new version's autoscaling minimum at the warm-up count even without ECS_CUTOVER_CARRY_SCALING"""
+        target = next(x for x in self.fake.scalable_targets.values() if 'ECS-c-App-a-new' in x['ResourceId'])
+        with patch.dict(os.environ, {'ECS_CUTOVER_CARRY_SCALING': 'false'}):
+            warmup.warm_up_version('c', 'a', 'new')
+        self.assertEqual((target['MinCapacity'], target['MaxCapacity']), (6, 8))
+
+
+class DrainTest(FakeFleetTestCase):
+    """Unit tests for drain"""
+
+    fleet = dict(FakeFleetTestCase.fleet, autoscaling=(2, 8))
+
+    @patch('health.time.sleep')
+    @patch('builtins.print')
+    def test_1(self, _print, sleep):
+        """Test that cutover scales the previous version down to the floor and waits for its targets to drain, not for the deregistration delay"""
+        previous = self.fake.stacks['ECS-c-App-a-v1']['Resources']['ECSService'][0]
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': '1'}):
+            cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+        self.assertEqual(sleep.call_count, 1)  # one poll while the three stopped targets drain
+        self.assertLess(sleep.call_args[0][0], 30)
+        self.assertFalse(self.fake.draining)
+        services = {x['serviceArn']: x for x in self.fake.services.values()}
+        self.assertEqual(services[previous]['desiredCount'], 1)
+        self.assertEqual(self.fake.calls['ecs.update_service'], 2)  # resize of the new version, scale-down of the previous one
+        target = next(x for x in self.fake.scalable_targets.values() if previous.endswith(x['ResourceId'].split('/')[-1]))
+        self.assertEqual((target['MinCapacity'], target['MaxCapacity']), (1, 8))
+
+    def test_2(self):
+        """Test that the previous version is left running unless a floor is set"""
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': ''}):
+            self.assertIsNone(drain.get_drain_settings()['floor'])
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': '0'}):
+            self.assertEqual(drain.get_drain_settings()['floor'], 0)
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': '-1'}):
+            self.assertRaises(ValueError, drain.get_drain_settings)
+
+
+class RollbackTest(FakeFleetTestCase):
+    """Unit tests for rollback"""
+
+    fleet = dict(FakeFleetTestCase.fleet, autoscaling=(2, 8))
+
+    @patch('health.time.sleep')
+    @patch('builtins.print')
+    def test_1(self, _print, _sleep):
+        """Test that rollback scales the drained previous version back up and flips the listener with one call"""
+        previous = self.default_target_group()
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': '0'}):
+            cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+        new = self.default_target_group()
+        self.assertNotEqual(new, previous)
+        self.fake.reset_counters()
+        rollback.rollback('c', 'a')
+        self.assertEqual(self.default_target_group(), previous)
+        self.assertEqual(self.fake.calls['elbv2.modify_listener'], 1)
+        self.assertEqual(self.fake.calls['ecs.update_service'], 1)
+        self.assertEqual(self.fake.calls['ecs.list_services'], 0)
+        rollback.rollback('c', 'a')  # the rollback is recorded too, so rolling back again rolls forward
+        self.assertEqual(self.default_target_group(), new)
+
+    @patch('builtins.print')
+    def test_2(self, _print):
+        """Test that rollback refuses to run without a recorded cutover, or when the listener changed since"""
+        self.assertRaises(cutover_history.NoCutoverRecordedError, rollback.rollback, 'c', 'a')
+        cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+        cutover.change_default_rule_tg('c', 'a', 'v0', 'example.com', '/')
+        self.fake.tags[self.listener]['ecs-utils:cutover-target-group'] = 'arn:other'
+        self.assertRaises(Exception, rollback.rollback, 'c', 'a')
+        self.assertEqual(self.fake.calls['elbv2.modify_listener'], 2)
+
+    @patch('health.time.sleep')
+    @patch('builtins.print')
+    def test_3(self, _print, _sleep):
+        """Test that rollback restores the autoscaling bounds lowered by the drain, using the recorded cluster with old-format service ARNs"""
+        previous = self.fake.stacks['ECS-c-App-a-v1']['Resources']['ECSService'][0]
+        with patch.dict(os.environ, {'ECS_CUTOVER_SCALE_DOWN_FLOOR': '0'}):
+            cutover.change_default_rule_tg('c', 'a', 'new', 'example.com', '/')
+        tags = self.fake.tags[self.listener]
+        self.assertEqual((tags['ecs-utils:cutover-previous-min-capacity'], tags['ecs-utils:cutover-previous-max-capacity']), ('2', '8'))
+        tags['ecs-utils:cutover-previous-service'] = 'arn:aws:ecs:ap-southeast-2:123456789012:service/{}'.format(previous.split('/')[-1])
+        rollback.rollback('c', 'a')
+        target = next(x for x in self.fake.scalable_targets.values() if previous.endswith(x['ResourceId'].split('/')[-1]))
+        self.assertEqual((target['MinCapacity'], target['MaxCapacity']), (2, 8))
+        services = {x['serviceArn']: x for x in self.fake.services.values()}
+        self.assertEqual(services[previous]['desiredCount'], 4)
+
+
+def load_tests(loader, tests, _pattern):
+    """Runs the tests of test_parallel.py along with these ones"""
+
+    tests.addTests(loader.loadTestsFromModule(test_parallel))
+    return tests
+
+
 def main():
     """Entrypoint for CLI"""
 
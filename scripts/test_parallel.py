@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""Tests for the parallel runs of ecs-utils: autocleanup, batch deploy, fan-out and run_graph, plus the fake AWS fixtures shared with test.py"""
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+import botocore
+import botocore.stub
+import yaml
+import autocleanup
+import benchmark
+import batch_deploy
+import clients
+import concurrency
+import cutover
+import fake_aws
+import fanout
+import rate_limit
+import stack_resources
+import tracing
+
+
+def without_rate_limits(test):
+    """Lifts the client rate limits for the rest of `test`, the fake answers instantly"""
+
+    patcher = patch.dict(os.environ, {'ECS_RATE_LIMITS': ','.join('{}=0'.format(x) for x in rate_limit.DEFAULT_RATE_LIMITS)})
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    rate_limit.reset_rate_limiters()
+    test.addCleanup(rate_limit.reset_rate_limiters)
+
+
+def use_fake_aws(test, fake):
+    """Makes the scripts call `fake` instead of AWS for the rest of `test`"""
+
+    without_rate_limits(test)
+    clients.set_client_factory(fake.client)
+    test.addCleanup(clients.set_client_factory, None)
+    stack_resources.reset_stack_resources()
+    test.addCleanup(stack_resources.reset_stack_resources)
+
+
+class CleanupVersionsTest(unittest.TestCase):
+    """Unit tests for autocleanup.cleanup_versions()"""
+
+    stacks = [{'StackName': 'ECS-c-App-a-{}'.format(x), 'StackId': 'id-{}'.format(x), 'Outputs': {'Version': str(x), 'TargetGroup': 'tg-{}'.format(x)}} for x in range(1, 4)]
+
+    @patch('autocleanup.cleanup_version_stack')
+    def test_1(self, cleanup_version_stack):
+        """Test that a failing version does not stop the others"""
+        def cleanup(cluster_name, app_name, version, **_):  # pylint: disable=unused-argument
+            if version == '2':
+                raise Exception('delete failed')
+        cleanup_version_stack.side_effect = cleanup
+        with patch('builtins.print'):
+            results = autocleanup.cleanup_versions('c', 'a', self.stacks, concurrency=3, live_target_groups=['tg-4'])
+        self.assertEqual([x['name'] for x in results], ['1', '2', '3'])
+        self.assertEqual([x['error'] is None for x in results], [True, False, True])
+        self.assertEqual(cleanup_version_stack.call_count, 3)
+
+    @patch('autocleanup.cleanup_version_stack')
+    @patch('autocleanup.get_alb_default_target_groups')
+    def test_2(self, get_alb_default_target_groups, cleanup_version_stack):
+        """Test that deletions get the stack ID and target group from the inventory and the live target groups are resolved once"""
+        get_alb_default_target_groups.return_value = ['tg-4']
+        with patch('builtins.print'):
+            autocleanup.cleanup_versions('c', 'a', self.stacks, concurrency=3)
+        get_alb_default_target_groups.assert_called_once_with('c', 'a')
+        cleanup_version_stack.assert_any_call(cluster_name='c', app_name='a', version='2', stack_id='id-2', target_group='tg-2', live_target_groups=['tg-4'])
+
+
+class BatchDeployTest(unittest.TestCase):
+    """Unit tests for batch_deploy"""
+
+    @patch.dict('os.environ', {'ENV': 'Dev', 'ECS_CLUSTER_NAME': 'cluster', 'AWS_HOSTED_ZONE': 'example.com'})
+    def test_1(self):
+        """Test that manifest entries are merged with defaults and the environment"""
+        manifest = "defaults:\n  env: QA\nservices:\n  - app_name: api\n    version: 1.0\n    base_path: /api\n  - app_name: web\n    version: 2\n    base_path: /\n    cluster_name: other\n"
+        with patch('builtins.open', unittest.mock.mock_open(read_data=manifest)):
+            services = batch_deploy.load_manifest('batch.yml')
+        self.assertEqual([(x['app_name'], x['version'], x['env'], x['cluster_name']) for x in services], [('api', '1.0', 'QA', 'cluster'), ('web', '2', 'QA', 'other')])
+        self.assertEqual(services[0]['task_definition'], 'deployment/ecs.json')
+
+    @patch('builtins.print')
+    def test_2(self, _print):
+        """Test that one failing task does not stop the others"""
+        def fail():
+            raise Exception('boom')
+        results = concurrency.run_tasks([('a', lambda: 1), ('b', fail), ('c', lambda: 3)], max_workers=2)
+        self.assertEqual([x['name'] for x in results], ['a', 'b', 'c'])
+        self.assertEqual([x['value'] for x in results], [1, None, 3])
+        self.assertEqual(str(results[1]['error']), 'boom')
+
+    def test_3(self):
+        """Test that tasks run with the caller's region and their output is prefixed with their name"""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), clients.use_region('us-east-1'):
+            results = concurrency.run_tasks([('a', lambda: print(clients.get_region()) or clients.get_region())], max_workers=2)
+        self.assertEqual(results[0]['value'], 'us-east-1')
+        self.assertEqual(output.getvalue(), '[a] us-east-1\n')
+
+    @patch('builtins.print')
+    def test_4(self, _print):
+        """Test that each service's containers get the service's own variables, not the runner's"""
+        fake = fake_aws.FakeAWS()
+        fake.build_fleet('c', 'a', versions=1, services=0, rules=0)
+        use_fake_aws(self, fake)
+        with tempfile.TemporaryDirectory() as directory:
+            files = {
+                '.env': 'ECS_APP_NAME\nBUILD_VERSION\nBASE_PATH\n',
+                'ecs.json': json.dumps({'family': 'a', 'containerDefinitions': [{'name': '${ECS_APP_NAME}', 'image': 'a', 'portMappings': [{'containerPort': 80}]}]}),
+                'ecs-config.yml': yaml.safe_dump(dict(benchmark.CONFIG, lb_health_check='${BASE_PATH}'))
+            }
+            for name, content in files.items():
+                with open(os.path.join(directory, name), 'w') as output_file:
+                    output_file.write(content)
+            runner = {
+                'ECS_APP_NAME': 'runner', 'BUILD_VERSION': '0.0.0', 'BASE_PATH': '/runner', 'DOTENV': os.path.join(directory, '.env'),
+                'ECS_TEMPLATE_VALIDATION_CACHE': os.path.join(directory, 'validation.json'), 'ECS_STACK_EVENTS_POLL_INTERVAL': '0.1'
+            }
+            services = [
+                {'app_name': 'a', 'version': version, 'base_path': base_path, 'env': 'QA', 'cluster_name': 'c', 'aws_hosted_zone': 'example.com',
+                 'task_definition': os.path.join(directory, 'ecs.json'), 'config': os.path.join(directory, 'ecs-config.yml'), 'variables': {}}
+                for version, base_path in [('1.2.3', '/one'), ('2.0.0', '/two')]
+            ]
+            with patch.dict(os.environ, runner):
+                for service in services:
+                    batch_deploy._deploy_service(service, 'Resources: {}')  # pylint: disable=protected-access
+        environments = [{x['name']: x['value'] for x in revision['taskDefinition']['containerDefinitions'][0]['environment']} for revision in fake.task_definitions['a']]
+        self.assertEqual(environments, [
+            {'ECS_APP_NAME': 'a', 'BUILD_VERSION': '1.2.3', 'BASE_PATH': '/one'},
+            {'ECS_APP_NAME': 'a', 'BUILD_VERSION': '2.0.0', 'BASE_PATH': '/two'}
+        ])
+
+
+class FanoutTest(unittest.TestCase):
+    """Unit tests for fanout"""
+
+    def test_1(self):
+        """Test parsing of region:cluster targets"""
+        targets = fanout.parse_targets('ap-southeast-2:cluster-a, us-east-1:cluster-b,')
+        self.assertEqual(targets, [('ap-southeast-2', 'cluster-a'), ('us-east-1', 'cluster-b')])
+        self.assertRaises(Exception, fanout.parse_targets, 'cluster-a')
+
+    @patch.dict('os.environ', {'ECS_APP_NAME': 'a', 'BUILD_VERSION': '1'})
+    @patch('fanout.cleanup_version_stack')
+    def test_2(self, cleanup_version_stack):
+        """Test that each target runs with its own region"""
+        cleanup_version_stack.side_effect = lambda **kwargs: clients.get_region()
+        tasks = fanout.get_tasks('cleanup', [('ap-southeast-2', 'cluster-a'), ('us-east-1', 'cluster-b')])
+        self.assertEqual([(name, task()) for name, task in tasks], [('ap-southeast-2:cluster-a', 'ap-southeast-2'), ('us-east-1:cluster-b', 'us-east-1')])
+        cleanup_version_stack.assert_called_with(cluster_name='cluster-b', app_name='a', version='1')
+
+    @patch.dict('os.environ', {'ECS_APP_NAME': 'a', 'BUILD_VERSION': '1', 'ENV': 'QA', 'AWS_HOSTED_ZONE': 'example.com', 'BASE_PATH': '/', 'ECS_CLUSTER_NAME': 'runner'})
+    @patch('fanout.load_deployment_files', lambda variables: ({}, {}, ''))
+    @patch('fanout.deploy_ecs_service')
+    def test_3(self, deploy_ecs_service):
+        """Test that each target's containers get the target's cluster and region, not the runner's"""
+        for _, task in fanout.get_tasks('deploy', [('ap-southeast-2', 'cluster-a'), ('us-east-1', 'cluster-b')]):
+            task()
+        variables = [x[1]['variables'] for x in deploy_ecs_service.call_args_list]
+        self.assertEqual([(x['ECS_CLUSTER_NAME'], x['AWS_DEFAULT_REGION']) for x in variables], [('cluster-a', 'ap-southeast-2'), ('cluster-b', 'us-east-1')])
+
+    @patch('builtins.print')
+    def test_4(self, _print):
+        """Test that with fail-fast a running target stops at its next check and queued targets never start"""
+        failed = threading.Event()
+
+        def fail():
+            failed.set()
+            raise Exception('boom')
+
+        def fake_deploy():
+            failed.wait(5)
+            for _ in range(500):  # the failing task sets the stop event right after raising
+                concurrency.check_stopped()
+                time.sleep(0.01)
+            return 'finished'
+
+        results = concurrency.run_tasks([('a', fail), ('b', fake_deploy), ('c', lambda: 'started')], max_workers=2, fail_fast=True)
+        self.assertEqual(str(results[0]['error']), 'boom')
+        self.assertEqual([x['error'] for x in results[1:]], ['cancelled', 'cancelled'])
+        self.assertEqual([x['value'] for x in results], [None, None, None])
+        concurrency.check_stopped()  # no stop event outside of the run
+
+    @patch('builtins.print')
+    def test_5(self, _print):
+        """Test that a stopped cutover does not touch the listener"""
+        fake = fake_aws.FakeAWS()
+        fake.build_fleet('c', 'a', versions=2, services=0, rules=0)
+        fake.add_version('c', 'a', 'new')
+        use_fake_aws(self, fake)
+        stop = threading.Event()
+        stop.set()
+        with concurrency.use_stop_event(stop):
+            self.assertRaises(concurrency.TaskStoppedError, cutover.change_default_rule_tg, 'c', 'a', 'new', 'example.com', '/')
+        self.assertEqual(fake.calls['elbv2.modify_listener'], 0)
+        self.assertEqual(fake.calls['ecs.update_service'], 0)
+
+
+class RunGraphTest(unittest.TestCase):
+    """Unit tests for concurrency.run_graph()"""
+
+    @patch('builtins.print')
+    def test_1(self, _print):
+        """Test that steps receive their dependencies' results and independent steps overlap"""
+        barrier = threading.Barrier(2, timeout=5)
+
+        def independent(value):
+            barrier.wait()  # only passes if both independent steps run at the same time
+            return value
+        results = concurrency.run_graph([
+            ('a', lambda _: independent(1), []),
+            ('b', lambda _: independent(2), []),
+            ('c', lambda inputs: inputs['a'] + inputs['b'], ['a', 'b'])
+        ])
+        self.assertEqual(results, {'a': 1, 'b': 2, 'c': 3})
+
+    def test_2(self):
+        """Test that the critical path follows the dependencies that finished last"""
+        timings = {'a': {'start': 0, 'end': 1}, 'b': {'start': 0, 'end': 3}, 'c': {'start': 3, 'end': 4}, 'd': {'start': 0, 'end': 2}}
+        dependencies = {'a': [], 'b': [], 'c': ['a', 'b'], 'd': []}
+        self.assertEqual(concurrency.get_critical_path(timings, dependencies), ['b', 'c'])
+
+    @patch('builtins.print')
+    def test_3(self, _print):
+        """Test that a failing step is re-raised and its dependants never run"""
+        def fail(_):
+            raise ValueError('boom')
+        dependant = unittest.mock.Mock()
+        self.assertRaises(ValueError, concurrency.run_graph, [('a', fail, []), ('b', dependant, ['a'])])
+        dependant.assert_not_called()
+
+
+class TracingTest(unittest.TestCase):
+    """Unit tests for tracing"""
+
+    def setUp(self):
+        tracing.reset_trace()
+        clients.reset_clients()
+
+    def tearDown(self):
+        tracing.reset_trace()
+        clients.reset_clients()
+
+    @patch('builtins.print')
+    def test_1(self, _print):
+        """Test that spans nest across run_graph threads and AWS calls are recorded as children"""
+        cloudformation = clients.get_client('cloudformation', 'ap-southeast-2')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            with patch.dict('os.environ', {'ECS_TRACE_PATH': path}), botocore.stub.Stubber(cloudformation) as stubber:
+                stubber.add_response('describe_stacks', {'Stacks': []})
+                with tracing.trace_run('deploy'):
+                    with tracing.span('stack_deploy', stack='ECS-c-App-a-1'):
+                        concurrency.run_graph([('lookup', lambda _: cloudformation.describe_stacks(StackName='a'), [])])
+            with open(path, 'r') as trace_file:
+                events = {x['name']: x for x in json.load(trace_file)['traceEvents'] if x['ph'] == 'X'}
+        self.assertIsNone(events['deploy']['args']['parent_id'])
+        self.assertEqual(events['stack_deploy']['args']['parent_id'], events['deploy']['args']['span_id'])
+        self.assertEqual(events['stack_deploy']['args']['stack'], 'ECS-c-App-a-1')
+        self.assertEqual(events['cloudformation.DescribeStacks']['cat'], 'aws')
+        self.assertEqual(events['cloudformation.DescribeStacks']['args']['parent_id'], events['stack_deploy']['args']['span_id'])
+        self.assertNotEqual(events['cloudformation.DescribeStacks']['tid'], events['stack_deploy']['tid'])
+
+    def test_2(self):
+        """Test that nothing is recorded unless ECS_TRACE_PATH is set"""
+        with patch.dict('os.environ', {'ECS_TRACE_PATH': ''}):
+            with tracing.span('phase'):
+                pass
+        self.assertEqual(tracing.get_trace()['traceEvents'], [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
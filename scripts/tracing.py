@@ -0,0 +1,155 @@
+"""Lightweight spans written as a Chrome trace file, to look at the timeline of a run offline
+
+Tracing is enabled by setting ECS_TRACE_PATH. Wrap the phases of a run in span(), the AWS
+calls of every registry client are recorded as child spans automatically. The file can be
+opened in chrome://tracing or https://ui.perfetto.dev.
+
+    with trace_run('deploy'):
+        with span('stack_deploy', stack=stack_name):
+            ..."""
+
+import os
+import json
+import time
+import itertools
+import threading
+import contextlib
+
+
+_LOCK = threading.Lock()
+_EVENTS = []
+_THREADS = set()
+_THREAD_STATE = threading.local()
+_SPAN_IDS = itertools.count(1)
+_EPOCH = time.time() - time.perf_counter()  # converts perf_counter readings to wall clock time
+_CONTEXT_KEY = 'ecs_utils_tracing'
+
+
+def is_enabled():
+    """Returns True if spans are being recorded"""
+
+    return bool(os.environ.get('ECS_TRACE_PATH'))
+
+
+def _timestamp():
+    return (_EPOCH + time.perf_counter()) * 1000000  # microseconds, as Chrome traces expect
+
+
+def current_span():
+    """Returns the ID of the innermost open span of this thread, None outside of any span"""
+
+    stack = getattr(_THREAD_STATE, 'spans', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def use_parent(span_id):
+    """Makes spans opened in this thread children of `span_id`, used to carry a span over to pool threads"""
+
+    previous = getattr(_THREAD_STATE, 'spans', None)
+    _THREAD_STATE.spans = [] if span_id is None else [span_id]
+    try:
+        yield
+    finally:
+        _THREAD_STATE.spans = previous
+
+
+def _record(name, category, start, end, attributes):
+    thread = threading.current_thread()
+    with _LOCK:
+        _EVENTS.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round(start, 1),
+            'dur': round(end - start, 1),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+            'args': attributes
+        })
+        if thread.ident not in _THREADS:
+            _THREADS.add(thread.ident)
+            _EVENTS.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident, 'args': {'name': thread.name}})
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Records the with statement as a span with the given attributes, a no-op unless tracing is enabled"""
+
+    if not is_enabled():
+        yield
+        return
+    span_id = next(_SPAN_IDS)
+    attributes = dict(attributes, span_id=span_id, parent_id=current_span())
+    if getattr(_THREAD_STATE, 'spans', None) is None:
+        _THREAD_STATE.spans = []
+    _THREAD_STATE.spans.append(span_id)
+    start = _timestamp()
+    try:
+        yield
+    except BaseException as exception:
+        attributes['error'] = str(exception)
+        raise
+    finally:
+        _THREAD_STATE.spans.pop()
+        _record(name, 'phase', start, _timestamp(), attributes)
+
+
+def _before_call(model, context, **_):
+    if is_enabled():
+        context[_CONTEXT_KEY] = (model.service_model.service_name, model.name, _timestamp())
+
+
+def _after_call(context, parsed=None, exception=None, **_):
+    if _CONTEXT_KEY not in context:
+        return
+    service, operation, start = context.pop(_CONTEXT_KEY)
+    attributes = {'parent_id': current_span()}
+    if parsed is not None:
+        attributes['retries'] = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if 'Error' in parsed:
+            attributes['error'] = parsed['Error'].get('Code')
+    if exception is not None:
+        attributes['error'] = str(exception)
+    _record('{}.{}'.format(service, operation), 'aws', start, _timestamp(), attributes)
+
+
+def trace_client(client):
+    """Registers hooks on a boto3 client recording each of its calls as a span"""
+
+    client.meta.events.register_first('before-call.*.*', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call)
+
+
+def get_trace():
+    """Returns the trace recorded so far in Chrome trace format"""
+
+    with _LOCK:
+        return {'traceEvents': list(_EVENTS), 'displayTimeUnit': 'ms'}
+
+
+def reset_trace():
+    """Forgets every recorded span"""
+
+    with _LOCK:
+        del _EVENTS[:]
+        _THREADS.clear()
+
+
+@contextlib.contextmanager
+def trace_run(command):
+    """Records the with statement as the root span of a run and writes the trace to ECS_TRACE_PATH at the end"""
+
+    if not is_enabled():
+        yield
+        return
+    try:
+        with span(command):
+            yield
+    finally:
+        path = os.environ['ECS_TRACE_PATH']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as trace_file:
+            json.dump(get_trace(), trace_file)
+        print("Trace written to {}".format(path))
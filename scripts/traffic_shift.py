@@ -0,0 +1,121 @@
+"""Progressive, health-gated shift of an ALB listener's default traffic between two target groups
+
+Enabled by ECS_CUTOVER_STEPS, the percentages of traffic sent to the new version at each
+step, e.g. `10,25,50,100`. After each step the new version is watched for
+ECS_CUTOVER_STEP_INTERVAL seconds; if its targets become unhealthy or its ECS service is
+not stable, the listener is put back on the previous step's weights and the cutover fails."""
+
+import os
+import time
+from clients import get_client
+from health import get_healthy_target_count
+from metrics import record_wait
+from tracing import span
+
+
+class TrafficShiftError(Exception):
+    """Raised when the new version fails its checks during a progressive cutover"""
+
+
+def get_shift_settings():
+    """Returns the step schedule and timings, an empty schedule means cutting over in one go
+
+    The steps must be strictly increasing percentages between 1 and 99, 100 is always the last
+    step and may be given explicitly."""
+
+    steps = [int(x) for x in os.environ.get('ECS_CUTOVER_STEPS', '').split(',') if x.strip()]
+    if steps and steps[-1] == 100:
+        steps.pop()
+    if any(x < 1 or x > 99 for x in steps) or any(x >= y for x, y in zip(steps, steps[1:])):
+        raise ValueError("ECS_CUTOVER_STEPS must be strictly increasing percentages between 1 and 99, optionally followed by 100")
+    if steps:
+        steps.append(100)
+    return {
+        'steps': steps,
+        'interval': float(os.environ.get('ECS_CUTOVER_STEP_INTERVAL', '60')),
+        'check_interval': float(os.environ.get('ECS_CUTOVER_CHECK_INTERVAL', '10'))
+    }
+
+
+def get_forward_action(weights):
+    """Returns a listener default action forwarding to target groups by weight, given as {arn: weight}
+
+    A single target group gets a plain forward action, so a finished shift looks like a regular cutover."""
+
+    weights = {key: value for key, value in weights.items() if value > 0}
+    if len(weights) == 1:
+        return {'Type': 'forward', 'TargetGroupArn': list(weights)[0]}
+    return {
+        'Type': 'forward',
+        'ForwardConfig': {
+            'TargetGroups': [{'TargetGroupArn': key, 'Weight': value} for key, value in weights.items()]
+        }
+    }
+
+
+def get_action_weights(action):
+    """Returns the {target group ARN: weight} of a forward action, plain or weighted"""
+
+    if 'ForwardConfig' in action:
+        return {x['TargetGroupArn']: x.get('Weight', 1) for x in action['ForwardConfig']['TargetGroups']}
+    return {action['TargetGroupArn']: 1}
+
+
+def set_listener_weights(listener, weights):
+    """Points the listener's default action at the given {target group ARN: weight}"""
+
+    elbv2 = get_client('elbv2')
+    elbv2.modify_listener(ListenerArn=listener, DefaultActions=[get_forward_action(weights)])
+
+
+def check_version(cluster_full_name, service_full_name, target_group):
+    """Returns why the version is not fit to take traffic, None if it is
+
+    The service must have a single deployment with all its tasks running, and the target
+    group at least as many healthy targets as the service's desired count."""
+
+    ecs = get_client('ecs')
+    service = ecs.describe_services(cluster=cluster_full_name, services=[service_full_name])['services'][0]
+    if len(service.get('deployments', [])) > 1:
+        return "service {} has {} deployments in progress".format(service_full_name, len(service['deployments']))
+    if service['runningCount'] < service['desiredCount']:
+        return "service {} runs {} of {} tasks".format(service_full_name, service['runningCount'], service['desiredCount'])
+    healthy, registered = get_healthy_target_count(target_group)
+    if healthy < service['desiredCount']:
+        return "{} of {} targets are healthy, {} expected".format(healthy, registered, service['desiredCount'])
+    return None
+
+
+def watch_version(check, interval, check_interval):
+    """Calls `check` every check_interval seconds for `interval` seconds, returns the first failure or None"""
+
+    deadline = time.monotonic() + interval
+    while True:
+        failure = check()
+        remaining = deadline - time.monotonic()
+        if failure is not None or remaining <= 0:
+            return failure
+        sleep = min(check_interval, remaining)
+        time.sleep(sleep)
+        record_wait('sleep.cutover_step', sleep)
+
+
+def shift_traffic(listener, old_target_group, new_target_group, check, settings):
+    """Moves the listener's default traffic to the new target group step by step
+
+    `check` returns why the new version is unfit, or None. On a failed check the listener
+    goes back to the previous step's weights and TrafficShiftError is raised."""
+
+    previous = {old_target_group: 100}
+    for step in settings['steps']:
+        weights = {old_target_group: 100 - step, new_target_group: step}
+        with span('traffic_step', weight=step):
+            print('Sending {}% of traffic to the new version...'.format(step))
+            set_listener_weights(listener, weights)
+            failure = watch_version(check, settings['interval'], settings['check_interval'])
+            if failure is not None:
+                print('New version failed its checks at {}%: {}'.format(step, failure))
+                print('Restoring previous weights: {}% to the new version.'.format(previous.get(new_target_group, 0)))
+                set_listener_weights(listener, previous)
+                raise TrafficShiftError("Cutover stopped at {}%: {}".format(step, failure))
+        previous = weights
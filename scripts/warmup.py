@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""CLI tool and function for scaling a deployed version up to the live version's size ahead of cutover
+
+Run right after deploy (the `deploy` make target does so when ECS_DEPLOY_PRESCALE=true), so
+the tasks start while the release is still being verified and cutover only has to flip
+the listener. The version's autoscaling minimum is always raised to the warm-up count, as
+with ECS_CUTOVER_CARRY_SCALING=true, or target tracking would scale the idle version back
+down before cutover. restore_scaling.py puts the configured bounds back after cutover."""
+
+import os
+from concurrency import check_stopped
+from cutover import get_version_target_group
+from cutover import set_correct_service_size
+from metrics import run_report
+from tracing import span
+from tracing import trace_run
+
+
+def warm_up_version(cluster_name, app_name, version):
+    """Scales a version's service to the live service's desired count, pinning its autoscaling minimum there, and waits for its targets to be healthy"""
+
+    version_stack_name = "ECS-{cluster_name}-App-{app_name}-{version}".format(
+        cluster_name=cluster_name,
+        app_name=app_name,
+        version=version
+    )
+    with span('warm_up_version', app=app_name, version=version, stack=version_stack_name):
+        print('Warming up {} to the size of the live version...'.format(version_stack_name))
+        target_group = get_version_target_group(version_stack_name)
+        check_stopped()
+        set_correct_service_size(cluster_name=cluster_name, app_name=app_name, version_stack_name=version_stack_name, target_group=target_group, carry_scaling=True)
+
+
+def main():
+    """CLI entrypoint for warmup.py"""
+
+    warm_up_version(cluster_name=os.environ['ECS_CLUSTER_NAME'], app_name=os.environ['ECS_APP_NAME'], version=os.environ['BUILD_VERSION'])
+
+
+if __name__ == "__main__":
+    with run_report('warmup'), trace_run('warmup'):
+        main()